@@ -0,0 +1,459 @@
+-- microbenchmarks for the generated bindings
+--
+-- run through the benchmark host, which opens the fixture packages:
+--
+--   host bench.lua [pattern]
+--
+-- only cases whose name contains pattern are run. BENCH_TIME sets the time
+-- spent on each case in seconds. for every case, the number of operations per
+-- second and the allocations per operation made by C++ and by Lua are printed
+
+local bench = bench
+local Flat = protobuf.bench.flat.Flat
+local Level = protobuf.bench.flat.Level
+local Node = protobuf.bench.nested.Node
+local Envelope = protobuf.bench.nested.Envelope
+local Series = protobuf.bench.lists.Series
+local Blob = protobuf.bench.blobs.Blob
+
+local pattern = ...
+local duration = tonumber(os.getenv("BENCH_TIME")) or 0.5
+
+local cases = {}
+
+-- setup() prepares a case and returns a function that performs n operations
+local function case(name, setup)
+    cases[#cases + 1] = { name = name, setup = setup }
+end
+
+-- fixtures
+
+local function filled_flat()
+    local m = Flat.new()
+    m:set_f_int32(-123456)
+    m:set_f_int64(1234567890123)
+    m:set_f_uint32(4000000000)
+    m:set_f_uint64(9007199254740)
+    m:set_f_sint32(-42)
+    m:set_f_sint64(-4242424242)
+    m:set_f_fixed32(123)
+    m:set_f_fixed64(456)
+    m:set_f_sfixed32(-789)
+    m:set_f_sfixed64(-1011)
+    m:set_f_double(3.14159)
+    m:set_f_float(2.5)
+    m:set_f_bool(true)
+    m:set_f_string("the quick brown fox")
+    m:set_f_bytes("\0\1\2\3\4\5\6\7")
+    m:set_f_enum(Level.HIGH)
+    m:set_f_int32_b(7)
+    m:set_f_int64_b(8)
+    m:set_f_double_b(9.5)
+    m:set_f_string_b("jumps over the lazy dog")
+    return m
+end
+
+-- a chain of depth nodes, each with width children
+local function filled_node(depth, width)
+    local m = Node.new()
+    local node = m
+    for d = 1, depth do
+        node:set_value(d)
+        node:set_name("node " .. d)
+        for i = 1, width do
+            local child = node:add_children()
+            child:set_value(i)
+            child:set_name("leaf " .. i)
+        end
+        if d < depth then
+            node = node:get_child()
+        end
+    end
+    return m
+end
+
+local function filled_series(n)
+    local m = Series.new()
+    for i = 1, n do
+        m:set_ints(i, i)
+        m:set_doubles(i, i / 3)
+        m:set_labels(i, "label " .. i)
+        local p = m:add_points()
+        p:set_x(i)
+        p:set_y(-i)
+    end
+    return m
+end
+
+local function filled_blob(size)
+    local m = Blob.new()
+    m:set_data(string.rep("x", size))
+    for i = 1, 16 do
+        m:set_chunks(i, string.rep(string.char(64 + i), size / 16))
+    end
+    m:set_text(string.rep("text ", size / 5))
+    return m
+end
+
+-- creating messages
+
+for name, T in pairs({ Flat = Flat, Node = Node, Series = Series, Blob = Blob }) do
+    case("new " .. name, function()
+        local new = T.new
+        return function(n)
+            for i = 1, n do
+                new()
+            end
+        end
+    end)
+end
+
+-- accessors of every field type
+
+local values = {
+    f_int32 = -123456, f_int64 = 1234567890123, f_uint32 = 4000000000,
+    f_uint64 = 9007199254740, f_sint32 = -42, f_sint64 = -4242424242,
+    f_fixed32 = 123, f_fixed64 = 456, f_sfixed32 = -789, f_sfixed64 = -1011,
+    f_double = 3.14159, f_float = 2.5, f_bool = true,
+    f_string = "the quick brown fox", f_bytes = "\0\1\2\3\4\5\6\7",
+    f_enum = Level.HIGH,
+}
+
+for field, value in pairs(values) do
+    case("get " .. field, function()
+        local m = filled_flat()
+        local get = m["get_" .. field]
+        return function(n)
+            for i = 1, n do
+                get(m)
+            end
+        end
+    end)
+
+    case("set " .. field, function()
+        local m = Flat.new()
+        local set = m["set_" .. field]
+        return function(n)
+            for i = 1, n do
+                set(m, value)
+            end
+        end
+    end)
+end
+
+case("has f_int32", function()
+    local m = filled_flat()
+    local has = m.has_f_int32
+    return function(n)
+        for i = 1, n do
+            has(m)
+        end
+    end
+end)
+
+case("enum lookup", function()
+    local x
+    return function(n)
+        for i = 1, n do
+            x = Level.HIGH
+        end
+    end
+end)
+
+case("enum reverse lookup", function()
+    local x
+    return function(n)
+        for i = 1, n do
+            x = Level[3]
+        end
+    end
+end)
+
+-- large bytes fields
+
+case("get 1 MB bytes", function()
+    local m = filled_blob(1024 * 1024)
+    return function(n)
+        for i = 1, n do
+            m:get_data()
+        end
+    end
+end)
+
+case("get_view 1 MB bytes", function()
+    local m = filled_blob(1024 * 1024)
+    return function(n)
+        for i = 1, n do
+            m:get_data_view()
+        end
+    end
+end)
+
+case("set 1 MB bytes", function()
+    local m = Blob.new()
+    local data = string.rep("x", 1024 * 1024)
+    return function(n)
+        for i = 1, n do
+            m:set_data(data)
+        end
+    end
+end)
+
+-- repeated fields
+
+case("get repeated int32", function()
+    local m = filled_series(1000)
+    return function(n)
+        for i = 1, n do
+            m:get_ints(i % 1000 + 1)
+        end
+    end
+end)
+
+case("set repeated int32", function()
+    local m = filled_series(1000)
+    return function(n)
+        for i = 1, n do
+            m:set_ints(i % 1000 + 1, i)
+        end
+    end
+end)
+
+case("append repeated int32", function()
+    local m = Series.new()
+    return function(n)
+        m:clear_ints()
+        for i = 1, n do
+            m:set_ints(i, i)
+        end
+    end
+end)
+
+case("size repeated int32", function()
+    local m = filled_series(1000)
+    return function(n)
+        for i = 1, n do
+            m:size_ints()
+        end
+    end
+end)
+
+case("get repeated string", function()
+    local m = filled_series(1000)
+    return function(n)
+        for i = 1, n do
+            m:get_labels(i % 1000 + 1)
+        end
+    end
+end)
+
+case("get repeated message field", function()
+    local m = filled_series(1000)
+    return function(n)
+        for i = 1, n do
+            m:get_points(i % 1000 + 1):get_x()
+        end
+    end
+end)
+
+case("add repeated message", function()
+    local m = Series.new()
+    return function(n)
+        m:clear_points()
+        for i = 1, n do
+            m:add_points()
+        end
+    end
+end)
+
+-- nested fields
+
+case("get nested chain", function()
+    local m = filled_node(4, 1)
+    return function(n)
+        for i = 1, n do
+            m:get_child():get_child():get_children(1):get_value()
+        end
+    end
+end)
+
+case("getpath nested", function()
+    local m = filled_node(4, 1)
+    local path = Node.path("child.child.children[1].value")
+    return function(n)
+        for i = 1, n do
+            m:getpath(path)
+        end
+    end
+end)
+
+-- parsing and serializing
+
+local payloads = {
+    { "Flat", Flat, function() return filled_flat() end },
+    { "Node 16x16", Node, function() return filled_node(16, 16) end },
+    { "Series 10000", Series, function() return filled_series(10000) end },
+    { "Blob 1 MB", Blob, function() return filled_blob(1024 * 1024) end },
+}
+
+for _, payload in ipairs(payloads) do
+    local name, T, fill = payload[1], payload[2], payload[3]
+
+    case("parsefromstring " .. name, function()
+        local s = fill():serialized()
+        local parse = T.parsefromstring
+        return function(n)
+            for i = 1, n do
+                parse(s)
+            end
+        end
+    end)
+
+    case("serialized " .. name, function()
+        local m = fill()
+        return function(n)
+            for i = 1, n do
+                m:serialized()
+            end
+        end
+    end)
+end
+
+case("parse_many 100 Flat", function()
+    local s = filled_flat():serialized()
+    local batch = {}
+    for i = 1, 100 do
+        batch[i] = s
+    end
+    return function(n)
+        local out = {}
+        for i = 1, n / 100 do
+            Flat.parse_many(batch, out)
+        end
+    end
+end)
+
+case("protobuf.parse Flat", function()
+    local s = filled_flat():serialized()
+    return function(n)
+        for i = 1, n do
+            protobuf.parse("bench.flat.Flat", s)
+        end
+    end
+end)
+
+-- only the envelope's route is read, as a proxy would
+for _, field in ipairs({ "payload", "lazy_payload" }) do
+    case("parse and route Envelope." .. field, function()
+        local m = Envelope.new()
+        m:set_id(1)
+        m:set_route("backend")
+        m["set_" .. field](m, filled_node(16, 16))
+        local s = m:serialized()
+        return function(n)
+            for i = 1, n do
+                local e = Envelope.parsefromstring(s)
+                e:get_route()
+                e:serialized()
+            end
+        end
+    end)
+end
+
+-- garbage collector churn
+
+case("gc churn Flat", function()
+    return function(n)
+        for i = 1, n do
+            local m = Flat.new()
+            m:set_f_string("the quick brown fox")
+        end
+        collectgarbage()
+    end
+end)
+
+case("gc churn Series 1000", function()
+    local s = filled_series(1000):serialized()
+    return function(n)
+        for i = 1, n do
+            Series.parsefromstring(s)
+        end
+        collectgarbage()
+    end
+end)
+
+-- LuaJIT FFI bindings, when they were produced
+
+local ok, F = pcall(require, "flat_pb_ffi")
+if ok then
+    case("ffi get f_int32", function()
+        local m = F.Flat.wrap(filled_flat())
+        return function(n)
+            for i = 1, n do
+                m:get_f_int32()
+            end
+        end
+    end)
+
+    case("ffi set f_int32", function()
+        local m = F.Flat.wrap(Flat.new())
+        return function(n)
+            for i = 1, n do
+                m:set_f_int32(i)
+            end
+        end
+    end)
+
+    case("ffi get f_double", function()
+        local m = F.Flat.wrap(filled_flat())
+        return function(n)
+            for i = 1, n do
+                m:get_f_double()
+            end
+        end
+    end)
+end
+
+-- runner
+
+local function measure(run, n)
+    collectgarbage()
+    local cxx, lua = bench.allocations()
+    local start = bench.clock()
+    run(n)
+    local elapsed = bench.clock() - start
+    local cxx_after, lua_after = bench.allocations()
+    return elapsed, cxx_after - cxx, lua and lua_after - lua
+end
+
+local function per_op(count, n)
+    if not count then
+        return "-"
+    end
+    return string.format("%.2f", count / n)
+end
+
+table.sort(cases, function(a, b) return a.name < b.name end)
+
+print(string.format("# %s, %s", jit and jit.version or _VERSION, bench.options()))
+print(string.format("%-40s %14s %12s %12s", "case", "ops/sec", "C++ allocs", "Lua allocs"))
+
+for _, c in ipairs(cases) do
+    if not pattern or c.name:find(pattern, 1, true) then
+        local run = c.setup()
+
+        -- grow the number of operations until a run takes long enough to be
+        -- measured, then scale it to the requested duration
+        local n = 100
+        local elapsed = measure(run, n)
+        while elapsed < 0.05 do
+            n = n * 4
+            elapsed = measure(run, n)
+        end
+        n = math.max(100, math.floor(n * duration / elapsed))
+
+        local cxx, lua
+        elapsed, cxx, lua = measure(run, n)
+        print(string.format("%-40s %14.0f %12s %12s", c.name, n / elapsed, per_op(cxx, n), per_op(lua, n)))
+    end
+end
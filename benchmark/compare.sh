@@ -0,0 +1,69 @@
+#!/bin/sh
+# runs the benchmarks for several sets of options and prints the operations
+# per second of each case side by side
+#
+#   ./compare.sh [mode ...]
+#
+# modes are default, inline, flat_enums, stats, measure_memory and ffi, which
+# needs LuaJIT. modes joined with +, such as ffi+stats, are combined.
+# all but ffi are compared by default. BENCH_TIME and the variables of the
+# Makefile, such as LUA_PKG, are passed through. CASES selects cases
+
+set -e
+cd "$(dirname "$0")"
+
+if [ $# -eq 0 ]; then
+    set -- default inline flat_enums stats
+fi
+
+for mode in "$@"; do
+    defines=""
+    ffi=""
+    for option in $(echo "$mode" | tr + ' '); do
+        case "$option" in
+            default) ;;
+            inline) defines="$defines -DLUA_PROTOBUF_INLINE_MESSAGES" ;;
+            flat_enums) defines="$defines -DLUA_PROTOBUF_FLAT_ENUMS" ;;
+            stats) defines="$defines -DLUA_PROTOBUF_STATS" ;;
+            measure_memory) defines="$defines -DLUA_PROTOBUF_MEASURE_MEMORY" ;;
+            ffi) ffi="FFI=1" ;;
+            *) echo "unknown mode: $option" >&2; exit 2 ;;
+        esac
+    done
+
+    make -s BUILD="build/$mode" DEFINES="$defines" $ffi build/"$mode"/host >&2
+    echo "running $mode" >&2
+    LUA_PATH="build/$mode/?.lua;;" build/"$mode"/host bench.lua $CASES > build/"$mode"/results.txt
+done
+
+# the first column of every result file holds the case names, which are
+# padded to 40 characters. join the operations per second on them
+awk -v modes="$*" '
+    BEGIN { n = split(modes, mode, " ") }
+    FNR <= 2 { next }
+    {
+        name = substr($0, 1, 40)
+        sub(/ +$/, "", name)
+        split(substr($0, 41), fields, " ")
+        if (!(name in seen)) {
+            seen[name] = 1
+            order[++count] = name
+        }
+        ops[name, FILENAME] = fields[1]
+    }
+    END {
+        printf "%-40s", "case"
+        for (i = 1; i <= n; i++) {
+            printf " %14s", mode[i]
+        }
+        printf "\n"
+        for (c = 1; c <= count; c++) {
+            printf "%-40s", order[c]
+            for (i = 1; i <= n; i++) {
+                v = ops[order[c], "build/" mode[i] "/results.txt"]
+                printf " %14s", v == "" ? "-" : v
+            }
+            printf "\n"
+        }
+    }
+' $(for mode in "$@"; do echo build/"$mode"/results.txt; done)
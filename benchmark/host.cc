@@ -0,0 +1,184 @@
+//  Copyright 2010 Gregory Szorc
+//
+//  Licensed under the Apache License, Version 2.0 (the "License");
+//  you may not use this file except in compliance with the License.
+//  You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+//  Unless required by applicable law or agreed to in writing, software
+//  distributed under the License is distributed on an "AS IS" BASIS,
+//  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//  See the License for the specific language governing permissions and
+//  limitations under the License.
+
+// Lua host for the benchmarks
+//
+// opens the packages of the fixture schemas and runs the script given on the
+// command line. the script finds a bench module with a clock and counters of
+// the allocations made by C++ and by Lua
+
+#include <atomic>
+#include <cstdio>
+#include <cstdlib>
+#include <new>
+#include <string>
+#include <time.h>
+
+#include "flat.pb-lua.h"
+#include "nested.pb-lua.h"
+#include "lists.pb-lua.h"
+#include "blobs.pb-lua.h"
+
+extern "C" {
+#include <lauxlib.h>
+#include <lualib.h>
+}
+
+static std::atomic<unsigned long long> cxx_allocations(0);
+static unsigned long long lua_allocations = 0;
+static bool lua_counted = false;
+
+void * operator new(size_t size)
+{
+    cxx_allocations.fetch_add(1, std::memory_order_relaxed);
+    void *p = malloc(size ? size : 1);
+    if (!p) {
+        throw std::bad_alloc();
+    }
+    return p;
+}
+
+void operator delete(void *p) noexcept
+{
+    free(p);
+}
+
+void operator delete(void *p, size_t) noexcept
+{
+    free(p);
+}
+
+static void * counting_alloc(void *, void *ptr, size_t, size_t nsize)
+{
+    if (nsize == 0) {
+        free(ptr);
+        return NULL;
+    }
+    if (!ptr) {
+        lua_allocations++;
+    }
+    return realloc(ptr, nsize);
+}
+
+// returns a monotonic time in seconds
+static int bench_clock(lua_State *L)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    lua_pushnumber(L, (lua_Number)ts.tv_sec + (lua_Number)ts.tv_nsec / 1e9);
+    return 1;
+}
+
+// returns the number of allocations made by C++ and by Lua so far
+// the latter is nil if the Lua allocator could not be replaced
+static int bench_allocations(lua_State *L)
+{
+    lua_pushnumber(L, (lua_Number)cxx_allocations.load(std::memory_order_relaxed));
+    if (lua_counted) {
+        lua_pushnumber(L, (lua_Number)lua_allocations);
+    }
+    else {
+        lua_pushnil(L);
+    }
+    return 2;
+}
+
+// returns the lua-protobuf options the host was compiled with
+static int bench_options(lua_State *L)
+{
+    std::string options;
+#ifdef LUA_PROTOBUF_FFI
+    options += " ffi";
+#endif
+#ifdef LUA_PROTOBUF_INLINE_MESSAGES
+    options += " inline";
+#endif
+#ifdef LUA_PROTOBUF_FLAT_ENUMS
+    options += " flat_enums";
+#endif
+#ifdef LUA_PROTOBUF_STATS
+    options += " stats";
+#endif
+#ifdef LUA_PROTOBUF_MEASURE_MEMORY
+    options += " measure_memory";
+#endif
+#ifdef LUA_PROTOBUF_ASYNC
+    options += " async";
+#endif
+#ifdef LUA_PROTOBUF_GZIP
+    options += " gzip";
+#endif
+#ifdef LUA_PROTOBUF_DEBUG
+    options += " debug";
+#endif
+    if (options.empty()) {
+        lua_pushliteral(L, "default");
+    }
+    else {
+        lua_pushlstring(L, options.c_str() + 1, options.size() - 1);
+    }
+    return 1;
+}
+
+int main(int argc, char **argv)
+{
+    if (argc < 2) {
+        fprintf(stderr, "usage: %s script.lua [arguments]\n", argv[0]);
+        return 2;
+    }
+
+    // LuaJIT does not allow custom allocators on all platforms
+    lua_State *L = lua_newstate(counting_alloc, NULL);
+    lua_counted = L != NULL;
+    if (!L) {
+        L = luaL_newstate();
+    }
+    luaL_openlibs(L);
+
+    lua_protobuf_bench_flat_open(L);
+    lua_protobuf_bench_nested_open(L);
+    lua_protobuf_bench_lists_open(L);
+    lua_protobuf_bench_blobs_open(L);
+    lua_settop(L, 0);
+
+    static const struct luaL_Reg functions [] = {
+        {"clock", bench_clock},
+        {"allocations", bench_allocations},
+        {"options", bench_options},
+        {NULL, NULL},
+    };
+    luaL_register(L, "bench", functions);
+    lua_pop(L, 1);
+
+    lua_createtable(L, argc - 2, 1);
+    for (int i = 1; i < argc; i++) {
+        lua_pushstring(L, argv[i]);
+        lua_rawseti(L, -2, i - 1);
+    }
+    lua_setglobal(L, "arg");
+
+    int status = luaL_loadfile(L, argv[1]);
+    if (!status) {
+        for (int i = 2; i < argc; i++) {
+            lua_pushstring(L, argv[i]);
+        }
+        status = lua_pcall(L, argc - 2, 0, 0);
+    }
+    if (status) {
+        fprintf(stderr, "%s\n", lua_tostring(L, -1));
+    }
+
+    lua_close(L);
+    return status ? 1 : 0;
+}
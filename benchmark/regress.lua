@@ -0,0 +1,426 @@
+-- regression checks for the generated bindings
+--
+-- run through the benchmark host, which opens the fixture packages:
+--
+--   host regress.lua
+--
+-- each check that fails is printed, and the script raises an error at the
+-- end if any did
+
+local Node = protobuf.bench.nested.Node
+
+local checks = {}
+
+local function check(name, f)
+    checks[#checks + 1] = { name = name, f = f }
+end
+
+-- a node with a value, a child and two children, all with distinct values
+local function tree()
+    local n = Node.new()
+    n:set_value(1)
+    n:get_child():set_value(2)
+    n:get_child():get_child():set_value(3)
+    n:add_children():set_value(4)
+    n:add_children():set_value(5)
+    return n
+end
+
+local function fails(pattern, f, ...)
+    local ok, err = pcall(f, ...)
+    assert(not ok, "call did not fail")
+    assert(tostring(err):find(pattern, 1, true), err)
+end
+
+-- messages that contain each other
+
+check("copy_from a message inside of it", function()
+    local a = tree()
+    a:copy_from(a:get_child())
+    assert(a:get_value() == 2 and a:get_child():get_value() == 3)
+    assert(not a:get_child():has_child() and a:size_children() == 0)
+end)
+
+check("copy_from a message containing it", function()
+    local a = tree()
+    local c = a:get_child()
+    c:copy_from(a)
+    assert(c:get_value() == 1 and c:get_child():get_value() == 2)
+    assert(c:get_child():get_child():get_value() == 3 and c:size_children() == 2)
+end)
+
+check("merge_from a message inside of it", function()
+    local a = tree()
+    a:merge_from(a:get_child())
+    assert(a:get_value() == 2 and a:get_child():get_value() == 3 and a:size_children() == 2)
+end)
+
+check("merge_from a message containing it", function()
+    local a = tree()
+    a:get_child():merge_from(a)
+    assert(a:get_child():get_value() == 1 and a:get_child():size_children() == 2)
+end)
+
+check("set a field to a message inside of it", function()
+    local b = tree()
+    b:set_child(b:get_child():get_child())
+    assert(b:get_child():get_value() == 3 and not b:get_child():has_child())
+end)
+
+check("set a field to the message containing it", function()
+    local b = tree()
+    b:set_child(b)
+    assert(b:get_child():get_value() == 1 and b:get_child():get_child():get_value() == 2)
+    assert(b:get_child():size_children() == 2)
+end)
+
+check("set a repeated field to the message containing it", function()
+    local b = tree()
+    b:set_children(3, b)
+    assert(b:size_children() == 3 and b:get_children(3):size_children() == 2)
+    b:set_children(1, b:get_children(3):get_child())
+    assert(b:get_children(1):get_value() == 2)
+end)
+
+check("swap a field with the message containing it", function()
+    local n = tree()
+    fails("contains it", n.swap_child, n, n)
+    fails("contains it", n.swap_children, n, 1, n)
+    fails("contains it", n:get_child().swap_child, n:get_child(), n)
+    assert(n:get_child():get_value() == 2)
+end)
+
+check("swap a field with a message inside of it", function()
+    local n = tree()
+    fails("inside of it", n.swap_child, n, n:get_child():get_child())
+    assert(n:get_child():get_child():get_value() == 3)
+end)
+
+check("swap a message with a message it contains", function()
+    local n = tree()
+    fails("it contains", n.swap, n, n:get_child())
+    fails("it contains", n.swap, n:get_child():get_child(), n)
+    n:get_children(1):swap(n:get_children(2))
+    assert(n:get_children(1):get_value() == 5 and n:get_children(2):get_value() == 4)
+end)
+
+check("references stay with their message when it is swapped", function()
+    local a, b = tree(), tree()
+    local c = a:get_child()
+    local e = a:get_children(1)
+    c:set_name(string.rep("a", 100))
+    b:get_child():set_name(string.rep("b", 100))
+    b:get_children(1):set_value(40)
+    a:swap(b)
+    assert(b:get_child():get_name() == string.rep("a", 100))
+
+    local f = a:get_child():get_child()
+    a:swap_child(b:get_child())
+    b = nil
+    collectgarbage()
+    collectgarbage()
+    for i = 1, 100 do
+        tree():get_child():set_name(string.rep("z", 100))
+    end
+    assert(c:get_name() == string.rep("a", 100) and e:get_value() == 40)
+    assert(f:get_value() == 3 and a:get_child():get_name() == c:get_name())
+end)
+
+check("merge_masked a message inside of it", function()
+    local a = tree()
+    a:merge_masked(a:get_child(), Node.mask({ "value", "child" }))
+    assert(a:get_value() == 2 and a:get_child():get_value() == 3)
+end)
+
+-- reusing messages when parsing
+
+check("parse_many does not parse into references or frozen messages", function()
+    local n = tree()
+    local f = tree():freeze()
+    local child = n:get_child()
+    local s = Node.new():serialized()
+    local out = { child, f }
+    Node.parse_many({ s, s }, out)
+    assert(out[1] ~= child and out[2] ~= f)
+    assert(n:get_child():get_value() == 2 and f:get_value() == 1)
+
+    local owned = Node.new()
+    out = { owned }
+    Node.parse_many({ s }, out)
+    assert(out[1] == owned)
+end)
+
+check("iter_delimited does not parse into a frozen message", function()
+    local s = tree():write_delimited() .. tree():write_delimited()
+    local frozen
+    for m in Node.iter_delimited(s, true) do
+        assert(m:get_value() == 1)
+        if frozen then
+            assert(m ~= frozen and frozen:get_child():get_value() == 2)
+        else
+            frozen = m:freeze()
+        end
+    end
+end)
+
+-- peeking
+
+check("peek grows the stack for many paths", function()
+    local n = Node.new()
+    n:set_value(7)
+    local s = n:serialized()
+    local paths = {}
+    for i = 1, 1000 do
+        paths[i] = "value"
+    end
+    local values = { Node.peek(s, paths) }
+    assert(#values == 1000 and values[1000] == 7)
+    for i = 1, 100000 do
+        paths[i] = "value"
+    end
+    fails("too many paths", Node.peek, s, paths)
+end)
+
+-- field paths
+
+check("getpath returns nil for indexes out of range", function()
+    local n = tree()
+    assert(n:getpath("children[2].value") == 5)
+    assert(n:getpath("children[3].value") == nil)
+    assert(n:getpath("child.children[1].value") == nil)
+end)
+
+check("setpath checks the value before creating messages", function()
+    local n = Node.new()
+    fails("number expected", n.setpath, n, "child.child.value", "x")
+    fails("string expected", n.setpath, n, "children[1].name", {})
+    fails("out of range", n.setpath, n, "child.children[2].value", 1)
+    fails("repeated", n.setpath, n, "children[1].children[1]", nil)
+    assert(not n:has_child() and n:size_children() == 0)
+
+    n:setpath("child.child.name", nil)
+    assert(not n:has_child())
+    n:setpath("children[1].child.value", 3)
+    assert(n:get_children(1):get_child():get_value() == 3)
+end)
+
+check("setpath checks the range of 32-bit integers and the type of booleans", function()
+    local Flat = protobuf.bench.flat.Flat
+    local m = Flat.new()
+    fails("out of range for int32", m.setpath, m, "f_int32", 2^31)
+    fails("out of range for int32", m.setpath, m, "f_int32", -2^31 - 1)
+    fails("out of range for uint32", m.setpath, m, "f_uint32", -1)
+    fails("out of range for uint32", m.setpath, m, "f_uint32", 2^32)
+    fails("boolean expected", m.setpath, m, "f_bool", 1)
+    assert(not m:has_f_int32() and not m:has_f_uint32() and not m:has_f_bool())
+
+    fails("out of range for int32", m.set_f_int32, m, 2^31)
+    fails("out of range for uint32", m.set_f_uint32, m, 2^32)
+    fails("boolean expected", m.set_f_bool, m, 0)
+
+    m:setpath("f_int32", -2^31)
+    m:setpath("f_uint32", 2^32 - 1)
+    m:setpath("f_bool", false)
+    assert(m:get_f_int32() == -2^31 and m:get_f_uint32() == 2^32 - 1)
+    assert(m:has_f_bool() and m:get_f_bool() == false)
+end)
+
+-- string views
+
+local function invalidated(v)
+    fails("view invalidated", v.len, v)
+    fails("view invalidated", v.sub, v, 1)
+    fails("view invalidated", tostring, v)
+end
+
+check("views are invalidated by changes to their message", function()
+    local n = tree()
+    n:set_name(string.rep("x", 100))
+    local v = n:get_name_view()
+    assert(#v == 100 and v:sub(1, 3) == "xxx")
+    n:set_name("y")
+    invalidated(v)
+
+    for _, change in ipairs({
+        function(m) m:clear() end,
+        function(m) m:clear_name() end,
+        function(m) m:set_value(5) end,
+        function(m) m:copy_from(Node.new()) end,
+        function(m) m:swap(Node.new()) end,
+        function(m) m:setpath("name", "z") end,
+    }) do
+        n:set_name(string.rep("x", 100))
+        v = n:get_name_view()
+        change(n)
+        invalidated(v)
+    end
+end)
+
+check("views are invalidated by changes through other references", function()
+    local n = tree()
+    n:get_child():set_name(string.rep("x", 100))
+    local v = n:get_child():get_name_view()
+    n:clear()
+    invalidated(v)
+
+    n:get_child():set_name(string.rep("x", 100))
+    v = n:get_child():get_name_view()
+    n:get_child():get_child():set_value(9)
+    invalidated(v)
+end)
+
+check("views are invalidated by parsing into their message again", function()
+    local m = Node.new()
+    m:set_name(string.rep("x", 100))
+    local s = m:serialized()
+    local out = Node.parse_many({ s })
+    local v = out[1]:get_name_view()
+    Node.parse_many({ s }, out)
+    invalidated(v)
+    v = out[1]:get_name_view()
+    assert(v:sub(1, 2) == "xx")
+end)
+
+-- frozen messages
+
+check("references obtained before freezing are read-only", function()
+    local n = tree()
+    local pre = n:get_child()
+    local deep = pre:get_child()
+    n:freeze()
+    assert(pre:frozen() and deep:frozen())
+    fails("frozen", pre.set_value, pre, 99)
+    fails("frozen", deep.clear, deep)
+    fails("frozen", n.add_children, n)
+    assert(n:get_child():get_value() == 2)
+end)
+
+check("swap a field with a reference into a frozen message", function()
+    local n = tree()
+    local bc = n:get_child()
+    n:freeze()
+    local other = Node.new()
+    fails("frozen", other.swap_child, other, bc)
+    fails("frozen", other.swap, other, bc)
+    other:set_child(n)
+    assert(n:get_child():get_value() == 2 and other:get_child():get_value() == 1)
+end)
+
+-- memory accounting
+
+check("messages larger than the heap do not run a whole collection each", function()
+    -- a heap that takes the collector some work, and a message that is
+    -- larger, parsed from a file so the heap does not hold it
+    local heap = {}
+    for i = 1, 200000 do
+        heap[i] = { i }
+    end
+    local path = os.tmpname()
+    local f = assert(io.open(path, "wb"))
+    local m = Node.new()
+    m:set_name(string.rep("x", 64 * 1024 * 1024))
+    f:write(m:serialized())
+    f:close()
+    m = nil
+
+    local survived = 0
+    for i = 1, 10 do
+        collectgarbage()
+        local sentinel = setmetatable({}, { __mode = "k" })
+        sentinel[{}] = true
+        Node.parse_file(path)
+        if next(sentinel) then
+            survived = survived + 1
+        end
+    end
+    os.remove(path)
+    assert(survived > 0, "every message ran a collection")
+end)
+
+-- background serialization, when it was compiled in
+
+if Node.parse_async then
+    check("messages being serialized in the background are not modified", function()
+        local n = tree()
+        n:set_name(string.rep("x", 1000000))
+        local s = n:serialized()
+        for i = 1, 10 do
+            local h = n:serialize_async()
+            n:set_name("y")
+            assert(h:result() == s)
+            n:set_name(string.rep("x", 1000000))
+
+            h = n:serialize_async()
+            n:get_children(2):set_value(6)
+            assert(h:result() == s)
+            n:get_children(2):set_value(5)
+        end
+    end)
+
+    check("handles and messages being serialized can be collected", function()
+        local s = tree():serialized()
+        for i = 1, 20 do
+            Node.parse_async(s)
+            tree():serialize_async()
+        end
+        collectgarbage()
+        collectgarbage()
+        local n = tree()
+        local h = n:serialize_async()
+        n = nil
+        collectgarbage()
+        assert(h:result() == s)
+    end)
+end
+
+local ok, F = pcall(require, "nested_pb_ffi")
+if ok then
+    check("messages wrapped by the FFI bindings cannot be frozen", function()
+        local n = tree()
+        local w = F.Node.wrap(n:get_child())
+        fails("FFI", n.freeze, n)
+        w:set_value(7)
+        assert(n:get_child():get_value() == 7)
+
+        local f = tree()
+        local pre = f:get_child()
+        f:freeze()
+        fails("frozen", F.Node.wrap, pre)
+    end)
+
+    check("views of messages wrapped by the FFI bindings", function()
+        local n = tree()
+        n:set_name(string.rep("x", 100))
+        local v = n:get_name_view()
+        local w = F.Node.wrap(n)
+        invalidated(v)
+        fails("FFI", n.get_name_view, n)
+        w:set_name("y")
+    end)
+
+    check("embedded messages obtained through the FFI bindings keep their parent alive", function()
+        local c = F.Node.new():get_child():get_child()
+        local e = F.Node.new():add_children()
+        collectgarbage()
+        collectgarbage()
+        c:set_name(string.rep("c", 100))
+        e:set_name(string.rep("e", 100))
+        assert(c:get_name() == string.rep("c", 100) and e:get_name() == string.rep("e", 100))
+    end)
+end
+
+-- runner
+
+local failed = 0
+for _, c in ipairs(checks) do
+    local ok, err = pcall(c.f)
+    if not ok then
+        failed = failed + 1
+        print(string.format("FAIL %s: %s", c.name, tostring(err)))
+    end
+end
+
+print(string.format("%d checks, %d failed", #checks, failed))
+if failed > 0 then
+    error("regression checks failed")
+end
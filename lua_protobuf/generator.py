@@ -46,6 +46,29 @@ FIELD_TYPE_MAP = {
     FieldDescriptor.TYPE_SINT64: 'sint64',
 }
 
+# C types used by the flat FFI accessors for scalar fields
+FFI_SCALAR_TYPE_MAP = {
+    FieldDescriptor.TYPE_DOUBLE: 'double',
+    FieldDescriptor.TYPE_FLOAT: 'float',
+    FieldDescriptor.TYPE_INT64: 'int64_t',
+    FieldDescriptor.TYPE_UINT64: 'uint64_t',
+    FieldDescriptor.TYPE_INT32: 'int32_t',
+    FieldDescriptor.TYPE_FIXED64: 'uint64_t',
+    FieldDescriptor.TYPE_FIXED32: 'uint32_t',
+    FieldDescriptor.TYPE_BOOL: 'int',
+    FieldDescriptor.TYPE_UINT32: 'uint32_t',
+    FieldDescriptor.TYPE_ENUM: 'int',
+    FieldDescriptor.TYPE_SFIXED32: 'int32_t',
+    FieldDescriptor.TYPE_SFIXED64: 'int64_t',
+    FieldDescriptor.TYPE_SINT32: 'int32_t',
+    FieldDescriptor.TYPE_SINT64: 'int64_t',
+}
+
+FFI_INT64_TYPES = [
+    FieldDescriptor.TYPE_INT64, FieldDescriptor.TYPE_UINT64, FieldDescriptor.TYPE_FIXED64,
+    FieldDescriptor.TYPE_SFIXED64, FieldDescriptor.TYPE_SINT64,
+]
+
 def lua_protobuf_header():
     '''Returns common header included by all produced files'''
     return '''
@@ -53,6 +76,12 @@ def lua_protobuf_header():
 #define LUA_PROTOBUF_H
 
 #include <google/protobuf/message.h>
+#include <stdint.h>
+#include <string>
+
+#ifdef LUA_PROTOBUF_STATS
+#include <atomic>
+#endif
 
 #ifdef __cplusplus
 extern "C" {
@@ -72,6 +101,26 @@ extern "C" {
 // if returns 0, Lua will not free the memory
 typedef int (*lua_protobuf_gc_callback)(::google::protobuf::Message *msg, void *userdata);
 
+// registers the protobuf module, which holds functions that are not tied to
+// a message type. called by the open functions of all packages
+LUA_PROTOBUF_EXPORT int lua_protobuf_open(lua_State *L);
+
+// describes a message type for lookups by name or id
+typedef struct lua_protobuf_type {
+    // fully qualified name, such as package.Message
+    const char *full_name;
+    // 32 bit FNV-1a hash of the full name
+    unsigned int id;
+    lua_CFunction new_message;
+    lua_CFunction parsefromstring;
+    // name of the Lua library of the type, such as protobuf.package.Message
+    const char *libname;
+} lua_protobuf_type;
+
+// makes a message type available to protobuf.new(), protobuf.parse() and
+// protobuf.lookup() in L. raises a Lua error if another type has the same id
+LUA_PROTOBUF_EXPORT void lua_protobuf_register_type(lua_State *L, const lua_protobuf_type *type);
+
 // __index and __newindex functions for enum tables
 LUA_PROTOBUF_EXPORT int lua_protobuf_enum_index(lua_State *L);
 LUA_PROTOBUF_EXPORT int lua_protobuf_enum_newindex(lua_State *L);
@@ -79,6 +128,238 @@ LUA_PROTOBUF_EXPORT int lua_protobuf_enum_newindex(lua_State *L);
 // GC callback function that always returns true
 LUA_PROTOBUF_EXPORT int lua_protobuf_gc_always_free(::google::protobuf::Message *msg, void *userdata);
 
+// obtain the value at index for a field of type int32 or uint32, or bool.
+// raise a Lua error if it is of another type or does not fit in the field
+LUA_PROTOBUF_EXPORT int32_t lua_protobuf_check_int32(lua_State *L, int index);
+LUA_PROTOBUF_EXPORT uint32_t lua_protobuf_check_uint32(lua_State *L, int index);
+LUA_PROTOBUF_EXPORT bool lua_protobuf_check_bool(lua_State *L, int index);
+
+// reads a stream of messages, each prefixed with its varint encoded length
+typedef struct lua_protobuf_delimited_reader lua_protobuf_delimited_reader;
+
+// pushes a reader over the Lua file handle or string at index onto the stack
+// the reader does not keep the file or string alive
+LUA_PROTOBUF_EXPORT lua_protobuf_delimited_reader * lua_protobuf_delimited_reader_new(lua_State *L, int index);
+
+// parses the next message in the stream into msg
+// returns 1 if a message was read, 0 at the end of the stream and -1 on error
+LUA_PROTOBUF_EXPORT int lua_protobuf_delimited_reader_next(lua_protobuf_delimited_reader *reader, ::google::protobuf::Message *msg);
+
+// pushes a reader over a memory mapped file onto the stack
+// the path is at index, followed by optional offset and length arguments
+LUA_PROTOBUF_EXPORT lua_protobuf_delimited_reader * lua_protobuf_delimited_reader_new_file(lua_State *L, int index);
+
+// parses msg from a memory mapped file
+// the path is at index, followed by optional offset and length arguments
+// string fields are copied out of the mapping, which is unmapped before
+// returning. raises a Lua error on failure
+LUA_PROTOBUF_EXPORT void lua_protobuf_parse_file(lua_State *L, int index, ::google::protobuf::Message *msg);
+
+// describes a field of a message type, as needed to walk the wire format
+// tables of fields are terminated by an entry whose name is NULL
+typedef struct lua_protobuf_field_info {
+    const char *name;
+    int number;
+    // ::google::protobuf::FieldDescriptor::Type
+    int type;
+    bool repeated;
+    // fields of the embedded message type, NULL for other types
+    const struct lua_protobuf_field_info *message_fields;
+} lua_protobuf_field_info;
+
+// pushes values of the fields named by the table of paths at paths_index
+// the values are read from the serialized message at data, without parsing
+// the whole message. fields is the field table of the message type
+// returns the number of values pushed. raises a Lua error on failure
+LUA_PROTOBUF_EXPORT int lua_protobuf_peek(lua_State *L, const lua_protobuf_field_info *fields, const char *data, size_t len, int paths_index);
+
+// a compiled path of fields, such as a.b[2].c
+typedef struct lua_protobuf_path lua_protobuf_path;
+
+// obtains the compiled path at index. a string is compiled against the field
+// table and descriptor of a message type and replaced by the compiled path,
+// which is a userdata. raises a Lua error if the path is invalid or was
+// compiled for another message type
+LUA_PROTOBUF_EXPORT const lua_protobuf_path * lua_protobuf_check_path(lua_State *L, int index, const lua_protobuf_field_info *fields, const ::google::protobuf::Descriptor *descriptor);
+
+// returns the number of the first field in a path
+LUA_PROTOBUF_EXPORT int lua_protobuf_path_number(const lua_protobuf_path *path);
+
+// pushes the value at the end of a path. embedded messages are pushed
+// serialized. pushes nil if a message or field along the path is not set,
+// or an index is out of range
+LUA_PROTOBUF_EXPORT int lua_protobuf_getpath(lua_State *L, const lua_protobuf_path *path, const ::google::protobuf::Message *msg);
+
+// sets the value at the end of a path to the value at index, creating the
+// messages along the path. nil clears a singular field. raises a Lua error,
+// without changing msg, if the value or an index is invalid
+LUA_PROTOBUF_EXPORT int lua_protobuf_setpath(lua_State *L, const lua_protobuf_path *path, ::google::protobuf::Message *msg, int index);
+
+// a compiled set of field paths, like a FieldMask
+typedef struct lua_protobuf_mask lua_protobuf_mask;
+
+// obtains the compiled mask at index. a table of paths is compiled against
+// the field table and descriptor of a message type and replaced by the
+// compiled mask, which is a userdata. raises a Lua error if a path is invalid
+// or the mask was compiled for another message type
+LUA_PROTOBUF_EXPORT const lua_protobuf_mask * lua_protobuf_check_mask(lua_State *L, int index, const lua_protobuf_field_info *fields, const ::google::protobuf::Descriptor *descriptor);
+
+// pushes the serialized form of the fields of msg in the mask
+LUA_PROTOBUF_EXPORT int lua_protobuf_serialize_masked(lua_State *L, const lua_protobuf_mask *mask, const ::google::protobuf::Message &msg);
+
+// replaces the fields of to in the mask with those of from
+// fields in the mask that are not set in from are cleared
+// returns false if the fields could not be merged
+LUA_PROTOBUF_EXPORT bool lua_protobuf_merge_masked(const lua_protobuf_mask *mask, const ::google::protobuf::Message &from, ::google::protobuf::Message *to);
+
+// pushes the JSON representation of msg
+// the optional table of options at options_index may set pretty, defaults,
+// enums_as_ints and preserve_field_names. raises a Lua error on failure
+LUA_PROTOBUF_EXPORT int lua_protobuf_tojson(lua_State *L, const ::google::protobuf::Message &msg, int options_index);
+
+// parses the JSON string at index into msg
+// the optional table of options at options_index may set ignore_unknown
+// raises a Lua error on failure
+LUA_PROTOBUF_EXPORT void lua_protobuf_fromjson(lua_State *L, int index, ::google::protobuf::Message *msg, int options_index);
+
+// pushes a view of len bytes at data, which belong to the value at
+// owner_index. the view keeps the owner alive, but the bytes are not copied.
+// generation points to a counter that the owner increments whenever the bytes
+// may change, or is NULL if they never do. once the counter differs from its
+// value when the view was pushed, using the view raises an error
+LUA_PROTOBUF_EXPORT void lua_protobuf_push_view(lua_State *L, const char *data, size_t len, int owner_index, const unsigned int *generation);
+
+// wire format of embedded message fields that have not been parsed yet
+typedef struct lua_protobuf_lazy lua_protobuf_lazy;
+
+// parses msg from data, except for the embedded message fields whose numbers
+// are listed in lazy_numbers, a 0 terminated array. the wire format of those
+// fields is stored in *lazy, which is NULL if none were present
+// returns false if the message could not be parsed
+LUA_PROTOBUF_EXPORT bool lua_protobuf_parse_lazy(::google::protobuf::Message *msg, const char *data, size_t len, const int *lazy_numbers, lua_protobuf_lazy **lazy);
+
+// parses the stored wire format of the field with the given number into msg
+// if number is 0, all stored fields are parsed. *lazy is freed and set to
+// NULL once no fields are left. returns false if a field could not be parsed
+LUA_PROTOBUF_EXPORT bool lua_protobuf_lazy_materialize(::google::protobuf::Message *msg, lua_protobuf_lazy **lazy, int number);
+
+// appends the stored wire format of all fields to a serialized message
+LUA_PROTOBUF_EXPORT void lua_protobuf_lazy_serialize(const lua_protobuf_lazy *lazy, std::string *s);
+
+LUA_PROTOBUF_EXPORT void lua_protobuf_lazy_free(lua_protobuf_lazy *lazy);
+
+// an immutable message that can be read from several Lua states at once
+// it is reference counted, and the message is deleted with the last reference
+typedef struct lua_protobuf_shared lua_protobuf_shared;
+
+// takes ownership of msg. the returned handle holds one reference
+LUA_PROTOBUF_EXPORT lua_protobuf_shared * lua_protobuf_share(::google::protobuf::Message *msg);
+
+// adds a reference. returns shared, which may be NULL
+LUA_PROTOBUF_EXPORT lua_protobuf_shared * lua_protobuf_shared_retain(lua_protobuf_shared *shared);
+
+// drops a reference. shared may be NULL
+LUA_PROTOBUF_EXPORT void lua_protobuf_shared_release(lua_protobuf_shared *shared);
+
+LUA_PROTOBUF_EXPORT const ::google::protobuf::Message * lua_protobuf_shared_message(const lua_protobuf_shared *shared);
+
+// records the memory used by a message owned by Lua, including the lazy
+// fields it holds, which may be NULL. *accounted is what was recorded for the
+// message before, 0 for a new message, and is updated. growth is reported to
+// the garbage collector of L, which only sees the userdata holding the message
+// the memory is estimated from the length of the data the message was parsed
+// from, or from its serialized size if estimate is 0. with
+// LUA_PROTOBUF_MEASURE_MEMORY defined, it is measured with SpaceUsedLong()
+// instead, which is exact but walks the whole message through reflection
+LUA_PROTOBUF_EXPORT void lua_protobuf_account(lua_State *L, size_t *accounted, const ::google::protobuf::Message *msg, const lua_protobuf_lazy *lazy, size_t estimate);
+
+// records bytes of growth of a message without measuring it again
+// does nothing for messages that are not accounted
+LUA_PROTOBUF_EXPORT void lua_protobuf_account_growth(lua_State *L, size_t *accounted, size_t bytes);
+
+// forgets the memory recorded for a message that is deleted
+LUA_PROTOBUF_EXPORT void lua_protobuf_unaccount(size_t *accounted);
+
+// a job of the worker pool enabled by LUA_PROTOBUF_ASYNC
+typedef struct lua_protobuf_async_job lua_protobuf_async_job;
+
+#ifdef LUA_PROTOBUF_ASYNC
+// pushes a message allocated with new, handing it over to Lua
+typedef void (*lua_protobuf_push_owned)(lua_State *L, ::google::protobuf::Message *msg);
+
+// queues parsing a copy of the string at index into msg on the worker pool
+// pushes a handle for the job. msg belongs to the job until the handle's
+// result() hands it to Lua through push
+LUA_PROTOBUF_EXPORT void lua_protobuf_parse_async(lua_State *L, int index, ::google::protobuf::Message *msg, lua_protobuf_push_owned push);
+
+// queues serializing msg, which is held by the userdata at index, on the
+// worker pool. pushes a handle for the job and sets *busy to the job, which
+// must be NULL before. the produced bindings keep *busy in the udata and,
+// before modifying or serializing the message, wait for the job with
+// lua_protobuf_async_busy()
+LUA_PROTOBUF_EXPORT void lua_protobuf_serialize_async(lua_State *L, int index, const ::google::protobuf::Message *msg, lua_protobuf_async_job **busy);
+
+// returns whether the job *busy is still running. if wait is set, waits for
+// it to finish first. once the job is done, *busy is set to NULL
+LUA_PROTOBUF_EXPORT bool lua_protobuf_async_busy(lua_protobuf_async_job **busy, bool wait);
+#endif
+
+#ifdef LUA_PROTOBUF_GZIP
+// pushes the serialized form of msg compressed with gzip
+// level is the zlib compression level, -1 for the default
+LUA_PROTOBUF_EXPORT int lua_protobuf_serialize_compressed(lua_State *L, const ::google::protobuf::Message &msg, int level);
+
+// parses msg from the gzip compressed string at index
+// raises a Lua error on failure
+LUA_PROTOBUF_EXPORT void lua_protobuf_parse_compressed(lua_State *L, int index, ::google::protobuf::Message *msg);
+
+// makes a reader decompress its source with gzip
+// must be called before the first message is read
+LUA_PROTOBUF_EXPORT void lua_protobuf_delimited_reader_decompress(lua_protobuf_delimited_reader *reader);
+
+// like lua_protobuf_write_delimited, but the length-delimited message is
+// compressed with gzip. each call writes one gzip member. as these may be
+// concatenated, a series of calls produces a gzip stream of messages
+LUA_PROTOBUF_EXPORT int lua_protobuf_write_delimited_compressed(lua_State *L, int index, const ::google::protobuf::Message &msg, int level);
+#endif
+
+#ifdef LUA_PROTOBUF_STATS
+typedef std::atomic<unsigned long long> lua_protobuf_counter;
+
+// describes the counters of a message type
+typedef struct lua_protobuf_stats_type {
+    const char *full_name;
+    // names of the counted functions, terminated by NULL
+    const char * const *functions;
+} lua_protobuf_stats_type;
+
+// the counters of a message type are the bytes parsed by parsefromstring(),
+// the bytes produced by serialized() and the number of calls to each function
+#define LUA_PROTOBUF_STATS_PARSED 0
+#define LUA_PROTOBUF_STATS_SERIALIZED 1
+#define LUA_PROTOBUF_STATS_FUNCTIONS 2
+
+// returns the counters of the calling thread for a message type
+// they are only written by that thread and summed up by protobuf.stats()
+LUA_PROTOBUF_EXPORT lua_protobuf_counter * lua_protobuf_stats_counters(const lua_protobuf_stats_type *type);
+
+// adds n to counter i of a message type. counters is a thread_local pointer
+// caching the counters of the calling thread, which starts out NULL
+#define LUA_PROTOBUF_COUNT(counters, type, i, n) do { \\
+    if (!(counters)) { \\
+        (counters) = lua_protobuf_stats_counters(&(type)); \\
+    } \\
+    (counters)[i].store((counters)[i].load(std::memory_order_relaxed) + (n), std::memory_order_relaxed); \\
+} while (0)
+#else
+#define LUA_PROTOBUF_COUNT(counters, type, i, n)
+#endif
+
+// writes a message prefixed with its length to the Lua file handle at index
+// if index is 0, the length-delimited message is pushed as a string instead
+// returns the number of values pushed on the stack
+LUA_PROTOBUF_EXPORT int lua_protobuf_write_delimited(lua_State *L, int index, const ::google::protobuf::Message &msg);
+
 #ifdef __cplusplus
 }
 #endif
@@ -98,13 +379,176 @@ extern "C" {
 #endif
 
 #include <lauxlib.h>
+#include <lualib.h>
 
 #ifdef __cplusplus
 }
 #endif
 
+#include <limits.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+#include <algorithm>
+#include <map>
+#include <string>
+#include <vector>
+#include <google/protobuf/io/coded_stream.h>
+#ifdef LUA_PROTOBUF_GZIP
+#include <google/protobuf/io/gzip_stream.h>
+#endif
+#include <google/protobuf/io/zero_copy_stream_impl_lite.h>
+#include <google/protobuf/util/json_util.h>
+#include <google/protobuf/wire_format.h>
+#include <google/protobuf/wire_format_lite.h>
+
+#include <atomic>
+
+#ifdef LUA_PROTOBUF_ASYNC
+#include <condition_variable>
+#include <deque>
+#include <mutex>
+#include <thread>
+#endif
+
+#ifdef LUA_PROTOBUF_STATS
+#include <map>
+#include <mutex>
+#include <vector>
+#endif
+
+#ifndef WINDOWS
+#include <errno.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#endif
+
+using ::google::protobuf::io::CodedInputStream;
+using ::google::protobuf::io::CodedOutputStream;
+using ::google::protobuf::io::CopyingInputStream;
+using ::google::protobuf::io::CopyingInputStreamAdaptor;
+using ::google::protobuf::io::CopyingOutputStream;
+using ::google::protobuf::io::CopyingOutputStreamAdaptor;
+using ::google::protobuf::io::StringOutputStream;
+using ::google::protobuf::io::ZeroCopyInputStream;
+using ::google::protobuf::internal::WireFormat;
+using ::google::protobuf::internal::WireFormatLite;
+using ::google::protobuf::Descriptor;
+using ::google::protobuf::EnumValueDescriptor;
+using ::google::protobuf::FieldDescriptor;
+using ::google::protobuf::Message;
+using ::google::protobuf::Reflection;
+
+#define DELIMITED_READER_METATABLE "lua_protobuf.delimited_reader"
+#define PATH_METATABLE "lua_protobuf.path"
+#define MASK_METATABLE "lua_protobuf.mask"
+#define VIEW_METATABLE "lua_protobuf.view"
+
+// deepest nesting of fields in a path
+#define MAX_PATH_DEPTH 32
+
+// reads from a Lua file handle
+// we hold on to the handle's storage so a closed file is noticed
+class FileInputStream : public CopyingInputStream {
+  public:
+    FileInputStream(FILE **f) : file(f) {}
+
+    int Read(void *buffer, int size) {
+        if (!*file) return -1;
+        size_t n = fread(buffer, 1, size, *file);
+        if (n == 0 && ferror(*file)) return -1;
+        return (int)n;
+    }
+
+  private:
+    FILE **file;
+};
+
+class FileOutputStream : public CopyingOutputStream {
+  public:
+    FileOutputStream(FILE *f) : file(f) {}
+
+    bool Write(const void *buffer, int size) {
+        return fwrite(buffer, 1, size, file) == (size_t)size;
+    }
+
+  private:
+    FILE *file;
+};
+
+// reads from a contiguous block of memory
+// unlike ArrayInputStream, it is not limited to 2GB
+class MemoryInputStream : public ZeroCopyInputStream {
+  public:
+    MemoryInputStream(const char *d, size_t s) : data(d), size(s), position(0) {}
+
+    bool Next(const void **buffer, int *n) {
+        if (position >= size) return false;
+
+        size_t chunk = size - position;
+        if (chunk > MEMORY_CHUNK_SIZE) chunk = MEMORY_CHUNK_SIZE;
+
+        *buffer = data + position;
+        *n = (int)chunk;
+        position += chunk;
+        return true;
+    }
+
+    void BackUp(int count) {
+        position -= count;
+    }
+
+    bool Skip(int count) {
+        if (size - position < (size_t)count) {
+            position = size;
+            return false;
+        }
+        position += count;
+        return true;
+    }
+
+    int64_t ByteCount() const {
+        return position;
+    }
+
+  private:
+    static const size_t MEMORY_CHUNK_SIZE = 1 << 30;
+
+    const char *data;
+    size_t size;
+    size_t position;
+};
+
+// a read-only mapping of a file region
+typedef struct file_mapping {
+    void *base;
+    size_t length;
+    const char *data;
+    size_t size;
+} file_mapping;
+
+struct lua_protobuf_delimited_reader {
+    ZeroCopyInputStream *stream;
+    // what stream decompresses, if the source is compressed
+    ZeroCopyInputStream *compressed;
+    CopyingInputStream *source;
+    file_mapping mapping;
+};
+
+// keyed by field number. the wire format includes the tags
+struct lua_protobuf_lazy {
+    std::map<int, std::string> fields;
+};
+
 int lua_protobuf_enum_index(lua_State *L)
 {
+    // numbers that are not values of the enumeration have no name
+    if (lua_type(L, 2) == LUA_TNUMBER) {
+        lua_pushnil(L);
+        return 1;
+    }
     return luaL_error(L, "attempting to access undefined enumeration value: %s", lua_tostring(L, 2));
 }
 
@@ -113,530 +557,3837 @@ int lua_protobuf_enum_newindex(lua_State *L)
     return luaL_error(L, "cannot modify enumeration tables");
 }
 
-int lua_protobuf_gc_always_free(::google::protobuf::Message *msg, void *ud)
+int lua_protobuf_gc_always_free(::google::protobuf::Message *, void *)
 {
     return 1;
 }
 
-'''
-
-def c_header_header(filename, package):
-    return [
-        '// Generated by the lua-protobuf compiler.',
-        '// You shouldn\'t be editing this file manually',
-        '//',
-        '// source proto file: %s' % filename,
-        '',
-        '#ifndef LUA_PROTOBUF_%s_H' % filename[:-len('.proto')],
-        '#define LUA_PROTOBUF_%s_H' % filename[:-len('.proto')],
-        '',
-        '#include "lua-protobuf.h"',
-        '#include <%s.pb.h>' % filename[:-len('.proto')],
-        '',
-        '#ifdef __cplusplus',
-        'extern "C" {',
-        '#endif',
-        '',
-        '#include <lua.h>',
-        '',
-        '// register all messages in this package to a Lua state',
-        'LUA_PROTOBUF_EXPORT int %sopen(lua_State *L);' % package_function_prefix(package),
-        '',
-    ]
+int32_t lua_protobuf_check_int32(lua_State *L, int index)
+{
+    lua_Number n = luaL_checknumber(L, index);
+    if (n < INT32_MIN || n > INT32_MAX) {
+        luaL_argerror(L, index, "value out of range for int32");
+    }
+    return (int32_t)luaL_checkinteger(L, index);
+}
 
-def source_header(filename, package):
-    '''Returns lines that begin a source file'''
-    return [
-        '// Generated by the lua-protobuf compiler',
-        '// You shouldn\'t edit this file manually',
-        '//',
-        '// source proto file: %s' % filename,
-        '',
-        '#include "%s.pb-lua.h"' % filename[:-len('.proto')],
-        '',
-        '#ifdef __cplusplus',
-        'extern "C" { // make sure functions treated with C naming',
-        '#endif',
-        '',
-        '#include <lauxlib.h>',
-        '',
-        '#ifdef __cplusplus',
-        '}',
-        '#endif',
-        '',
-        '#include <string>',
-        '',
-        '// this represents Lua udata for a protocol buffer message',
-        '// we record where a message came from so we can GC it properly',
-        'typedef struct msg_udata { // confuse over-simplified pretty-printer',
-        '    ::google::protobuf::Message * msg;',
-        '    bool lua_owns;',
-        '    lua_protobuf_gc_callback gc_callback;',
-        '    void * callback_data;',
-        '} msg_udata;',
-        '',
-    ]
+uint32_t lua_protobuf_check_uint32(lua_State *L, int index)
+{
+    lua_Number n = luaL_checknumber(L, index);
+    if (n < 0 || n > UINT32_MAX) {
+        luaL_argerror(L, index, "value out of range for uint32");
+    }
+    return (uint32_t)luaL_checkinteger(L, index);
+}
 
-def package_function_prefix(package):
-    return 'lua_protobuf_%s_' % package.replace('.', '_')
+bool lua_protobuf_check_bool(lua_State *L, int index)
+{
+    luaL_checktype(L, index, LUA_TBOOLEAN);
+    return lua_toboolean(L, index);
+}
 
-def message_function_prefix(package, message):
-    return '%s%s_' % (package_function_prefix(package), message)
+// maps the file whose path is at index
+// optional offset and length arguments follow the path
+// raises a Lua error on failure
+static void map_file(lua_State *L, int index, file_mapping *mapping)
+{
+    const char *path = luaL_checkstring(L, index);
+    lua_Integer offset = luaL_optinteger(L, index + 1, 0);
+    lua_Integer length = luaL_optinteger(L, index + 2, -1);
 
-def message_open_function_name(package, message):
-    '''Returns function name that registers the Lua library for a message type'''
+    mapping->base = NULL;
+    mapping->length = 0;
+    mapping->data = NULL;
+    mapping->size = 0;
 
-    return '%sopen' % message_function_prefix(package, message)
+    if (offset < 0) {
+        luaL_argerror(L, index + 1, "offset must not be negative");
+    }
 
-def cpp_class(package, message = None):
-    '''Returns the fully qualified class name for a message type'''
+#ifdef WINDOWS
+    luaL_error(L, "memory mapped files are not supported on this platform");
+#else
+    int fd = open(path, O_RDONLY);
+    if (fd < 0) {
+        luaL_error(L, "could not open %s: %s", path, strerror(errno));
+    }
+
+    struct stat st;
+    if (fstat(fd, &st) != 0) {
+        int error = errno;
+        close(fd);
+        luaL_error(L, "could not stat %s: %s", path, strerror(error));
+    }
+
+    if ((off_t)offset > st.st_size) {
+        close(fd);
+        luaL_error(L, "offset is past the end of %s", path);
+    }
+    if (length < 0) {
+        length = st.st_size - offset;
+    }
+    if ((off_t)(offset + length) > st.st_size) {
+        close(fd);
+        luaL_error(L, "length is past the end of %s", path);
+    }
+
+    // nothing to map. this is also not allowed by mmap()
+    if (length == 0) {
+        close(fd);
+        return;
+    }
+
+    // mappings must start on a page boundary
+    size_t page = sysconf(_SC_PAGESIZE);
+    off_t start = offset - offset % page;
+    size_t skip = offset - start;
+
+    void *base = mmap(NULL, length + skip, PROT_READ, MAP_PRIVATE, fd, start);
+    int error = errno;
+    close(fd);
+    if (base == MAP_FAILED) {
+        luaL_error(L, "could not map %s: %s", path, strerror(error));
+    }
+
+    madvise(base, length + skip, MADV_SEQUENTIAL);
+
+    mapping->base = base;
+    mapping->length = length + skip;
+    mapping->data = (const char *)base + skip;
+    mapping->size = length;
+#endif
+}
 
-    if not message:
-        return package.replace('.', '::')
+static void unmap_file(file_mapping *mapping)
+{
+#ifndef WINDOWS
+    if (mapping->base) {
+        munmap(mapping->base, mapping->length);
+    }
+#endif
+    mapping->base = NULL;
+    mapping->data = NULL;
+}
 
-    return '::%s::%s' % ( package.replace('.', '::'), message )
+static int delimited_reader_gc(lua_State *L)
+{
+    lua_protobuf_delimited_reader *reader = (lua_protobuf_delimited_reader *)luaL_checkudata(L, 1, DELIMITED_READER_METATABLE);
+    delete reader->stream;
+    delete reader->compressed;
+    delete reader->source;
+    reader->stream = NULL;
+    reader->compressed = NULL;
+    reader->source = NULL;
+    unmap_file(&reader->mapping);
+    return 0;
+}
 
-def field_function_name(package, message, prefix, field):
-    '''Obtain the function name of a field accessor/mutator function'''
+static lua_protobuf_delimited_reader * push_delimited_reader(lua_State *L)
+{
+    lua_protobuf_delimited_reader *reader = (lua_protobuf_delimited_reader *)lua_newuserdata(L, sizeof(lua_protobuf_delimited_reader));
+    reader->stream = NULL;
+    reader->compressed = NULL;
+    reader->source = NULL;
+    reader->mapping.base = NULL;
+    reader->mapping.data = NULL;
+    if (luaL_newmetatable(L, DELIMITED_READER_METATABLE)) {
+        lua_pushcfunction(L, delimited_reader_gc);
+        lua_setfield(L, -2, "__gc");
+    }
+    lua_setmetatable(L, -2);
+
+    return reader;
+}
 
-    return '%s%s_%s' % ( message_function_prefix(package, message), prefix, field )
+lua_protobuf_delimited_reader * lua_protobuf_delimited_reader_new(lua_State *L, int index)
+{
+    FILE **f = NULL;
+    size_t len = 0;
+    const char *s = NULL;
+
+    if (lua_type(L, index) == LUA_TSTRING) {
+        s = lua_tolstring(L, index, &len);
+    }
+    else {
+        f = (FILE **)luaL_checkudata(L, index, LUA_FILEHANDLE);
+        if (!*f) {
+            luaL_error(L, "attempt to use a closed file");
+        }
+    }
+
+    lua_protobuf_delimited_reader *reader = push_delimited_reader(L);
+
+    if (s) {
+        reader->stream = new MemoryInputStream(s, len);
+    }
+    else {
+        reader->source = new FileInputStream(f);
+        reader->stream = new CopyingInputStreamAdaptor(reader->source);
+    }
+
+    return reader;
+}
 
-def field_function_start(package, message, prefix, field):
-    '''Obtain the start of function for a field accessor function'''
-    return [
-        'int %s(lua_State *L)' % field_function_name(package, message, prefix, field),
-        '{',
-    ]
+lua_protobuf_delimited_reader * lua_protobuf_delimited_reader_new_file(lua_State *L, int index)
+{
+    // the reader is created first, so it owns the mapping if anything fails
+    lua_protobuf_delimited_reader *reader = push_delimited_reader(L);
+    map_file(L, index, &reader->mapping);
+    reader->stream = new MemoryInputStream(reader->mapping.data, reader->mapping.size);
 
-def lua_libname(package, message):
-    '''Returns the Lua library name for a specific message'''
+    return reader;
+}
 
-    return 'protobuf.%s.%s' % (package, message)
+void lua_protobuf_parse_file(lua_State *L, int index, ::google::protobuf::Message *msg)
+{
+    file_mapping mapping;
+    map_file(L, index, &mapping);
+
+    bool ok;
+    {
+        MemoryInputStream stream(mapping.data, mapping.size);
+        ok = msg->ParseFromZeroCopyStream(&stream);
+    }
+    unmap_file(&mapping);
+
+    if (!ok) {
+        luaL_error(L, "error deserializing message");
+    }
+}
 
-def metatable(package, message):
-    '''Returns Lua metatable for protocol buffer message type'''
-    return 'protobuf_.%s.%s' % (package, message)
+int lua_protobuf_delimited_reader_next(lua_protobuf_delimited_reader *reader, ::google::protobuf::Message *msg)
+{
+    // a coded stream is created for each message, so the stream's byte
+    // limits apply per message. destroying it hands unread bytes back
+    CodedInputStream input(reader->stream);
+
+    int start = input.CurrentPosition();
+    uint32_t size;
+    if (!input.ReadVarint32(&size)) {
+        return input.CurrentPosition() == start ? 0 : -1;
+    }
+
+    CodedInputStream::Limit limit = input.PushLimit(size);
+    if (!msg->ParseFromCodedStream(&input) || !input.ConsumedEntireMessage()) {
+        return -1;
+    }
+    input.PopLimit(limit);
 
-def obtain_message_from_udata(package, message=None, index=1, varname='m'):
-    '''Statement that obtains a message from userdata'''
+    return 1;
+}
 
-    c = cpp_class(package, message)
-    return [
-        'msg_udata * %sud = (msg_udata *)%s;' % ( varname, check_udata(package, message, index) ),
-        '%s *%s = (%s *)%sud->msg;' % ( c, varname, c, varname ),
-    ]
+// a path of fields resolved against field tables
+typedef struct field_path {
+    const lua_protobuf_field_info *fields[MAX_PATH_DEPTH];
+    int depth;
+    // if any field in the path is repeated, all values are collected in a table
+    bool collect;
+} field_path;
+
+// resolves a dotted path of field names
+// raises a Lua error if the path does not name a field
+static void resolve_field_path(lua_State *L, const lua_protobuf_field_info *fields, const char *path, field_path *resolved)
+{
+    const char *start = path;
+
+    resolved->depth = 0;
+    resolved->collect = false;
+
+    while (true) {
+        const char *end = strchr(start, '.');
+        size_t len = end ? (size_t)(end - start) : strlen(start);
+
+        if (!fields) {
+            luaL_error(L, "field %s in path %s is not a message", resolved->fields[resolved->depth - 1]->name, path);
+        }
+        if (resolved->depth == MAX_PATH_DEPTH) {
+            luaL_error(L, "path is nested too deeply: %s", path);
+        }
+
+        const lua_protobuf_field_info *field = fields;
+        while (field->name && (strncmp(field->name, start, len) != 0 || field->name[len] != '\\0')) {
+            field++;
+        }
+        if (!field->name) {
+            lua_pushlstring(L, start, len);
+            luaL_error(L, "unknown field %s in path %s", lua_tostring(L, -1), path);
+        }
+
+        resolved->fields[resolved->depth++] = field;
+        resolved->collect = resolved->collect || field->repeated;
+        fields = field->message_fields;
+
+        if (!end) break;
+        start = end + 1;
+    }
+}
 
-def check_udata(package, message, index=1):
-    '''Validates a udata is instance of protocol buffer message
+// returns the wire type a field type is encoded with
+static int wire_type(int type)
+{
+    switch (type) {
+        case FieldDescriptor::TYPE_FIXED32:
+        case FieldDescriptor::TYPE_SFIXED32:
+        case FieldDescriptor::TYPE_FLOAT:
+            return WireFormatLite::WIRETYPE_FIXED32;
+
+        case FieldDescriptor::TYPE_FIXED64:
+        case FieldDescriptor::TYPE_SFIXED64:
+        case FieldDescriptor::TYPE_DOUBLE:
+            return WireFormatLite::WIRETYPE_FIXED64;
+
+        case FieldDescriptor::TYPE_STRING:
+        case FieldDescriptor::TYPE_BYTES:
+        case FieldDescriptor::TYPE_MESSAGE:
+            return WireFormatLite::WIRETYPE_LENGTH_DELIMITED;
+
+        case FieldDescriptor::TYPE_GROUP:
+            return WireFormatLite::WIRETYPE_START_GROUP;
+
+        default:
+            return WireFormatLite::WIRETYPE_VARINT;
+    }
+}
 
-    By default, it validates udata at top of the stack
-    '''
+// reads a single scalar value and pushes it on the stack
+static bool push_scalar(lua_State *L, CodedInputStream *input, int type)
+{
+    uint32_t v32;
+    uint64_t v64;
+
+    switch (wire_type(type)) {
+        case WireFormatLite::WIRETYPE_FIXED32:
+            if (!input->ReadLittleEndian32(&v32)) return false;
+            break;
+
+        case WireFormatLite::WIRETYPE_FIXED64:
+            if (!input->ReadLittleEndian64(&v64)) return false;
+            break;
+
+        default:
+            if (!input->ReadVarint64(&v64)) return false;
+            v32 = (uint32_t)v64;
+    }
+
+    switch (type) {
+        case FieldDescriptor::TYPE_INT32:
+        case FieldDescriptor::TYPE_ENUM:
+        case FieldDescriptor::TYPE_SFIXED32:
+            lua_pushinteger(L, (int32_t)v32);
+            break;
+
+        case FieldDescriptor::TYPE_UINT32:
+        case FieldDescriptor::TYPE_FIXED32:
+            lua_pushinteger(L, v32);
+            break;
+
+        case FieldDescriptor::TYPE_SINT32:
+            lua_pushinteger(L, WireFormatLite::ZigZagDecode32(v32));
+            break;
+
+        case FieldDescriptor::TYPE_INT64:
+        case FieldDescriptor::TYPE_SFIXED64:
+            lua_pushinteger(L, (int64_t)v64);
+            break;
+
+        case FieldDescriptor::TYPE_UINT64:
+        case FieldDescriptor::TYPE_FIXED64:
+            lua_pushinteger(L, v64);
+            break;
+
+        case FieldDescriptor::TYPE_SINT64:
+            lua_pushinteger(L, WireFormatLite::ZigZagDecode64(v64));
+            break;
+
+        case FieldDescriptor::TYPE_BOOL:
+            lua_pushboolean(L, v64 != 0);
+            break;
+
+        case FieldDescriptor::TYPE_FLOAT:
+            lua_pushnumber(L, WireFormatLite::DecodeFloat(v32));
+            break;
+
+        case FieldDescriptor::TYPE_DOUBLE:
+            lua_pushnumber(L, WireFormatLite::DecodeDouble(v64));
+            break;
+
+        default:
+            return false;
+    }
+
+    return true;
+}
 
-    return 'luaL_checkudata(L, %d, "%s")' % ( index, metatable(package, message) )
+// stores the value on top of the stack as the result for a path
+static void store_peeked(lua_State *L, const field_path *path, int slot)
+{
+    if (path->collect) {
+        lua_rawseti(L, slot, lua_objlen(L, slot) + 1);
+    }
+    else {
+        // last one wins, just like parsing
+        lua_replace(L, slot);
+    }
+}
 
-def has_body(package, message, field):
-    '''Returns the function body for a has_<field> function'''
+// walks the fields of a message, storing the values of the active paths
+// active holds indexes of the paths whose fields up to depth matched.
+// the active indexes of the next level are stored after them
+static bool peek_message(lua_State *L, CodedInputStream *input, const field_path *paths, int *active, int nactive, int npaths, int depth, int base)
+{
+    int *next = active + npaths;
+
+    while (true) {
+        uint32_t tag = input->ReadTag();
+        if (tag == 0) {
+            return input->ConsumedEntireMessage();
+        }
+
+        int number = WireFormatLite::GetTagFieldNumber(tag);
+        int wire = WireFormatLite::GetTagWireType(tag);
+
+        const lua_protobuf_field_info *field = NULL;
+        bool leaf = false;
+        int nnext = 0;
+        for (int i = 0; i < nactive; i++) {
+            const field_path *path = &paths[active[i]];
+            if (path->fields[depth]->number != number) continue;
+
+            field = path->fields[depth];
+            if (path->depth == depth + 1) {
+                leaf = true;
+            }
+            else {
+                next[nnext++] = active[i];
+            }
+        }
+
+        if (!field) {
+            if (!WireFormatLite::SkipField(input, tag)) return false;
+            continue;
+        }
+
+        int expected = wire_type(field->type);
+
+        // packed repeated scalars
+        if (leaf && wire == WireFormatLite::WIRETYPE_LENGTH_DELIMITED && expected != wire) {
+            uint32_t len;
+            if (!input->ReadVarint32(&len)) return false;
+
+            CodedInputStream::Limit limit = input->PushLimit(len);
+            while (input->BytesUntilLimit() > 0) {
+                if (!push_scalar(L, input, field->type)) return false;
+                for (int i = 0; i < nactive; i++) {
+                    if (paths[active[i]].fields[depth] != field) continue;
+                    lua_pushvalue(L, -1);
+                    store_peeked(L, &paths[active[i]], base + active[i]);
+                }
+                lua_pop(L, 1);
+            }
+            input->PopLimit(limit);
+            continue;
+        }
+
+        // the wire format does not match the field. treat it like an unknown field
+        if (expected != wire) {
+            if (!WireFormatLite::SkipField(input, tag)) return false;
+            continue;
+        }
+
+        if (wire != WireFormatLite::WIRETYPE_LENGTH_DELIMITED) {
+            if (!push_scalar(L, input, field->type)) return false;
+        }
+        else {
+            uint32_t len;
+            if (!input->ReadVarint32(&len)) return false;
+
+            if (leaf) {
+                const void *data = NULL;
+                int available = 0;
+                if (len > 0 && (!input->GetDirectBufferPointer(&data, &available) || (uint32_t)available < len)) {
+                    return false;
+                }
+
+                // embedded messages are returned serialized
+                lua_pushlstring(L, (const char *)data, len);
+            }
+
+            if (nnext) {
+                CodedInputStream::Limit limit = input->PushLimit(len);
+                if (!peek_message(L, input, paths, next, nnext, npaths, depth + 1, base)) return false;
+                input->PopLimit(limit);
+            }
+            else if (!input->Skip(len)) {
+                return false;
+            }
+        }
+
+        if (leaf) {
+            for (int i = 0; i < nactive; i++) {
+                const field_path *path = &paths[active[i]];
+                if (path->fields[depth] != field || path->depth != depth + 1) continue;
+                lua_pushvalue(L, -1);
+                store_peeked(L, path, base + active[i]);
+            }
+            lua_pop(L, 1);
+        }
+    }
+}
 
-    lines = []
-    lines.extend(obtain_message_from_udata(package, message))
-    lines.append('lua_pushboolean(L, m->has_%s());' % field)
-    lines.append('return 1;')
+int lua_protobuf_peek(lua_State *L, const lua_protobuf_field_info *fields, const char *data, size_t len, int paths_index)
+{
+    luaL_checktype(L, paths_index, LUA_TTABLE);
+    if (len > INT_MAX) {
+        return luaL_error(L, "message is too large");
+    }
+
+    int npaths = lua_objlen(L, paths_index);
+
+    // scratch space is allocated from Lua, so it is collected if we error
+    field_path *paths = (field_path *)lua_newuserdata(L, npaths * (sizeof(field_path) + (MAX_PATH_DEPTH + 1) * sizeof(int)));
+    int *active = (int *)(paths + npaths);
+
+    for (int i = 0; i < npaths; i++) {
+        lua_rawgeti(L, paths_index, i + 1);
+        if (lua_type(L, -1) != LUA_TSTRING) {
+            return luaL_error(L, "paths must be strings");
+        }
+        resolve_field_path(L, fields, lua_tostring(L, -1), &paths[i]);
+        lua_pop(L, 1);
+        active[i] = i;
+    }
+
+    // one slot per path, and peek_message() holds up to two values per level
+    luaL_checkstack(L, npaths + MAX_PATH_DEPTH + 2, "too many paths");
+
+    int base = lua_gettop(L) + 1;
+    for (int i = 0; i < npaths; i++) {
+        if (paths[i].collect) {
+            lua_newtable(L);
+        }
+        else {
+            lua_pushnil(L);
+        }
+    }
+
+    bool ok;
+    {
+        CodedInputStream input((const uint8_t *)data, (int)len);
+        ok = peek_message(L, &input, paths, active, npaths, npaths, 0, base);
+    }
+    if (!ok) {
+        return luaL_error(L, "error parsing message");
+    }
+
+    return npaths;
+}
 
-    return lines
+struct lua_protobuf_path {
+    // the field table of the message type the path was compiled for
+    const lua_protobuf_field_info *fields;
+    int depth;
+    struct {
+        const FieldDescriptor *field;
+        // 1-based index into a repeated field
+        lua_Integer index;
+    } steps[MAX_PATH_DEPTH];
+};
+
+// compiles a path of field names separated by dots. repeated fields are
+// followed by an index in brackets
+static void compile_path(lua_State *L, const lua_protobuf_field_info *fields, const Descriptor *descriptor, const char *path, lua_protobuf_path *compiled)
+{
+    const char *start = path;
+
+    compiled->fields = fields;
+    compiled->depth = 0;
+
+    while (true) {
+        size_t len = strcspn(start, ".[");
+
+        if (!fields) {
+            luaL_error(L, "field %s in path %s is not a message", compiled->steps[compiled->depth - 1].field->name().c_str(), path);
+        }
+        if (compiled->depth == MAX_PATH_DEPTH) {
+            luaL_error(L, "path is nested too deeply: %s", path);
+        }
+
+        const lua_protobuf_field_info *info = fields;
+        while (info->name && (strncmp(info->name, start, len) != 0 || info->name[len])) {
+            info++;
+        }
+        if (!info->name) {
+            lua_pushlstring(L, start, len);
+            luaL_error(L, "unknown field %s in path %s", lua_tostring(L, -1), path);
+        }
+
+        const FieldDescriptor *field = descriptor->FindFieldByNumber(info->number);
+        lua_Integer index = 0;
+        start += len;
+
+        if (*start == '[') {
+            char *end;
+            index = (lua_Integer)strtol(start + 1, &end, 10);
+            if (end == start + 1 || *end != ']' || index < 1) {
+                luaL_error(L, "invalid index in path %s", path);
+            }
+            start = end + 1;
+        }
+
+        if (field->is_repeated() != (index != 0)) {
+            luaL_error(L, field->is_repeated() ? "repeated field %s in path %s needs an index" : "field %s in path %s is not repeated", info->name, path);
+        }
+
+        compiled->steps[compiled->depth].field = field;
+        compiled->steps[compiled->depth].index = index;
+        compiled->depth++;
+
+        if (!*start) break;
+        if (*start != '.') {
+            luaL_error(L, "invalid path %s", path);
+        }
+        start++;
+        fields = info->message_fields;
+        descriptor = field->message_type();
+    }
+}
 
-def clear_body(package, message, field):
-    '''Returns the function body for a clear_<field> function'''
-    lines = []
-    lines.extend(obtain_message_from_udata(package, message))
-    lines.append('m->clear_%s();' % field)
-    lines.append('return 0;')
+const lua_protobuf_path * lua_protobuf_check_path(lua_State *L, int index, const lua_protobuf_field_info *fields, const Descriptor *descriptor)
+{
+    if (lua_type(L, index) == LUA_TSTRING) {
+        const char *path = lua_tostring(L, index);
+        lua_protobuf_path *compiled = (lua_protobuf_path *)lua_newuserdata(L, sizeof(lua_protobuf_path));
+        compile_path(L, fields, descriptor, path, compiled);
 
-    return lines
+        luaL_newmetatable(L, PATH_METATABLE);
+        lua_setmetatable(L, -2);
+        lua_replace(L, index);
 
-def size_body(package, message, field):
-    '''Returns the function body for a size_<field> function'''
-    lines = []
-    lines.extend(obtain_message_from_udata(package, message))
-    lines.append('int size = m->%s_size();' % field)
-    lines.append('lua_pushinteger(L, size);')
-    lines.append('return 1;')
+        return compiled;
+    }
 
-    return lines
+    const lua_protobuf_path *compiled = (const lua_protobuf_path *)luaL_checkudata(L, index, PATH_METATABLE);
+    if (compiled->fields != fields) {
+        luaL_error(L, "path was compiled for another message type");
+    }
 
-def add_body(package, message, field, type_name):
-    '''Returns the function body for the add_<field> function for repeated embedded messages'''
-    lines = []
-    lines.extend(obtain_message_from_udata(package, message))
-    lines.extend([
-        '%s *msg_new = m->add_%s();' % ( cpp_class(type_name), field ),
+    return compiled;
+}
 
-        # since the message is allocated out of the containing message, Lua
-        # does not need to do GC
-        'lua_protobuf%s_pushreference(L, msg_new, NULL, NULL);' % type_name.replace('.', '_'),
-        'return 1;',
-    ])
+int lua_protobuf_path_number(const lua_protobuf_path *path)
+{
+    return path->steps[0].field->number();
+}
 
-    return lines
+// checks the index of a path step against the size of a repeated field
+// one past the end is allowed, as the field grows
+static void check_path_index(lua_State *L, const FieldDescriptor *field, lua_Integer index, int size)
+{
+    if (index > size + 1) {
+        luaL_error(L, "index %d of field %s is out of range. size is %d", (int)index, field->name().c_str(), size);
+    }
+}
 
-def field_get(package, message, field_descriptor):
-    '''Returns function definition for a get_<field> function'''
+int lua_protobuf_getpath(lua_State *L, const lua_protobuf_path *path, const Message *msg)
+{
+    const Message *current = msg;
+
+    for (int i = 0; i < path->depth; i++) {
+        const FieldDescriptor *field = path->steps[i].field;
+        int index = (int)path->steps[i].index - 1;
+        const Reflection *reflection = current->GetReflection();
+
+        if (field->is_repeated() ? index >= reflection->FieldSize(*current, field) : !reflection->HasField(*current, field)) {
+            lua_pushnil(L);
+            return 1;
+        }
+
+        if (i < path->depth - 1) {
+            current = index < 0 ? &reflection->GetMessage(*current, field) : &reflection->GetRepeatedMessage(*current, field, index);
+            continue;
+        }
+
+        switch (field->cpp_type()) {
+            case FieldDescriptor::CPPTYPE_INT32:
+                lua_pushinteger(L, index < 0 ? reflection->GetInt32(*current, field) : reflection->GetRepeatedInt32(*current, field, index));
+                break;
+
+            case FieldDescriptor::CPPTYPE_INT64:
+                lua_pushinteger(L, index < 0 ? reflection->GetInt64(*current, field) : reflection->GetRepeatedInt64(*current, field, index));
+                break;
+
+            case FieldDescriptor::CPPTYPE_UINT32:
+                lua_pushinteger(L, index < 0 ? reflection->GetUInt32(*current, field) : reflection->GetRepeatedUInt32(*current, field, index));
+                break;
+
+            case FieldDescriptor::CPPTYPE_UINT64:
+                lua_pushinteger(L, index < 0 ? reflection->GetUInt64(*current, field) : reflection->GetRepeatedUInt64(*current, field, index));
+                break;
+
+            case FieldDescriptor::CPPTYPE_DOUBLE:
+                lua_pushnumber(L, index < 0 ? reflection->GetDouble(*current, field) : reflection->GetRepeatedDouble(*current, field, index));
+                break;
+
+            case FieldDescriptor::CPPTYPE_FLOAT:
+                lua_pushnumber(L, index < 0 ? reflection->GetFloat(*current, field) : reflection->GetRepeatedFloat(*current, field, index));
+                break;
+
+            case FieldDescriptor::CPPTYPE_BOOL:
+                lua_pushboolean(L, index < 0 ? reflection->GetBool(*current, field) : reflection->GetRepeatedBool(*current, field, index));
+                break;
+
+            case FieldDescriptor::CPPTYPE_ENUM:
+                lua_pushinteger(L, index < 0 ? reflection->GetEnumValue(*current, field) : reflection->GetRepeatedEnumValue(*current, field, index));
+                break;
+
+            case FieldDescriptor::CPPTYPE_STRING: {
+                std::string scratch;
+                const std::string &value = index < 0 ? reflection->GetStringReference(*current, field, &scratch) : reflection->GetRepeatedStringReference(*current, field, index, &scratch);
+                lua_pushlstring(L, value.data(), value.size());
+                break;
+            }
+
+            case FieldDescriptor::CPPTYPE_MESSAGE: {
+                const Message &value = index < 0 ? reflection->GetMessage(*current, field) : reflection->GetRepeatedMessage(*current, field, index);
+                std::string serialized;
+                bool ok = value.SerializeToString(&serialized);
+                if (ok) {
+                    lua_pushlstring(L, serialized.data(), serialized.size());
+                }
+                else {
+                    lua_pushnil(L);
+                }
+                break;
+            }
+        }
+    }
 
-    name = field_descriptor.name
-    type = field_descriptor.type
-    type_name = field_descriptor.type_name
-    label = field_descriptor.label
-    repeated = label == FieldDescriptor.LABEL_REPEATED
+    return 1;
+}
 
-    lines = []
-    lines.extend(field_function_start(package, message, 'get', name))
-    lines.extend(obtain_message_from_udata(package, message))
+int lua_protobuf_setpath(lua_State *L, const lua_protobuf_path *path, Message *msg, int index)
+{
+    const FieldDescriptor *field = path->steps[path->depth - 1].field;
+    int step = (int)path->steps[path->depth - 1].index;
+
+    // the path and the value are checked before anything is changed, so
+    // errors leave the message alone. the messages along the path are looked
+    // at without creating them, and exists tells whether they are all set
+    const Message *probe = msg;
+    bool exists = true;
+    for (int i = 0; i < path->depth; i++) {
+        const FieldDescriptor *f = path->steps[i].field;
+        const Reflection *reflection = probe->GetReflection();
+
+        if (f->is_repeated()) {
+            int size = exists ? reflection->FieldSize(*probe, f) : 0;
+            check_path_index(L, f, path->steps[i].index, size);
+            exists = exists && path->steps[i].index <= size;
+        }
+        else {
+            exists = exists && reflection->HasField(*probe, f);
+        }
+
+        // past a message that does not exist, the rest of the path is empty
+        if (exists && i < path->depth - 1) {
+            probe = f->is_repeated() ? &reflection->GetRepeatedMessage(*probe, f, (int)path->steps[i].index - 1) : &reflection->GetMessage(*probe, f);
+        }
+    }
+
+    if (lua_isnil(L, index)) {
+        if (field->is_repeated()) {
+            return luaL_error(L, "cannot assign nil to repeated fields");
+        }
+        if (!exists && path->depth > 1) {
+            // there is nothing to clear
+            return 0;
+        }
+    }
+
+    lua_Integer integer = 0;
+    lua_Number number = 0;
+    bool boolean = false;
+    const char *s = NULL;
+    size_t len = 0;
+
+    if (!lua_isnil(L, index)) {
+        switch (field->cpp_type()) {
+            case FieldDescriptor::CPPTYPE_INT32:
+                integer = lua_protobuf_check_int32(L, index);
+                break;
+
+            case FieldDescriptor::CPPTYPE_UINT32:
+                integer = lua_protobuf_check_uint32(L, index);
+                break;
+
+            case FieldDescriptor::CPPTYPE_INT64:
+            case FieldDescriptor::CPPTYPE_UINT64:
+                integer = luaL_checkinteger(L, index);
+                break;
+
+            case FieldDescriptor::CPPTYPE_ENUM:
+                integer = luaL_checkinteger(L, index);
+                if (!field->enum_type()->FindValueByNumber((int)integer)) {
+                    return luaL_error(L, "%d is not a value of enum %s", (int)integer, field->enum_type()->full_name().c_str());
+                }
+                break;
+
+            case FieldDescriptor::CPPTYPE_DOUBLE:
+            case FieldDescriptor::CPPTYPE_FLOAT:
+                number = luaL_checknumber(L, index);
+                break;
+
+            case FieldDescriptor::CPPTYPE_BOOL:
+                boolean = lua_protobuf_check_bool(L, index);
+                break;
+
+            case FieldDescriptor::CPPTYPE_STRING:
+                s = luaL_checklstring(L, index, &len);
+                break;
+
+            case FieldDescriptor::CPPTYPE_MESSAGE:
+                return luaL_error(L, "embedded message %s cannot be set through a path", field->name().c_str());
+        }
+    }
+
+    Message *current = msg;
+
+    for (int i = 0; i < path->depth - 1; i++) {
+        const FieldDescriptor *f = path->steps[i].field;
+        const Reflection *reflection = current->GetReflection();
+
+        if (f->is_repeated()) {
+            int size = reflection->FieldSize(*current, f);
+            int at = (int)path->steps[i].index;
+            current = at > size ? reflection->AddMessage(current, f) : reflection->MutableRepeatedMessage(current, f, at - 1);
+        }
+        else {
+            current = reflection->MutableMessage(current, f);
+        }
+    }
+
+    const Reflection *reflection = current->GetReflection();
+    bool add = field->is_repeated() && step > reflection->FieldSize(*current, field);
+
+    if (lua_isnil(L, index)) {
+        reflection->ClearField(current, field);
+        return 0;
+    }
+
+    switch (field->cpp_type()) {
+        case FieldDescriptor::CPPTYPE_INT32: {
+            int32_t v = (int32_t)integer;
+            if (add) reflection->AddInt32(current, field, v);
+            else if (step) reflection->SetRepeatedInt32(current, field, step - 1, v);
+            else reflection->SetInt32(current, field, v);
+            break;
+        }
+
+        case FieldDescriptor::CPPTYPE_INT64: {
+            int64_t v = (int64_t)integer;
+            if (add) reflection->AddInt64(current, field, v);
+            else if (step) reflection->SetRepeatedInt64(current, field, step - 1, v);
+            else reflection->SetInt64(current, field, v);
+            break;
+        }
+
+        case FieldDescriptor::CPPTYPE_UINT32: {
+            uint32_t v = (uint32_t)integer;
+            if (add) reflection->AddUInt32(current, field, v);
+            else if (step) reflection->SetRepeatedUInt32(current, field, step - 1, v);
+            else reflection->SetUInt32(current, field, v);
+            break;
+        }
+
+        case FieldDescriptor::CPPTYPE_UINT64: {
+            uint64_t v = (uint64_t)integer;
+            if (add) reflection->AddUInt64(current, field, v);
+            else if (step) reflection->SetRepeatedUInt64(current, field, step - 1, v);
+            else reflection->SetUInt64(current, field, v);
+            break;
+        }
+
+        case FieldDescriptor::CPPTYPE_DOUBLE: {
+            double v = number;
+            if (add) reflection->AddDouble(current, field, v);
+            else if (step) reflection->SetRepeatedDouble(current, field, step - 1, v);
+            else reflection->SetDouble(current, field, v);
+            break;
+        }
+
+        case FieldDescriptor::CPPTYPE_FLOAT: {
+            float v = (float)number;
+            if (add) reflection->AddFloat(current, field, v);
+            else if (step) reflection->SetRepeatedFloat(current, field, step - 1, v);
+            else reflection->SetFloat(current, field, v);
+            break;
+        }
+
+        case FieldDescriptor::CPPTYPE_BOOL: {
+            bool v = boolean;
+            if (add) reflection->AddBool(current, field, v);
+            else if (step) reflection->SetRepeatedBool(current, field, step - 1, v);
+            else reflection->SetBool(current, field, v);
+            break;
+        }
+
+        case FieldDescriptor::CPPTYPE_ENUM: {
+            int v = (int)integer;
+            if (add) reflection->AddEnumValue(current, field, v);
+            else if (step) reflection->SetRepeatedEnumValue(current, field, step - 1, v);
+            else reflection->SetEnumValue(current, field, v);
+            break;
+        }
+
+        case FieldDescriptor::CPPTYPE_STRING: {
+            if (add) reflection->AddString(current, field, std::string(s, len));
+            else if (step) reflection->SetRepeatedString(current, field, step - 1, std::string(s, len));
+            else reflection->SetString(current, field, std::string(s, len));
+            break;
+        }
+
+        case FieldDescriptor::CPPTYPE_MESSAGE:
+            break;
+    }
+
+    return 0;
+}
 
-    # the logic is significantly different depending on if the field is
-    # singular or repeated.
-    # for repeated, we have an argument which points to the numeric index to
-    # retrieve. in true Lua convention, we index starting from 1, which is
-    # different from protocol buffers, which indexes from 0
+// reads a boolean option from the table at index, which may be none or nil
+static bool json_option(lua_State *L, int index, const char *name)
+{
+    if (lua_isnoneornil(L, index)) {
+        return false;
+    }
 
-    if repeated:
-        lines.extend([
-            'if (lua_gettop(L) != 2) {',
-                'return luaL_error(L, "missing required numeric argument");',
-            '}',
-            'lua_Integer index = luaL_checkinteger(L, 2);',
-            'if (index < 1 || index > m->%s_size()) {' % name,
-                # TODO is returning nil the more Lua way?
-                'return luaL_error(L, "index must be between 1 and current size: %%d", m->%s_size());' % name,
-            '}',
-        ])
+    lua_getfield(L, index, name);
+    bool value = lua_toboolean(L, -1);
+    lua_pop(L, 1);
 
-    # TODO float and double types are not equivalent. don't treat them as such
-    # TODO figure out how to support 64 bit integers properly
+    return value;
+}
 
-    if repeated:
-        if type in [ FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES ]:
-            lines.extend([
-                'string s = m->%s(index - 1);' % name,
-                'lua_pushlstring(L, s.c_str(), s.size());',
-            ])
-        elif type == FieldDescriptor.TYPE_BOOL:
-            lines.append('lua_pushboolean(L, m->%s(index-1));' % name)
+int lua_protobuf_tojson(lua_State *L, const Message &msg, int options_index)
+{
+    if (!lua_isnoneornil(L, options_index)) {
+        luaL_checktype(L, options_index, LUA_TTABLE);
+    }
+
+    ::google::protobuf::util::JsonPrintOptions options;
+    options.add_whitespace = json_option(L, options_index, "pretty");
+    options.always_print_primitive_fields = json_option(L, options_index, "defaults");
+    options.always_print_enums_as_ints = json_option(L, options_index, "enums_as_ints");
+    options.preserve_proto_field_names = json_option(L, options_index, "preserve_field_names");
+
+    // the error is raised once the strings are gone
+    bool ok;
+    {
+        std::string json;
+        auto status = ::google::protobuf::util::MessageToJsonString(msg, &json, options);
+        ok = status.ok();
+        if (ok) {
+            lua_pushlstring(L, json.data(), json.size());
+        }
+        else {
+            std::string error = status.ToString();
+            lua_pushlstring(L, error.data(), error.size());
+        }
+    }
+    if (!ok) {
+        return luaL_error(L, "error converting message to JSON: %s", lua_tostring(L, -1));
+    }
 
-        elif type in [FieldDescriptor.TYPE_INT32, FieldDescriptor.TYPE_UINT32,
-            FieldDescriptor.TYPE_FIXED32, FieldDescriptor.TYPE_SFIXED32, FieldDescriptor.TYPE_SINT32]:
+    return 1;
+}
 
-            lines.append('lua_pushinteger(L, m->%s(index-1));' % name)
+void lua_protobuf_fromjson(lua_State *L, int index, Message *msg, int options_index)
+{
+    size_t len;
+    const char *s = luaL_checklstring(L, index, &len);
+    if (!lua_isnoneornil(L, options_index)) {
+        luaL_checktype(L, options_index, LUA_TTABLE);
+    }
+
+    ::google::protobuf::util::JsonParseOptions options;
+    options.ignore_unknown_fields = json_option(L, options_index, "ignore_unknown");
+
+    bool ok;
+    {
+        auto status = ::google::protobuf::util::JsonStringToMessage(std::string(s, len), msg, options);
+        ok = status.ok();
+        if (!ok) {
+            std::string error = status.ToString();
+            lua_pushlstring(L, error.data(), error.size());
+        }
+    }
+    if (!ok) {
+        luaL_error(L, "error parsing JSON: %s", lua_tostring(L, -1));
+    }
+}
 
-        elif type in [ FieldDescriptor.TYPE_INT64, FieldDescriptor.TYPE_UINT64,
-            FieldDescriptor.TYPE_FIXED64, FieldDescriptor.TYPE_SFIXED64, FieldDescriptor.TYPE_SINT64]:
-            lines.append('lua_pushinteger(L, m->%s(index-1));' % name)
+typedef struct view {
+    const char *data;
+    size_t len;
+    // registry reference to the owner of the bytes
+    int owner;
+    // counter of changes to the owner and its value when the view was made
+    const unsigned int *generation;
+    unsigned int expected;
+} view;
+
+static view * check_view(lua_State *L)
+{
+    view *v = (view *)luaL_checkudata(L, 1, VIEW_METATABLE);
+    if (v->generation && *v->generation != v->expected) {
+        luaL_error(L, "view invalidated");
+    }
+    return v;
+}
 
-        elif type == FieldDescriptor.TYPE_FLOAT or type == FieldDescriptor.TYPE_DOUBLE:
-            lines.append('lua_pushnumber(L, m->%s(index-1));' % name)
+static int view_len(lua_State *L)
+{
+    lua_pushinteger(L, (lua_Integer)check_view(L)->len);
+    return 1;
+}
 
-        elif type == FieldDescriptor.TYPE_ENUM:
-            lines.append('lua_pushnumber(L, m->%s(index-1));' % name)
+static int view_tostring(lua_State *L)
+{
+    view *v = check_view(L);
+    lua_pushlstring(L, v->data, v->len);
+    return 1;
+}
 
-        elif type == FieldDescriptor.TYPE_MESSAGE:
-            lines.extend([
-                '%s * got_msg = m->mutable_%s(index-1);' % ( type_name.replace('.', '::'), name ),
-                'lua_protobuf%s_pushreference(L, got_msg, NULL, NULL);' % type_name.replace('.', '_'),
-            ])
+// translates a string.sub() style position into an offset from 1
+static lua_Integer view_position(lua_Integer position, size_t len)
+{
+    if (position < 0) {
+        position += (lua_Integer)len + 1;
+    }
+    return position < 0 ? 0 : position;
+}
 
-        else:
-            lines.append('return luaL_error(L, "lua-protobuf does not support this field type");')
-    else:
-        # for scalar fields, we push nil if the value is not defined
-        # this is the Lua way
-        if type == FieldDescriptor.TYPE_STRING or type == FieldDescriptor.TYPE_BYTES:
-            lines.append('string s = m->%s();' % name)
-            lines.append('m->has_%s() ? lua_pushlstring(L, s.c_str(), s.size()) : lua_pushnil(L);' % name)
+// returns bytes i to j, inclusive, like string.sub()
+static int view_sub(lua_State *L)
+{
+    view *v = check_view(L);
+    lua_Integer i = view_position(luaL_checkinteger(L, 2), v->len);
+    lua_Integer j = view_position(luaL_optinteger(L, 3, -1), v->len);
+    if (i < 1) {
+        i = 1;
+    }
+    if (j > (lua_Integer)v->len) {
+        j = (lua_Integer)v->len;
+    }
+
+    if (i > j) {
+        lua_pushliteral(L, "");
+    }
+    else {
+        lua_pushlstring(L, v->data + i - 1, (size_t)(j - i + 1));
+    }
+    return 1;
+}
 
-        elif type == FieldDescriptor.TYPE_BOOL:
-            lines.append('m->has_%s() ? lua_pushboolean(L, m->%s()) : lua_pushnil(L);' % ( name, name ))
+// returns the values of bytes i to j, like string.byte()
+static int view_byte(lua_State *L)
+{
+    view *v = check_view(L);
+    lua_Integer i = view_position(luaL_optinteger(L, 2, 1), v->len);
+    lua_Integer j = view_position(luaL_optinteger(L, 3, i), v->len);
+    if (i < 1) {
+        i = 1;
+    }
+    if (j > (lua_Integer)v->len) {
+        j = (lua_Integer)v->len;
+    }
+
+    int n = 0;
+    luaL_checkstack(L, j >= i ? (int)(j - i + 1) : 0, "view:byte(): too many results");
+    for (lua_Integer k = i; k <= j; k++, n++) {
+        lua_pushinteger(L, (unsigned char)v->data[k - 1]);
+    }
+    return n;
+}
 
-        elif type in [FieldDescriptor.TYPE_INT32, FieldDescriptor.TYPE_UINT32,
-            FieldDescriptor.TYPE_FIXED32, FieldDescriptor.TYPE_SFIXED32, FieldDescriptor.TYPE_SINT32]:
-            lines.append('m->has_%s() ? lua_pushinteger(L, m->%s()) : lua_pushnil(L);' % ( name, name ))
+// the address of the bytes, for use with the LuaJIT FFI
+static int view_pointer(lua_State *L)
+{
+    lua_pushlightuserdata(L, (void *)check_view(L)->data);
+    return 1;
+}
 
-        elif type in [ FieldDescriptor.TYPE_INT64, FieldDescriptor.TYPE_UINT64,
-            FieldDescriptor.TYPE_FIXED64, FieldDescriptor.TYPE_SFIXED64, FieldDescriptor.TYPE_SINT64]:
-            lines.append('m->has_%s() ? lua_pushinteger(L, m->%s()) : lua_pushnil(L);' % ( name, name ))
+static int view_gc(lua_State *L)
+{
+    view *v = (view *)luaL_checkudata(L, 1, VIEW_METATABLE);
+    luaL_unref(L, LUA_REGISTRYINDEX, v->owner);
+    v->owner = LUA_NOREF;
+    return 0;
+}
 
-        elif type == FieldDescriptor.TYPE_FLOAT or type == FieldDescriptor.TYPE_DOUBLE:
-            lines.append('m->has_%s() ? lua_pushnumber(L, m->%s()) : lua_pushnil(L);' % ( name, name ))
+void lua_protobuf_push_view(lua_State *L, const char *data, size_t len, int owner_index, const unsigned int *generation)
+{
+    lua_pushvalue(L, owner_index);
+    int owner = luaL_ref(L, LUA_REGISTRYINDEX);
+
+    view *v = (view *)lua_newuserdata(L, sizeof(view));
+    v->data = data;
+    v->len = len;
+    v->owner = owner;
+    v->generation = generation;
+    v->expected = generation ? *generation : 0;
+
+    if (luaL_newmetatable(L, VIEW_METATABLE)) {
+        static const struct luaL_Reg methods [] = {
+            {"len", view_len},
+            {"sub", view_sub},
+            {"byte", view_byte},
+            {"pointer", view_pointer},
+            {"__len", view_len},
+            {"__tostring", view_tostring},
+            {"__gc", view_gc},
+            {NULL, NULL},
+        };
+        lua_pushvalue(L, -1);
+        lua_setfield(L, -2, "__index");
+        luaL_register(L, NULL, methods);
+    }
+    lua_setmetatable(L, -2);
+}
 
-        elif type == FieldDescriptor.TYPE_ENUM:
-            lines.append('m->has_%s() ? lua_pushinteger(L, m->%s()) : lua_pushnil(L);' % ( name, name ))
+// a field in a mask. if it has no children, the whole field is in the mask
+typedef struct mask_node {
+    const FieldDescriptor *field;
+    std::vector<struct mask_node> children;
+} mask_node;
 
-        elif type == FieldDescriptor.TYPE_MESSAGE:
-            lines.extend([
-                'if (!m->has_%s()) {' % name,
-                    'lua_pushnil(L);',
-                '}',
+static bool mask_node_before(const mask_node &a, const mask_node &b)
+{
+    return a.field->number() < b.field->number();
+}
 
-                # we push the message as userdata
-                # since the message is allocated out of the parent message, we
-                # don't need to do garbage collection
-                '%s * got_msg = m->mutable_%s();' % ( type_name.replace('.', '::'), name ),
-                'lua_protobuf%s_pushreference(L, got_msg, NULL, NULL);' % type_name.replace('.', '_'),
-            ])
+struct lua_protobuf_mask {
+    // the field table of the message type the mask was compiled for
+    const lua_protobuf_field_info *fields;
+    // ordered by field number, so fields are written in canonical order
+    std::vector<mask_node> nodes;
+};
 
-        else:
-            # not supported yet :(
-            lines.append('return luaL_error(L, "lua-protobuf does not support this field type");')
+static int mask_gc(lua_State *L)
+{
+    lua_protobuf_mask **mask = (lua_protobuf_mask **)luaL_checkudata(L, 1, MASK_METATABLE);
+    delete *mask;
+    *mask = NULL;
+    return 0;
+}
 
-    lines.append('return 1;')
-    lines.append('}\n')
+// adds a path of field names separated by dots to a mask
+// only the last field of a path may be repeated
+static void add_mask_path(lua_State *L, const lua_protobuf_field_info *fields, const Descriptor *descriptor, const char *path, std::vector<mask_node> *nodes)
+{
+    const char *start = path;
+
+    while (true) {
+        const char *end = strchr(start, '.');
+        size_t len = end ? (size_t)(end - start) : strlen(start);
+
+        const lua_protobuf_field_info *info = fields;
+        while (info->name && (strncmp(info->name, start, len) != 0 || info->name[len])) {
+            info++;
+        }
+        if (!info->name) {
+            lua_pushlstring(L, start, len);
+            luaL_error(L, "unknown field %s in path %s", lua_tostring(L, -1), path);
+        }
+
+        const FieldDescriptor *field = descriptor->FindFieldByNumber(info->number);
+        if (end && (!info->message_fields || field->is_repeated())) {
+            luaL_error(L, "field %s in path %s is not a singular message", info->name, path);
+        }
+
+        std::vector<mask_node>::iterator node = nodes->begin();
+        while (node != nodes->end() && node->field != field) {
+            ++node;
+        }
+
+        if (node == nodes->end()) {
+            mask_node added;
+            added.field = field;
+            nodes->push_back(added);
+            std::sort(nodes->begin(), nodes->end(), mask_node_before);
+
+            node = nodes->begin();
+            while (node->field != field) {
+                ++node;
+            }
+        }
+        // the whole field is in the mask already
+        else if (node->children.empty()) {
+            return;
+        }
+
+        if (!end) {
+            node->children.clear();
+            return;
+        }
+
+        start = end + 1;
+        fields = info->message_fields;
+        descriptor = field->message_type();
+        nodes = &node->children;
+
+        // an empty list of children would make the whole field part of the mask
+        // it is filled in by the next iteration
+    }
+}
 
-    return lines
+const lua_protobuf_mask * lua_protobuf_check_mask(lua_State *L, int index, const lua_protobuf_field_info *fields, const Descriptor *descriptor)
+{
+    if (lua_istable(L, index)) {
+        lua_protobuf_mask **mask = (lua_protobuf_mask **)lua_newuserdata(L, sizeof(lua_protobuf_mask *));
+        *mask = NULL;
+        if (luaL_newmetatable(L, MASK_METATABLE)) {
+            lua_pushcfunction(L, mask_gc);
+            lua_setfield(L, -2, "__gc");
+        }
+        lua_setmetatable(L, -2);
+
+        // the userdata deletes the mask if a path raises an error
+        *mask = new lua_protobuf_mask();
+        (*mask)->fields = fields;
+
+        int n = lua_objlen(L, index);
+        for (int i = 1; i <= n; i++) {
+            lua_rawgeti(L, index, i);
+            if (lua_type(L, -1) != LUA_TSTRING) {
+                luaL_error(L, "paths must be strings");
+            }
+            add_mask_path(L, fields, descriptor, lua_tostring(L, -1), &(*mask)->nodes);
+            lua_pop(L, 1);
+        }
+
+        lua_replace(L, index);
+        return *mask;
+    }
+
+    const lua_protobuf_mask *mask = *(lua_protobuf_mask **)luaL_checkudata(L, index, MASK_METATABLE);
+    if (mask->fields != fields) {
+        luaL_error(L, "mask was compiled for another message type");
+    }
+
+    return mask;
+}
 
-def field_set_assignment(field, args):
-    return [
-        'if (index == current_size + 1) {',
-            'm->add_%s(%s);' % ( field, args ),
-        '}',
-        'else {',
-            'm->set_%s(index-1, %s);' % ( field, args ),
-        '}',
-    ]
+// returns the size of the serialized fields of msg in the mask
+// the sizes of embedded messages are cached, as serializing requires
+static size_t masked_size(const Message &msg, const std::vector<mask_node> &nodes)
+{
+    const Reflection *reflection = msg.GetReflection();
+    size_t size = 0;
+
+    for (std::vector<mask_node>::const_iterator node = nodes.begin(); node != nodes.end(); ++node) {
+        if (node->children.empty()) {
+            size += WireFormat::FieldByteSize(node->field, msg);
+        }
+        else if (reflection->HasField(msg, node->field)) {
+            size_t embedded = masked_size(reflection->GetMessage(msg, node->field), node->children);
+            size += WireFormat::TagSize(node->field->number(), node->field->type());
+            size += CodedOutputStream::VarintSize64(embedded) + embedded;
+        }
+    }
+
+    return size;
+}
 
-def field_set(package, message, field_descriptor):
-    '''Returns function definition for a set_<field> function'''
+static void write_masked(const Message &msg, const std::vector<mask_node> &nodes, CodedOutputStream *output)
+{
+    const Reflection *reflection = msg.GetReflection();
+
+    for (std::vector<mask_node>::const_iterator node = nodes.begin(); node != nodes.end(); ++node) {
+        if (node->children.empty()) {
+            WireFormat::SerializeFieldWithCachedSizes(node->field, msg, output);
+        }
+        else if (reflection->HasField(msg, node->field)) {
+            const Message &embedded = reflection->GetMessage(msg, node->field);
+            output->WriteTag(WireFormatLite::MakeTag(node->field->number(), WireFormatLite::WIRETYPE_LENGTH_DELIMITED));
+            output->WriteVarint64(masked_size(embedded, node->children));
+            write_masked(embedded, node->children, output);
+        }
+    }
+}
 
-    name = field_descriptor.name
-    type = field_descriptor.type
-    type_name = field_descriptor.type_name
-    label = field_descriptor.label
-    repeated = label == FieldDescriptor.LABEL_REPEATED
+// clears the fields of msg in the mask
+static void clear_masked(Message *msg, const std::vector<mask_node> &nodes)
+{
+    const Reflection *reflection = msg->GetReflection();
+
+    for (std::vector<mask_node>::const_iterator node = nodes.begin(); node != nodes.end(); ++node) {
+        if (node->children.empty()) {
+            reflection->ClearField(msg, node->field);
+        }
+        else if (reflection->HasField(*msg, node->field)) {
+            clear_masked(reflection->MutableMessage(msg, node->field), node->children);
+        }
+    }
+}
 
-    lines = []
-    lines.extend(field_function_start(package, message, 'set', name))
-    lines.extend(obtain_message_from_udata(package, message, 1))
+static void serialize_masked(const lua_protobuf_mask *mask, const Message &msg, std::string *s)
+{
+    size_t size = masked_size(msg, mask->nodes);
+    s->reserve(size);
 
-    # we do things differently depending on if this is a singular or repeated field
-    # for singular fields, the new value is the first argument
-    # for repeated fields, the index is arg1 and the value is arg2
-    if repeated:
-        lines.extend([
-            'if (lua_gettop(L) != 3) {',
-            '    return luaL_error(L, "required 2 arguments not passed to function");',
-            '}',
-            'lua_Integer index = luaL_checkinteger(L, 2);',
-            'int current_size = m->%s_size();' % name,
-            'if (index < 1 || index > current_size + 1) {',
-                'return luaL_error(L, "index must be between 1 and %d", current_size + 1);',
-            '}',
+    StringOutputStream stream(s);
+    CodedOutputStream output(&stream);
+    write_masked(msg, mask->nodes, &output);
+}
 
-            # we don't support the automagic nil clears value... yet
-            'if (lua_isnil(L, 3)) {',
-                'return luaL_error(L, "cannot assign nil to repeated fields (yet)");',
-            '}',
-        ])
+int lua_protobuf_serialize_masked(lua_State *L, const lua_protobuf_mask *mask, const Message &msg)
+{
+    std::string s;
+    serialize_masked(mask, msg, &s);
+    lua_pushlstring(L, s.data(), s.size());
+    return 1;
+}
 
-    # TODO proper 64 bit handling
+bool lua_protobuf_merge_masked(const lua_protobuf_mask *mask, const Message &from, Message *to)
+{
+    // fields in the mask are cleared first, so parsing replaces them while
+    // embedded messages on the way to them are merged
+    std::string s;
+    serialize_masked(mask, from, &s);
+    clear_masked(to, mask->nodes);
+
+    // required fields may be missing from either message
+    CodedInputStream input((const uint8_t *)s.data(), (int)s.size());
+    return to->MergePartialFromCodedStream(&input) && input.ConsumedEntireMessage();
+}
 
-    # now move on to the assignment
-    if repeated:
-        if type in [ FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES ]:
-            lines.extend([
-                'size_t length = 0;',
-                'const char *s = luaL_checklstring(L, 3, &length);',
-            ])
-            lines.extend(field_set_assignment(name, 's, length'))
+bool lua_protobuf_parse_lazy(::google::protobuf::Message *msg, const char *data, size_t len, const int *lazy_numbers, lua_protobuf_lazy **lazy)
+{
+    if (len > INT_MAX) {
+        return false;
+    }
+
+    lua_protobuf_lazy *pending = NULL;
+    std::string eager;
+    bool ok;
+    {
+        CodedInputStream input((const uint8_t *)data, (int)len);
+
+        // start of the eager bytes that have not been copied yet
+        int start = 0;
+
+        while (true) {
+            int position = input.CurrentPosition();
+            uint32_t tag = input.ReadTag();
+            if (tag == 0) {
+                ok = input.ConsumedEntireMessage();
+                break;
+            }
+
+            if (!WireFormatLite::SkipField(&input, tag)) {
+                ok = false;
+                break;
+            }
+
+            if (WireFormatLite::GetTagWireType(tag) != WireFormatLite::WIRETYPE_LENGTH_DELIMITED) continue;
+
+            int number = WireFormatLite::GetTagFieldNumber(tag);
+            const int *n = lazy_numbers;
+            while (*n && *n != number) n++;
+            if (!*n) continue;
+
+            eager.append(data + start, position - start);
+            start = input.CurrentPosition();
+
+            if (!pending) pending = new lua_protobuf_lazy();
+            pending->fields[number].append(data + position, start - position);
+        }
+
+        // without lazy fields, there is no need to copy anything
+        if (ok && !pending) {
+            ok = msg->ParseFromArray(data, (int)len);
+        }
+        else if (ok) {
+            eager.append(data + start, len - start);
+            ok = msg->ParseFromString(eager);
+        }
+    }
+
+    if (!ok) {
+        delete pending;
+        return false;
+    }
+
+    *lazy = pending;
+    return true;
+}
 
-        elif type == FieldDescriptor.TYPE_BOOL:
-            lines.append('bool b = lua_toboolean(L, 3);')
-            lines.extend(field_set_assignment(name, 'b'))
+bool lua_protobuf_lazy_materialize(::google::protobuf::Message *msg, lua_protobuf_lazy **lazy, int number)
+{
+    if (!*lazy) {
+        return true;
+    }
+
+    std::map<int, std::string> &fields = (*lazy)->fields;
+    bool ok = true;
+
+    if (number) {
+        std::map<int, std::string>::iterator i = fields.find(number);
+        if (i != fields.end()) {
+            ok = msg->MergeFromString(i->second);
+            fields.erase(i);
+        }
+    }
+    else {
+        for (std::map<int, std::string>::iterator i = fields.begin(); i != fields.end(); ++i) {
+            ok = msg->MergeFromString(i->second) && ok;
+        }
+        fields.clear();
+    }
+
+    if (fields.empty()) {
+        delete *lazy;
+        *lazy = NULL;
+    }
+
+    return ok;
+}
 
-        elif type in [ FieldDescriptor.TYPE_DOUBLE, FieldDescriptor.TYPE_FLOAT ]:
-            lines.append('double d = lua_tonumber(L, 3);')
-            lines.extend(field_set_assignment(name, 'd'))
+void lua_protobuf_lazy_serialize(const lua_protobuf_lazy *lazy, std::string *s)
+{
+    for (std::map<int, std::string>::const_iterator i = lazy->fields.begin(); i != lazy->fields.end(); ++i) {
+        s->append(i->second);
+    }
+}
 
-        elif type in [ FieldDescriptor.TYPE_INT32, FieldDescriptor.TYPE_FIXED32,
-            FieldDescriptor.TYPE_UINT32, FieldDescriptor.TYPE_SFIXED32, FieldDescriptor.TYPE_SINT32 ]:
+void lua_protobuf_lazy_free(lua_protobuf_lazy *lazy)
+{
+    delete lazy;
+}
 
-            lines.append('lua_Integer i = lua_tointeger(L, 3);')
-            lines.extend(field_set_assignment(name, 'i'))
+struct lua_protobuf_shared {
+    ::google::protobuf::Message *msg;
+    std::atomic<int> references;
+};
 
-        elif type in [ FieldDescriptor.TYPE_INT64, FieldDescriptor.TYPE_UINT64,
-            FieldDescriptor.TYPE_FIXED64, FieldDescriptor.TYPE_SFIXED64, FieldDescriptor.TYPE_SINT64]:
+lua_protobuf_shared * lua_protobuf_share(::google::protobuf::Message *msg)
+{
+    lua_protobuf_shared *shared = new lua_protobuf_shared();
+    shared->msg = msg;
+    shared->references = 1;
+    return shared;
+}
 
-            lines.append('lua_Integer i = lua_tointeger(L, 3);')
-            lines.extend(field_set_assignment(name, 'i'))
+lua_protobuf_shared * lua_protobuf_shared_retain(lua_protobuf_shared *shared)
+{
+    if (shared) {
+        shared->references.fetch_add(1, std::memory_order_relaxed);
+    }
+    return shared;
+}
 
-        elif type == FieldDescriptor.TYPE_ENUM:
-            lines.append('lua_Integer i = lua_tointeger(L, 3);')
-            lines.extend(field_set_assignment(name, '(%s)i' % type_name.replace('.', '::')))
+void lua_protobuf_shared_release(lua_protobuf_shared *shared)
+{
+    // the last owner must see every other owner's reads completed
+    if (shared && shared->references.fetch_sub(1, std::memory_order_acq_rel) == 1) {
+        delete shared->msg;
+        delete shared;
+    }
+}
 
-        elif type == FieldDescriptor.TYPE_MESSAGE:
-            lines.append('return luaL_error(L, "to manipulate embedded messages, fetch the embedded message and modify it");')
+const ::google::protobuf::Message * lua_protobuf_shared_message(const lua_protobuf_shared *shared)
+{
+    return shared->msg;
+}
 
-        else:
-            lines.append('return luaL_error(L, "field type not yet supported");')
+// messages owned by any Lua state in the process
+static std::atomic<long long> accounted_messages(0);
+static std::atomic<long long> accounted_bytes(0);
 
-        lines.append('return 0;')
-    else:
-        # if they call set() with nil, we interpret as a clear
-        # this is the Lua way, after all
-        lines.extend([
-            'if (lua_isnil(L, 2)) {',
-                'm->clear_%s();' % name,
-                'return 0;',
-            '}',
-            '',
-        ])
+#define DEBT_REGISTRY_KEY "lua_protobuf.debt"
 
-        if type in [ FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES ]:
-            lines.extend([
-                'if (!lua_isstring(L, 2)) return luaL_error(L, "passed value is not a string");',
-                'size_t len;',
-                'const char *s = lua_tolstring(L, 2, &len);',
-                'if (!s) {',
-                    'luaL_error(L, "could not obtain string on stack. weird");',
-                '}',
-                'm->set_%s(s, len);' % name,
-                'return 0;',
-            ])
+// the most growth in KB reported to the collector in one step. the work of a
+// step grows with its size, and a step larger than the heap runs a whole
+// collection cycle
+#ifndef LUA_PROTOBUF_GC_STEP_LIMIT
+#define LUA_PROTOBUF_GC_STEP_LIMIT 1024
+#endif
 
-        elif type in [ FieldDescriptor.TYPE_DOUBLE, FieldDescriptor.TYPE_FLOAT ]:
-            lines.extend([
-                'if (!lua_isnumber(L, 2)) return luaL_error(L, "passed value cannot be converted to a number");',
-                'lua_Number n = lua_tonumber(L, 2);',
-                'm->set_%s(n);' % name,
-                'return 0;',
-            ])
+static void report_growth(lua_State *L, size_t bytes)
+{
+    // growth smaller than the 1KB granularity of collector steps is carried
+    // over, and so is growth beyond the step limit, which later steps work
+    // off. each state has its own, in a userdata in the registry
+    lua_getfield(L, LUA_REGISTRYINDEX, DEBT_REGISTRY_KEY);
+    size_t *debt = (size_t *)lua_touserdata(L, -1);
+    lua_pop(L, 1);
+    if (!debt) {
+        debt = (size_t *)lua_newuserdata(L, sizeof(size_t));
+        *debt = 0;
+        lua_setfield(L, LUA_REGISTRYINDEX, DEBT_REGISTRY_KEY);
+    }
+
+    *debt += bytes;
+    if (*debt >= 1024) {
+        size_t steps = *debt >> 10;
+        if (steps > LUA_PROTOBUF_GC_STEP_LIMIT) {
+            steps = LUA_PROTOBUF_GC_STEP_LIMIT;
+        }
+        *debt -= steps << 10;
+        lua_gc(L, LUA_GCSTEP, (int)steps);
+    }
+}
 
-        elif type in [ FieldDescriptor.TYPE_INT32, FieldDescriptor.TYPE_FIXED32,
-            FieldDescriptor.TYPE_UINT32, FieldDescriptor.TYPE_SFIXED32, FieldDescriptor.TYPE_SINT32 ]:
+void lua_protobuf_account(lua_State *L, size_t *accounted, const ::google::protobuf::Message *msg, const lua_protobuf_lazy *lazy, size_t estimate)
+{
+#ifdef LUA_PROTOBUF_MEASURE_MEMORY
+    size_t size = msg->SpaceUsedLong();
+    if (lazy) {
+        for (std::map<int, std::string>::const_iterator i = lazy->fields.begin(); i != lazy->fields.end(); ++i) {
+            size += i->second.capacity();
+        }
+    }
+#else
+    // the data a message was parsed from includes its lazy fields
+    size_t size = estimate;
+    if (!size) {
+        size = msg->ByteSizeLong();
+        if (lazy) {
+            for (std::map<int, std::string>::const_iterator i = lazy->fields.begin(); i != lazy->fields.end(); ++i) {
+                size += i->second.size();
+            }
+        }
+    }
+
+    // the C++ object takes memory even if it is empty
+    size += sizeof(::google::protobuf::Message);
+#endif
 
-            lines.extend([
-                'lua_Integer v = luaL_checkinteger(L, 2);',
-                'm->set_%s(v);' % name,
-                'return 0;',
-            ])
+    if (!*accounted) {
+        accounted_messages++;
+    }
+    accounted_bytes += (long long)size - (long long)*accounted;
 
-        elif type in [ FieldDescriptor.TYPE_INT64, FieldDescriptor.TYPE_UINT64,
-            FieldDescriptor.TYPE_FIXED64, FieldDescriptor.TYPE_SFIXED64, FieldDescriptor.TYPE_SINT64]:
+    if (size > *accounted) {
+        report_growth(L, size - *accounted);
+    }
+    *accounted = size;
+}
 
-            lines.extend([
-                'lua_Integer i = luaL_checkinteger(L, 2);',
-                'm->set_%s(i);' % name,
-                'return 0;',
-            ])
+void lua_protobuf_account_growth(lua_State *L, size_t *accounted, size_t bytes)
+{
+    if (*accounted) {
+        *accounted += bytes;
+        accounted_bytes += (long long)bytes;
+        report_growth(L, bytes);
+    }
+}
 
-        elif type == FieldDescriptor.TYPE_BOOL:
-            lines.extend([
-                'bool b = lua_toboolean(L, 2);',
-                'm->set_%s(b);' % name,
-                'return 0;',
-            ])
+void lua_protobuf_unaccount(size_t *accounted)
+{
+    if (*accounted) {
+        accounted_messages--;
+        accounted_bytes -= (long long)*accounted;
+        *accounted = 0;
+    }
+}
 
-        elif type == FieldDescriptor.TYPE_ENUM:
-            lines.extend([
-                'lua_Integer i = luaL_checkinteger(L, 2);',
-                'm->set_%s((%s)i);' % ( name, type_name.replace('.', '::') ),
-                'return 0;',
-            ])
+#define TYPES_REGISTRY_KEY "lua_protobuf.types"
 
-        elif type == FieldDescriptor.TYPE_MESSAGE:
-            lines.append('return luaL_error(L, "to manipulate embedded messages, obtain the embedded message and manipulate it");')
+// pushes the table of registered types, keyed by full name and by id
+static void push_types(lua_State *L)
+{
+    lua_getfield(L, LUA_REGISTRYINDEX, TYPES_REGISTRY_KEY);
+    if (lua_isnil(L, -1)) {
+        lua_pop(L, 1);
+        lua_newtable(L);
+        lua_pushvalue(L, -1);
+        lua_setfield(L, LUA_REGISTRYINDEX, TYPES_REGISTRY_KEY);
+    }
+}
 
-        else:
-            lines.append('return luaL_error(L, "field type is not yet supported");')
+void lua_protobuf_register_type(lua_State *L, const lua_protobuf_type *type)
+{
+    push_types(L);
+
+    lua_pushnumber(L, (lua_Number)type->id);
+    lua_rawget(L, -2);
+    const lua_protobuf_type *existing = (const lua_protobuf_type *)lua_touserdata(L, -1);
+    lua_pop(L, 1);
+    if (existing && strcmp(existing->full_name, type->full_name)) {
+        luaL_error(L, "message types %s and %s have the same id", existing->full_name, type->full_name);
+        return;
+    }
+
+    lua_pushstring(L, type->full_name);
+    lua_pushlightuserdata(L, (void *)type);
+    lua_rawset(L, -3);
+    lua_pushnumber(L, (lua_Number)type->id);
+    lua_pushlightuserdata(L, (void *)type);
+    lua_rawset(L, -3);
+    lua_pop(L, 1);
+}
 
-    lines.append('}\n')
+// finds the type named by the full name or id at index
+// type URLs, as found in google.protobuf.Any, are accepted as well
+static const lua_protobuf_type * find_type(lua_State *L, int index)
+{
+    push_types(L);
+
+    if (lua_type(L, index) == LUA_TNUMBER) {
+        lua_pushvalue(L, index);
+    }
+    else {
+        size_t len;
+        const char *name = luaL_checklstring(L, index, &len);
+        const char *slash = strrchr(name, '/');
+        if (slash) {
+            lua_pushstring(L, slash + 1);
+        }
+        else {
+            lua_pushvalue(L, index);
+        }
+    }
+
+    lua_rawget(L, -2);
+    const lua_protobuf_type *type = (const lua_protobuf_type *)lua_touserdata(L, -1);
+    lua_pop(L, 2);
+    return type;
+}
 
-    return lines
+static const lua_protobuf_type * check_type(lua_State *L, int index)
+{
+    const lua_protobuf_type *type = find_type(L, index);
+    if (!type) {
+        lua_pushvalue(L, index);
+        luaL_error(L, "unknown message type: %s", lua_tostring(L, -1));
+    }
+    return type;
+}
 
-def new_message(package, message):
-    '''Returns function definition for creating a new protocol buffer message'''
+// returns the library, full name and id of a type, or nil if it is unknown
+static int lookup(lua_State *L)
+{
+    const lua_protobuf_type *type = find_type(L, 1);
+    if (!type) {
+        lua_pushnil(L);
+        return 1;
+    }
+
+    lua_getfield(L, LUA_REGISTRYINDEX, "_LOADED");
+    lua_getfield(L, -1, type->libname);
+    lua_pushstring(L, type->full_name);
+    lua_pushnumber(L, (lua_Number)type->id);
+    return 3;
+}
 
-    lines = []
+static int new_message(lua_State *L)
+{
+    const lua_protobuf_type *type = check_type(L, 1);
+    lua_settop(L, 0);
+    return type->new_message(L);
+}
 
-    lines.append('int %snew(lua_State *L)' % message_function_prefix(package, message))
-    lines.append('{')
+static int parse(lua_State *L)
+{
+    const lua_protobuf_type *type = check_type(L, 1);
+    luaL_checkstring(L, 2);
+    lua_settop(L, 2);
+    lua_remove(L, 1);
+    return type->parsefromstring(L);
+}
 
-    c = cpp_class(package, message)
-    lines.append('msg_udata * ud = (msg_udata *)lua_newuserdata(L, sizeof(msg_udata));')
+#ifdef LUA_PROTOBUF_STATS
 
-    lines.append('ud->lua_owns = true;')
-    lines.append('ud->msg = new %s();' % c)
-    lines.append('ud->gc_callback = NULL;')
-    lines.append('ud->callback_data = NULL;')
+typedef struct stats_block {
+    const lua_protobuf_stats_type *type;
+    size_t size;
+    lua_protobuf_counter *counters;
+} stats_block;
 
-    lines.append('luaL_getmetatable(L, "%s");' % metatable(package, message))
-    lines.append('lua_setmetatable(L, -2);')
-    lines.append('return 1;')
+static size_t stats_size(const lua_protobuf_stats_type *type)
+{
+    size_t size = LUA_PROTOBUF_STATS_FUNCTIONS;
+    while (type->functions[size - LUA_PROTOBUF_STATS_FUNCTIONS]) {
+        size++;
+    }
+    return size;
+}
 
-    lines.append('}\n')
+// guards the lists below, not the counters, which are atomic
+static std::mutex stats_mutex;
 
-    return lines
+// counters of all threads that are running
+static std::vector<stats_block *> stats_blocks;
 
-def message_pushcopy_function(package, message):
-    '''Returns function definition for pushing a copy of a message to the stack'''
+// what is added to the counters of running threads to obtain the totals
+// holds the counts of threads that exited, minus the totals at the last reset
+static std::map<const lua_protobuf_stats_type *, std::vector<long long> > stats_offsets;
 
-    return [
-        'bool %spushcopy(lua_State *L, const %s &from)' % ( message_function_prefix(package, message), cpp_class(package, message) ),
-        '{',
-        'msg_udata * ud = (msg_udata *)lua_newuserdata(L, sizeof(msg_udata));',
-        'ud->lua_owns = true;',
-        'ud->msg = new %s(from);' % cpp_class(package, message),
-        'ud->gc_callback = NULL;',
-        'ud->callback_data = NULL;',
-        'luaL_getmetatable(L, "%s");' % metatable(package, message),
-        'lua_setmetatable(L, -2);',
-        'return true;',
+static std::vector<long long> & stats_offset(const lua_protobuf_stats_type *type, size_t size)
+{
+    std::vector<long long> &offset = stats_offsets[type];
+    offset.resize(size, 0);
+    return offset;
+}
+
+// the counters of a thread, which are handed over when it exits
+struct thread_stats {
+    std::vector<stats_block *> blocks;
+
+    ~thread_stats()
+    {
+        std::lock_guard<std::mutex> lock(stats_mutex);
+        for (size_t i = 0; i < blocks.size(); i++) {
+            stats_block *block = blocks[i];
+            std::vector<long long> &offset = stats_offset(block->type, block->size);
+            for (size_t j = 0; j < block->size; j++) {
+                offset[j] += (long long)block->counters[j].load(std::memory_order_relaxed);
+            }
+
+            for (size_t j = 0; j < stats_blocks.size(); j++) {
+                if (stats_blocks[j] == block) {
+                    stats_blocks.erase(stats_blocks.begin() + j);
+                    break;
+                }
+            }
+
+            delete [] block->counters;
+            delete block;
+        }
+    }
+};
+
+static thread_local thread_stats this_thread_stats;
+
+lua_protobuf_counter * lua_protobuf_stats_counters(const lua_protobuf_stats_type *type)
+{
+    stats_block *block = new stats_block;
+    block->type = type;
+    block->size = stats_size(type);
+    block->counters = new lua_protobuf_counter[block->size];
+    for (size_t i = 0; i < block->size; i++) {
+        block->counters[i].store(0, std::memory_order_relaxed);
+    }
+
+    this_thread_stats.blocks.push_back(block);
+    std::lock_guard<std::mutex> lock(stats_mutex);
+    stats_blocks.push_back(block);
+    return block->counters;
+}
+
+// returns the totals of all message types that were counted
+static std::map<const lua_protobuf_stats_type *, std::vector<long long> > stats_totals()
+{
+    std::map<const lua_protobuf_stats_type *, std::vector<long long> > totals(stats_offsets);
+    for (size_t i = 0; i < stats_blocks.size(); i++) {
+        stats_block *block = stats_blocks[i];
+        std::vector<long long> &total = totals[block->type];
+        total.resize(block->size, 0);
+        for (size_t j = 0; j < block->size; j++) {
+            total[j] += (long long)block->counters[j].load(std::memory_order_relaxed);
+        }
+    }
+    return totals;
+}
+
+// returns a table of counters, keyed by message type name
+// the counters are reset afterwards if the argument is true
+static int stats(lua_State *L)
+{
+    bool reset = lua_toboolean(L, 1);
+
+    std::map<const lua_protobuf_stats_type *, std::vector<long long> > totals;
+    {
+        std::lock_guard<std::mutex> lock(stats_mutex);
+        totals = stats_totals();
+        if (reset) {
+            std::map<const lua_protobuf_stats_type *, std::vector<long long> >::iterator i;
+            for (i = totals.begin(); i != totals.end(); ++i) {
+                std::vector<long long> &offset = stats_offset(i->first, i->second.size());
+                for (size_t j = 0; j < i->second.size(); j++) {
+                    offset[j] -= i->second[j];
+                }
+            }
+        }
+    }
+
+    lua_createtable(L, 0, (int)totals.size());
+    std::map<const lua_protobuf_stats_type *, std::vector<long long> >::iterator i;
+    for (i = totals.begin(); i != totals.end(); ++i) {
+        const std::vector<long long> &total = i->second;
+
+        lua_createtable(L, 0, 3);
+        lua_pushnumber(L, (lua_Number)total[LUA_PROTOBUF_STATS_PARSED]);
+        lua_setfield(L, -2, "parsed_bytes");
+        lua_pushnumber(L, (lua_Number)total[LUA_PROTOBUF_STATS_SERIALIZED]);
+        lua_setfield(L, -2, "serialized_bytes");
+
+        lua_newtable(L);
+        for (size_t j = LUA_PROTOBUF_STATS_FUNCTIONS; j < total.size(); j++) {
+            if (total[j]) {
+                lua_pushnumber(L, (lua_Number)total[j]);
+                lua_setfield(L, -2, i->first->functions[j - LUA_PROTOBUF_STATS_FUNCTIONS]);
+            }
+        }
+        lua_setfield(L, -2, "calls");
+
+        lua_setfield(L, -2, i->first->full_name);
+    }
+    return 1;
+}
+
+#endif
+
+static int memstats(lua_State *L)
+{
+    lua_createtable(L, 0, 2);
+    lua_pushnumber(L, (lua_Number)accounted_messages);
+    lua_setfield(L, -2, "messages");
+    lua_pushnumber(L, (lua_Number)accounted_bytes);
+    lua_setfield(L, -2, "bytes");
+    return 1;
+}
+
+int lua_protobuf_open(lua_State *L)
+{
+    static const struct luaL_Reg functions [] = {
+        {"memstats", memstats},
+        {"lookup", lookup},
+        {"new", new_message},
+        {"parse", parse},
+#ifdef LUA_PROTOBUF_STATS
+        {"stats", stats},
+#endif
+        {NULL, NULL},
+    };
+    luaL_register(L, "protobuf", functions);
+    return 1;
+}
+
+#ifdef LUA_PROTOBUF_ASYNC
+
+#ifndef LUA_PROTOBUF_ASYNC_THREADS
+#define LUA_PROTOBUF_ASYNC_THREADS 4
+#endif
+
+#define ASYNC_METATABLE "lua_protobuf.async"
+
+typedef struct lua_protobuf_async_job {
+    // parse jobs read input into msg. serialize jobs write msg into output
+    bool serialize;
+    std::string input;
+    ::google::protobuf::Message *msg;
+    lua_protobuf_push_owned push;
+    std::string output;
+    bool ok;
+    std::atomic<bool> done;
+    // the worker, the handle and, for serialize jobs, the message hold the
+    // job. guarded by the mutex of the pool. the last one deletes the job
+    int holders;
+} async_job;
+
+// what Lua sees of a job
+typedef struct async_handle {
+    async_job *job;
+    // registry references to the message serialized and to the result
+    int anchor;
+    int result;
+} async_handle;
+
+static void delete_async_job(async_job *job)
+{
+    if (!job->serialize) {
+        delete job->msg;
+    }
+    delete job;
+}
+
+// the workers are detached and the pool is never destroyed, so nothing
+// waits for the workers when the process exits
+class AsyncPool {
+  public:
+    AsyncPool() {
+        for (int i = 0; i < LUA_PROTOBUF_ASYNC_THREADS; i++) {
+            std::thread(&AsyncPool::run, this).detach();
+        }
+    }
+
+    void submit(async_job *job) {
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            jobs.push_back(job);
+        }
+        work.notify_one();
+    }
+
+    void wait(async_job *job) {
+        std::unique_lock<std::mutex> lock(mutex);
+        while (!job->done) {
+            finished.wait(lock);
+        }
+    }
+
+    // drops a hold on the job, which is deleted once nobody holds it
+    void release(async_job *job) {
+        bool last;
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            last = --job->holders == 0;
+        }
+        if (last) {
+            delete_async_job(job);
+        }
+    }
+
+  private:
+    void run() {
+        while (true) {
+            async_job *job;
+            {
+                std::unique_lock<std::mutex> lock(mutex);
+                while (jobs.empty()) {
+                    work.wait(lock);
+                }
+                job = jobs.front();
+                jobs.pop_front();
+            }
+
+            if (job->serialize) {
+                job->ok = job->msg->SerializeToString(&job->output);
+            }
+            else {
+                job->ok = job->msg->ParseFromString(job->input);
+            }
+
+            // the job belongs to Lua again once it is marked as done. if its
+            // handle was collected in the meantime, nobody else holds it
+            bool last;
+            {
+                std::lock_guard<std::mutex> lock(mutex);
+                job->done = true;
+                last = --job->holders == 0;
+            }
+            finished.notify_all();
+            if (last) {
+                delete_async_job(job);
+            }
+        }
+    }
+
+    std::mutex mutex;
+    std::condition_variable work;
+    std::condition_variable finished;
+    std::deque<async_job *> jobs;
+};
+
+static AsyncPool * async_pool()
+{
+    static AsyncPool *pool = new AsyncPool();
+    return pool;
+}
+
+static async_handle * check_async_handle(lua_State *L)
+{
+    return (async_handle *)luaL_checkudata(L, 1, ASYNC_METATABLE);
+}
+
+static int async_done(lua_State *L)
+{
+    async_handle *handle = check_async_handle(L);
+    lua_pushboolean(L, handle->job->done);
+    return 1;
+}
+
+static int async_wait(lua_State *L)
+{
+    async_handle *handle = check_async_handle(L);
+    async_pool()->wait(handle->job);
+    return 0;
+}
+
+static int async_result(lua_State *L)
+{
+    async_handle *handle = check_async_handle(L);
+    async_job *job = handle->job;
+    async_pool()->wait(job);
+
+    if (!job->ok) {
+        return luaL_error(L, job->serialize ? "error serializing message" : "error deserializing message");
+    }
+
+    if (job->serialize) {
+        lua_pushlstring(L, job->output.c_str(), job->output.size());
+        return 1;
+    }
+
+    // the message is handed to Lua the first time, and the same userdata is
+    // returned after that
+    if (handle->result == LUA_NOREF) {
+        job->push(L, job->msg);
+        job->msg = NULL;
+        lua_pushvalue(L, -1);
+        handle->result = luaL_ref(L, LUA_REGISTRYINDEX);
+        return 1;
+    }
+
+    lua_rawgeti(L, LUA_REGISTRYINDEX, handle->result);
+    return 1;
+}
+
+static int async_gc(lua_State *L)
+{
+    async_handle *handle = check_async_handle(L);
+    async_job *job = handle->job;
+    if (!job) {
+        return 0;
+    }
+
+    // a running job is left to the worker, which deletes it when it is done.
+    // a message being serialized waits for the job before it is deleted
+    luaL_unref(L, LUA_REGISTRYINDEX, handle->anchor);
+    luaL_unref(L, LUA_REGISTRYINDEX, handle->result);
+    async_pool()->release(job);
+    handle->job = NULL;
+
+    return 0;
+}
+
+static async_handle * push_async_handle(lua_State *L, async_job *job, int index)
+{
+    async_handle *handle = (async_handle *)lua_newuserdata(L, sizeof(async_handle));
+    handle->job = job;
+    handle->anchor = LUA_NOREF;
+    handle->result = LUA_NOREF;
+
+    if (luaL_newmetatable(L, ASYNC_METATABLE)) {
+        static const struct luaL_Reg methods [] = {
+            {"done", async_done},
+            {"wait", async_wait},
+            {"result", async_result},
+            {NULL, NULL},
+        };
+        lua_pushvalue(L, -1);
+        lua_setfield(L, -2, "__index");
+        lua_pushcfunction(L, async_gc);
+        lua_setfield(L, -2, "__gc");
+        luaL_register(L, NULL, methods);
+    }
+    lua_setmetatable(L, -2);
+
+    if (index) {
+        lua_pushvalue(L, index);
+        handle->anchor = luaL_ref(L, LUA_REGISTRYINDEX);
+    }
+
+    return handle;
+}
+
+void lua_protobuf_parse_async(lua_State *L, int index, ::google::protobuf::Message *msg, lua_protobuf_push_owned push)
+{
+    size_t len = 0;
+    const char *data = lua_tolstring(L, index, &len);
+    if (!data || len > INT_MAX) {
+        delete msg;
+        luaL_error(L, data ? "message is too large" : "parse_async() requires a string argument");
+    }
+
+    // the input is copied, so the job does not depend on the Lua state and
+    // can outlive its handle
+    async_job *job = new async_job();
+    job->serialize = false;
+    job->input.assign(data, len);
+    job->msg = msg;
+    job->push = push;
+    job->ok = false;
+    job->done = false;
+    job->holders = 2;
+
+    push_async_handle(L, job, 0);
+    async_pool()->submit(job);
+}
+
+void lua_protobuf_serialize_async(lua_State *L, int index, const ::google::protobuf::Message *msg, lua_protobuf_async_job **busy)
+{
+    async_job *job = new async_job();
+    job->serialize = true;
+    job->msg = const_cast< ::google::protobuf::Message *>(msg);
+    job->push = NULL;
+    job->ok = false;
+    job->done = false;
+    job->holders = 3;
+
+    // the handle anchors the userdata holding the message
+    push_async_handle(L, job, index);
+    *busy = job;
+    async_pool()->submit(job);
+}
+
+bool lua_protobuf_async_busy(lua_protobuf_async_job **busy, bool wait)
+{
+    async_job *job = *busy;
+    if (wait) {
+        async_pool()->wait(job);
+    }
+    else if (!job->done) {
+        return true;
+    }
+
+    *busy = NULL;
+    async_pool()->release(job);
+    return false;
+}
+
+#endif
+
+static bool write_delimited(::google::protobuf::io::ZeroCopyOutputStream *stream, const ::google::protobuf::Message &msg)
+{
+    CodedOutputStream output(stream);
+    size_t size = msg.ByteSizeLong();
+    output.WriteVarint32(size);
+    msg.SerializeWithCachedSizes(&output);
+    return !output.HadError();
+}
+
+#ifdef LUA_PROTOBUF_GZIP
+static bool write_compressed(::google::protobuf::io::ZeroCopyOutputStream *stream, const ::google::protobuf::Message &msg, int level, bool delimited)
+{
+    ::google::protobuf::io::GzipOutputStream::Options options;
+    options.format = ::google::protobuf::io::GzipOutputStream::GZIP;
+    options.compression_level = level;
+
+    ::google::protobuf::io::GzipOutputStream gzip(stream, options);
+    bool ok = delimited ? write_delimited(&gzip, msg) : msg.SerializeToZeroCopyStream(&gzip);
+    return gzip.Close() && ok;
+}
+#endif
+
+// writes to the file handle at index, or pushes a string if index is 0
+// level is the compression level, or NO_COMPRESSION
+#define NO_COMPRESSION -2
+
+static int write_delimited_to(lua_State *L, int index, const ::google::protobuf::Message &msg, int level)
+{
+    bool ok;
+#ifndef LUA_PROTOBUF_GZIP
+    (void)level;
+#endif
+
+    if (!index) {
+        std::string s;
+        {
+            StringOutputStream stream(&s);
+#ifdef LUA_PROTOBUF_GZIP
+            ok = level == NO_COMPRESSION ? write_delimited(&stream, msg) : write_compressed(&stream, msg, level, true);
+#else
+            ok = write_delimited(&stream, msg);
+#endif
+        }
+        if (ok) {
+            lua_pushlstring(L, s.c_str(), s.size());
+            return 1;
+        }
+    }
+    else {
+        FILE **f = (FILE **)luaL_checkudata(L, index, LUA_FILEHANDLE);
+        if (!*f) {
+            return luaL_error(L, "attempt to use a closed file");
+        }
+
+        {
+            FileOutputStream file(*f);
+            CopyingOutputStreamAdaptor stream(&file);
+#ifdef LUA_PROTOBUF_GZIP
+            ok = level == NO_COMPRESSION ? write_delimited(&stream, msg) : write_compressed(&stream, msg, level, true);
+#else
+            ok = write_delimited(&stream, msg);
+#endif
+            ok = ok && stream.Flush();
+        }
+        if (ok) {
+            return 0;
+        }
+    }
+
+    return luaL_error(L, "error serializing message");
+}
+
+int lua_protobuf_write_delimited(lua_State *L, int index, const ::google::protobuf::Message &msg)
+{
+    return write_delimited_to(L, index, msg, NO_COMPRESSION);
+}
+
+#ifdef LUA_PROTOBUF_GZIP
+static void check_compression_level(lua_State *L, int level)
+{
+    if (level < -1 || level > 9) {
+        luaL_error(L, "compression level must be between 0 and 9");
+    }
+}
+
+int lua_protobuf_write_delimited_compressed(lua_State *L, int index, const ::google::protobuf::Message &msg, int level)
+{
+    check_compression_level(L, level);
+    return write_delimited_to(L, index, msg, level);
+}
+
+int lua_protobuf_serialize_compressed(lua_State *L, const ::google::protobuf::Message &msg, int level)
+{
+    check_compression_level(L, level);
+
+    bool ok;
+    {
+        std::string s;
+        {
+            StringOutputStream stream(&s);
+            ok = write_compressed(&stream, msg, level, false);
+        }
+        if (ok) {
+            lua_pushlstring(L, s.data(), s.size());
+        }
+    }
+    if (!ok) {
+        return luaL_error(L, "error serializing message");
+    }
+
+    return 1;
+}
+
+void lua_protobuf_parse_compressed(lua_State *L, int index, ::google::protobuf::Message *msg)
+{
+    size_t len;
+    const char *s = luaL_checklstring(L, index, &len);
+
+    bool ok;
+    {
+        MemoryInputStream stream(s, len);
+        ::google::protobuf::io::GzipInputStream gzip(&stream, ::google::protobuf::io::GzipInputStream::GZIP);
+        ok = msg->ParseFromZeroCopyStream(&gzip);
+    }
+    if (!ok) {
+        luaL_error(L, "error deserializing message");
+    }
+}
+
+void lua_protobuf_delimited_reader_decompress(lua_protobuf_delimited_reader *reader)
+{
+    reader->compressed = reader->stream;
+    reader->stream = new ::google::protobuf::io::GzipInputStream(reader->compressed, ::google::protobuf::io::GzipInputStream::GZIP);
+}
+#endif
+
+'''
+
+def c_header_header(filename, package, dependencies=[]):
+    lines = [
+        '// Generated by the lua-protobuf compiler.',
+        '// You shouldn\'t be editing this file manually',
+        '//',
+        '// source proto file: %s' % filename,
+        '',
+        '#ifndef LUA_PROTOBUF_%s_H' % filename[:-len('.proto')],
+        '#define LUA_PROTOBUF_%s_H' % filename[:-len('.proto')],
+        '',
+        '#include "lua-protobuf.h"',
+        '#include <%s.pb.h>' % filename[:-len('.proto')],
+    ]
+
+    # embedded messages may be defined in other files
+    for dependency in dependencies:
+        lines.append('#include "%s.pb-lua.h"' % dependency[:-len('.proto')])
+
+    lines.extend([
+        '',
+        '#ifdef __cplusplus',
+        'extern "C" {',
+        '#endif',
+        '',
+        '#include <lua.h>',
+        '',
+        '// register all messages in this package to a Lua state',
+        'LUA_PROTOBUF_EXPORT int %sopen(lua_State *L);' % package_function_prefix(package),
+        '',
+    ])
+
+    return lines
+
+def source_header(filename, package):
+    '''Returns lines that begin a source file'''
+    return [
+        '// Generated by the lua-protobuf compiler',
+        '// You shouldn\'t edit this file manually',
+        '//',
+        '// source proto file: %s' % filename,
+        '',
+        '#include "%s.pb-lua.h"' % filename[:-len('.proto')],
+        '',
+        '#ifdef __cplusplus',
+        'extern "C" { // make sure functions treated with C naming',
+        '#endif',
+        '',
+        '#include <lauxlib.h>',
+        '',
+        '#ifdef __cplusplus',
+        '}',
+        '#endif',
+        '',
+        '#include <new>',
+        '#include <string>',
+        '',
+        '// this represents Lua udata for a protocol buffer message',
+        '// we record where a message came from so we can GC it properly',
+        'typedef struct msg_udata { // confuse over-simplified pretty-printer',
+        '    ::google::protobuf::Message * msg;',
+        '    bool lua_owns;',
+        '    lua_protobuf_gc_callback gc_callback;',
+        '    void * callback_data;',
+        '    // embedded messages which have not been parsed yet',
+        '    lua_protobuf_lazy * lazy;',
+        '    // set if the message is frozen. the udata holds a reference',
+        '    lua_protobuf_shared * shared;',
+        '    // memory reported for the message while Lua owns it',
+        '    size_t accounted;',
+        '    // for references to embedded messages, the udata they were obtained',
+        '    // from, which is kept alive through a registry reference',
+        '    struct msg_udata * parent;',
+        '    int parent_ref;',
+        '    // set once the message was wrapped by the LuaJIT FFI bindings, which',
+        '    // write to it without going through the udata',
+        '    bool wrapped;',
+        '    // incremented whenever the message may be modified, which invalidates',
+        '    // the string views into it. only the root of references counts',
+        '    unsigned int generation;',
+        '    // a job of the worker pool serializing the message, only set on the',
+        '    // root of references',
+        '    lua_protobuf_async_job * busy;',
+        '} msg_udata;',
+        '',
+        '// with LUA_PROTOBUF_INLINE_MESSAGES, messages created by Lua are constructed',
+        '// in the same block, right after the msg_udata',
+        '#define MSG_UDATA_INLINE(ud) ((void *)((msg_udata *)(ud) + 1))',
+        '',
+        '// makes the reference on top of the stack keep the udata at index alive, as',
+        '// its message lies inside of the message of that udata',
+        'static inline void msg_udata_anchor(lua_State *L, int index)',
+        '{',
+        '    msg_udata * ud = (msg_udata *)lua_touserdata(L, -1);',
+        '    ud->parent = (msg_udata *)lua_touserdata(L, index);',
+        '    lua_pushvalue(L, index);',
+        '    ud->parent_ref = luaL_ref(L, LUA_REGISTRYINDEX);',
+        '}',
+        '',
+        '// returns the udata whose message contains the message of ud',
+        '// its state, such as whether it is frozen, applies to all references into it',
+        'static inline msg_udata * msg_udata_root(msg_udata *ud)',
+        '{',
+        '    while (ud->parent) {',
+        '        ud = ud->parent;',
+        '    }',
+        '    return ud;',
+        '}',
+        '',
+        'static inline bool msg_udata_frozen(msg_udata *ud)',
+        '{',
+        '    return msg_udata_root(ud)->shared != NULL;',
+        '}',
+        '',
+        '// waits for a job serializing the message of ud, if there is one. only',
+        '// one thread at a time may serialize a message, as that writes the sizes',
+        '// cached in it',
+        'static inline void msg_udata_wait(msg_udata *ud)',
+        '{',
+        '#ifdef LUA_PROTOBUF_ASYNC',
+        '    msg_udata * root = msg_udata_root(ud);',
+        '    if (root->busy) {',
+        '        lua_protobuf_async_busy(&root->busy, true);',
+        '    }',
+        '#else',
+        '    (void)ud;',
+        '#endif',
+        '}',
+        '',
+        '// whether the message of ud may only be read, as it is frozen or a job is',
+        '// serializing it',
+        'static inline bool msg_udata_readonly(msg_udata *ud)',
+        '{',
+        '    msg_udata * root = msg_udata_root(ud);',
+        '#ifdef LUA_PROTOBUF_ASYNC',
+        '    if (root->busy && lua_protobuf_async_busy(&root->busy, false)) {',
+        '        return true;',
+        '    }',
+        '#endif',
+        '    return root->shared != NULL;',
+        '}',
+        '',
+        '// checks that the message of ud may be modified and records that it will',
+        '// be, which invalidates the string views into it. waits for a job',
+        '// serializing the message first. returns false if the message is frozen',
+        'static inline bool msg_udata_modify(msg_udata *ud)',
+        '{',
+        '    msg_udata * root = msg_udata_root(ud);',
+        '    if (root->shared) {',
+        '        return false;',
+        '    }',
+        '    msg_udata_wait(root);',
+        '    root->generation++;',
+        '    return true;',
+        '}',
+        '',
+        '// whether the message of ud is msg or lies inside of it, as far as the',
+        '// references ud was obtained through tell',
+        'static inline bool msg_udata_inside(const msg_udata *ud, const ::google::protobuf::Message *msg)',
+        '{',
+        '    for (; ud; ud = ud->parent) {',
+        '        if (ud->msg == msg) {',
+        '            return true;',
+        '        }',
+        '    }',
+        '    return false;',
+        '}',
+        '',
+    ]
+
+def package_function_prefix(package):
+    return 'lua_protobuf_%s_' % package.replace('.', '_')
+
+def message_function_prefix(package, message):
+    return '%s%s_' % (package_function_prefix(package), message)
+
+def message_fields_name(type_name):
+    '''Returns the name of the field table for a message type'''
+
+    return 'lua_protobuf%s_fields' % type_name.replace('.', '_')
+
+def message_open_function_name(package, message):
+    '''Returns function name that registers the Lua library for a message type'''
+
+    return '%sopen' % message_function_prefix(package, message)
+
+def cpp_class(package, message = None):
+    '''Returns the fully qualified class name for a message type'''
+
+    if not message:
+        return package.replace('.', '::')
+
+    return '::%s::%s' % ( package.replace('.', '::'), message )
+
+def field_function_name(package, message, prefix, field):
+    '''Obtain the function name of a field accessor/mutator function'''
+
+    return '%s%s_%s' % ( message_function_prefix(package, message), prefix, field )
+
+def field_function_start(package, message, prefix, field):
+    '''Obtain the start of function for a field accessor function'''
+    return [
+        'int %s(lua_State *L)' % field_function_name(package, message, prefix, field),
+        '{',
+    ]
+
+def lua_libname(package, message):
+    '''Returns the Lua library name for a specific message'''
+
+    return 'protobuf.%s.%s' % (package, message)
+
+def metatable(package, message):
+    '''Returns Lua metatable for protocol buffer message type'''
+    return 'protobuf_.%s.%s' % (package, message)
+
+def split_type_name(type_name):
+    '''Returns the package and message of a fully qualified type name'''
+
+    return tuple(type_name[1:].rsplit('.', 1))
+
+def obtain_message_from_udata(package, message=None, index=1, varname='m', lazy_field=None, modifies=False):
+    '''Statement that obtains a message from userdata
+
+    If lazy_field is given, the stored wire format of that field is parsed
+    into the message first. If modifies is set, frozen messages raise an error.
+    '''
+
+    c = cpp_class(package, message)
+    lines = [
+        'msg_udata * %sud = (msg_udata *)%s;' % ( varname, check_udata(package, message, index) ),
+        '%s *%s = (%s *)%sud->msg;' % ( c, varname, c, varname ),
+    ]
+
+    if modifies:
+        lines.extend([
+            'if (!msg_udata_modify(%sud)) {' % varname,
+                'return luaL_error(L, "message is frozen");',
+            '}',
+        ])
+
+    if lazy_field:
+        lines.extend([
+            'if (!lua_protobuf_lazy_materialize(%s, &%sud->lazy, %d)) {' % ( varname, varname, lazy_field.number ),
+                'return luaL_error(L, "error deserializing lazy field %s");' % lazy_field.name,
+            '}',
+        ])
+
+    return lines
+
+def is_lazy(field_descriptor):
+    '''Whether a field is parsed on first access
+
+    This is requested with the lazy option on embedded message fields. Required
+    fields are always parsed, so missing ones are noticed right away.
+    '''
+
+    return field_descriptor.type == FieldDescriptor.TYPE_MESSAGE and \
+        field_descriptor.label != FieldDescriptor.LABEL_REQUIRED and \
+        field_descriptor.options.lazy
+
+def lazy_fields(descriptor):
+    '''Returns the fields of a message that are parsed on first access'''
+
+    return [ fd for fd in descriptor.field if is_lazy(fd) ]
+
+def check_udata(package, message, index=1):
+    '''Validates a udata is instance of protocol buffer message
+
+    By default, it validates udata at top of the stack
+    '''
+
+    return 'luaL_checkudata(L, %d, "%s")' % ( index, metatable(package, message) )
+
+def has_body(package, message, field, lazy_field=None):
+    '''Returns the function body for a has_<field> function'''
+
+    lines = []
+    lines.extend(obtain_message_from_udata(package, message, lazy_field=lazy_field))
+    lines.append('lua_pushboolean(L, m->has_%s());' % field)
+    lines.append('return 1;')
+
+    return lines
+
+def clear_body(package, message, field, lazy_field=None):
+    '''Returns the function body for a clear_<field> function'''
+    lines = []
+    lines.extend(obtain_message_from_udata(package, message, lazy_field=lazy_field, modifies=True))
+    lines.append('m->clear_%s();' % field)
+    lines.append('return 0;')
+
+    return lines
+
+def size_body(package, message, field, lazy_field=None):
+    '''Returns the function body for a size_<field> function'''
+    lines = []
+    lines.extend(obtain_message_from_udata(package, message, lazy_field=lazy_field))
+    lines.append('int size = m->%s_size();' % field)
+    lines.append('lua_pushinteger(L, size);')
+    lines.append('return 1;')
+
+    return lines
+
+def add_body(package, message, field, type_name, lazy_field=None):
+    '''Returns the function body for the add_<field> function for repeated embedded messages'''
+    lines = []
+    lines.extend(obtain_message_from_udata(package, message, lazy_field=lazy_field, modifies=True))
+    lines.extend([
+        '%s *msg_new = m->add_%s();' % ( cpp_class(type_name), field ),
+
+        # since the message is allocated out of the containing message, Lua
+        # does not need to do GC, but the containing message must stay alive
+        'lua_protobuf%s_pushreference(L, msg_new, NULL, NULL);' % type_name.replace('.', '_'),
+        'msg_udata_anchor(L, 1);',
+        'return 1;',
+    ])
+
+    return lines
+
+def field_get(package, message, field_descriptor):
+    '''Returns function definition for a get_<field> function'''
+
+    name = field_descriptor.name
+    type = field_descriptor.type
+    type_name = field_descriptor.type_name
+    label = field_descriptor.label
+    repeated = label == FieldDescriptor.LABEL_REPEATED
+
+    lines = []
+    lines.extend(field_function_start(package, message, 'get', name))
+    lines.extend(obtain_message_from_udata(package, message, lazy_field=field_descriptor if is_lazy(field_descriptor) else None))
+
+    # the logic is significantly different depending on if the field is
+    # singular or repeated.
+    # for repeated, we have an argument which points to the numeric index to
+    # retrieve. in true Lua convention, we index starting from 1, which is
+    # different from protocol buffers, which indexes from 0
+
+    if repeated:
+        lines.extend([
+            'if (lua_gettop(L) != 2) {',
+                'return luaL_error(L, "missing required numeric argument");',
+            '}',
+            'lua_Integer index = luaL_checkinteger(L, 2);',
+            'if (index < 1 || index > m->%s_size()) {' % name,
+                # TODO is returning nil the more Lua way?
+                'return luaL_error(L, "index must be between 1 and current size: %%d", m->%s_size());' % name,
+            '}',
+        ])
+
+    # TODO float and double types are not equivalent. don't treat them as such
+    # TODO figure out how to support 64 bit integers properly
+
+    if repeated:
+        if type in [ FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES ]:
+            lines.extend([
+                'const string &s = m->%s(index - 1);' % name,
+                'lua_pushlstring(L, s.c_str(), s.size());',
+            ])
+        elif type == FieldDescriptor.TYPE_BOOL:
+            lines.append('lua_pushboolean(L, m->%s(index-1));' % name)
+
+        elif type in [FieldDescriptor.TYPE_INT32, FieldDescriptor.TYPE_UINT32,
+            FieldDescriptor.TYPE_FIXED32, FieldDescriptor.TYPE_SFIXED32, FieldDescriptor.TYPE_SINT32]:
+
+            lines.append('lua_pushinteger(L, m->%s(index-1));' % name)
+
+        elif type in [ FieldDescriptor.TYPE_INT64, FieldDescriptor.TYPE_UINT64,
+            FieldDescriptor.TYPE_FIXED64, FieldDescriptor.TYPE_SFIXED64, FieldDescriptor.TYPE_SINT64]:
+            lines.append('lua_pushinteger(L, m->%s(index-1));' % name)
+
+        elif type == FieldDescriptor.TYPE_FLOAT or type == FieldDescriptor.TYPE_DOUBLE:
+            lines.append('lua_pushnumber(L, m->%s(index-1));' % name)
+
+        elif type == FieldDescriptor.TYPE_ENUM:
+            lines.append('lua_pushnumber(L, m->%s(index-1));' % name)
+
+        elif type == FieldDescriptor.TYPE_MESSAGE:
+            lines.extend([
+                '%s * got_msg = msg_udata_readonly(mud) ? const_cast<%s *>(&m->%s(index-1)) : m->mutable_%s(index-1);' % ( type_name.replace('.', '::'), type_name.replace('.', '::'), name, name ),
+                'lua_protobuf%s_pushreference(L, got_msg, NULL, NULL);' % type_name.replace('.', '_'),
+                'msg_udata_anchor(L, 1);',
+            ])
+
+        else:
+            lines.append('return luaL_error(L, "lua-protobuf does not support this field type");')
+    else:
+        # for scalar fields, we push nil if the value is not defined
+        # this is the Lua way
+        if type == FieldDescriptor.TYPE_STRING or type == FieldDescriptor.TYPE_BYTES:
+            lines.append('const string &s = m->%s();' % name)
+            lines.append('m->has_%s() ? lua_pushlstring(L, s.c_str(), s.size()) : lua_pushnil(L);' % name)
+
+        elif type == FieldDescriptor.TYPE_BOOL:
+            lines.append('m->has_%s() ? lua_pushboolean(L, m->%s()) : lua_pushnil(L);' % ( name, name ))
+
+        elif type in [FieldDescriptor.TYPE_INT32, FieldDescriptor.TYPE_UINT32,
+            FieldDescriptor.TYPE_FIXED32, FieldDescriptor.TYPE_SFIXED32, FieldDescriptor.TYPE_SINT32]:
+            lines.append('m->has_%s() ? lua_pushinteger(L, m->%s()) : lua_pushnil(L);' % ( name, name ))
+
+        elif type in [ FieldDescriptor.TYPE_INT64, FieldDescriptor.TYPE_UINT64,
+            FieldDescriptor.TYPE_FIXED64, FieldDescriptor.TYPE_SFIXED64, FieldDescriptor.TYPE_SINT64]:
+            lines.append('m->has_%s() ? lua_pushinteger(L, m->%s()) : lua_pushnil(L);' % ( name, name ))
+
+        elif type == FieldDescriptor.TYPE_FLOAT or type == FieldDescriptor.TYPE_DOUBLE:
+            lines.append('m->has_%s() ? lua_pushnumber(L, m->%s()) : lua_pushnil(L);' % ( name, name ))
+
+        elif type == FieldDescriptor.TYPE_ENUM:
+            lines.append('m->has_%s() ? lua_pushinteger(L, m->%s()) : lua_pushnil(L);' % ( name, name ))
+
+        elif type == FieldDescriptor.TYPE_MESSAGE:
+            lines.extend([
+                # creating the message modifies its parent, which has to wait
+                # for a job serializing it
+                'if (!m->has_%s()) {' % name,
+                    'lua_pushnil(L);',
+                    'msg_udata_wait(mud);',
+                '}',
+
+                # we push the message as userdata
+                # since the message is allocated out of the parent message, we
+                # don't need to do garbage collection, but the reference keeps
+                # the parent alive
+                '%s * got_msg = msg_udata_readonly(mud) ? const_cast<%s *>(&m->%s()) : m->mutable_%s();' % ( type_name.replace('.', '::'), type_name.replace('.', '::'), name, name ),
+                'lua_protobuf%s_pushreference(L, got_msg, NULL, NULL);' % type_name.replace('.', '_'),
+                'msg_udata_anchor(L, 1);',
+            ])
+
+        else:
+            # not supported yet :(
+            lines.append('return luaL_error(L, "lua-protobuf does not support this field type");')
+
+    lines.append('return 1;')
+    lines.append('}\n')
+
+    return lines
+
+def field_swap(package, message, field_descriptor):
+    '''Returns function definition for a swap_<field> function of an embedded message field'''
+
+    name = field_descriptor.name
+    type_name = field_descriptor.type_name
+    repeated = field_descriptor.label == FieldDescriptor.LABEL_REPEATED
+    index = 3 if repeated else 2
+
+    lines = []
+    lines.extend(field_function_start(package, message, 'swap', name))
+    lines.extend(obtain_message_from_udata(package, message, 1, lazy_field=field_descriptor if is_lazy(field_descriptor) else None, modifies=True))
+    lines.extend(obtain_message_from_udata(package=split_type_name(type_name)[0], message=split_type_name(type_name)[1], index=index, varname='o', modifies=True))
+
+    # the wire format of lazy fields of the other message stays with its userdata
+    lines.extend(materialize_lazy_fields('o'))
+
+    # the field would end up inside of itself if the other message contains
+    # it or lies inside of it
+    lines.extend([
+        'if (msg_udata_inside(mud, o)) {',
+            'return luaL_error(L, "cannot swap a field with a message that contains it");',
+        '}',
+    ])
+
+    if repeated:
+        lines.extend([
+            'lua_Integer index = luaL_checkinteger(L, 2);',
+            'if (index < 1 || index > m->%s_size()) {' % name,
+                'return luaL_error(L, "index must be between 1 and %%d", m->%s_size());' % name,
+            '}',
+            '%s *e = m->mutable_%s(index-1);' % ( cpp_class(type_name), name ),
+        ])
+    else:
+        lines.append('%s *e = m->mutable_%s();' % ( cpp_class(type_name), name ))
+
+    lines.extend([
+        'if (e != o && msg_udata_inside(oud, e)) {',
+            'return luaL_error(L, "cannot swap a field with a message inside of it");',
+        '}',
+        # swapped by value, so the embedded messages stay with their owners
+        # and references obtained from either message remain valid
+        'if (e != o) {',
+            '%s copy(*e);' % cpp_class(type_name),
+            'e->CopyFrom(*o);',
+            'o->CopyFrom(copy);',
+        '}',
+    ])
+    lines.extend(account_message())
+    lines.extend(account_message('o'))
+    lines.extend([
+        'return 0;',
+        '}\n',
+    ])
+
+    return lines
+
+def field_get_view(package, message, field_descriptor):
+    '''Returns function definition for a get_<field>_view function of a string or bytes field'''
+
+    name = field_descriptor.name
+    repeated = field_descriptor.label == FieldDescriptor.LABEL_REPEATED
+
+    lines = []
+    lines.extend(field_function_start(package, message, 'get', '%s_view' % name))
+    lines.extend(obtain_message_from_udata(package, message, lazy_field=field_descriptor if is_lazy(field_descriptor) else None))
+
+    # the FFI accessors change strings without going through the udata, so
+    # views would not notice
+    lines.extend([
+        'msg_udata * root = msg_udata_root(mud);',
+        'if (root->wrapped) {',
+            'return luaL_error(L, "views of messages wrapped by the FFI bindings are not supported");',
+        '}',
+    ])
+
+    if repeated:
+        lines.extend([
+            'lua_Integer index = luaL_checkinteger(L, 2);',
+            'if (index < 1 || index > m->%s_size()) {' % name,
+                'return luaL_error(L, "index must be between 1 and current size: %%d", m->%s_size());' % name,
+            '}',
+            'const string &s = m->%s(index - 1);' % name,
+        ])
+    else:
+        lines.extend([
+            'if (!m->has_%s()) {' % name,
+                'lua_pushnil(L);',
+                'return 1;',
+            '}',
+            'const string &s = m->%s();' % name,
+        ])
+
+    lines.extend([
+        'lua_protobuf_push_view(L, s.data(), s.size(), 1, &root->generation);',
+        'return 1;',
+        '}\n',
+    ])
+
+    return lines
+
+def field_set_assignment(field, args):
+    return [
+        'if (index == current_size + 1) {',
+            'm->add_%s(%s);' % ( field, args ),
+        '}',
+        'else {',
+            'm->set_%s(index-1, %s);' % ( field, args ),
+        '}',
+    ]
+
+def field_set(package, message, field_descriptor):
+    '''Returns function definition for a set_<field> function'''
+
+    name = field_descriptor.name
+    type = field_descriptor.type
+    type_name = field_descriptor.type_name
+    label = field_descriptor.label
+    repeated = label == FieldDescriptor.LABEL_REPEATED
+
+    lines = []
+    lines.extend(field_function_start(package, message, 'set', name))
+    lines.extend(obtain_message_from_udata(package, message, 1, lazy_field=field_descriptor if is_lazy(field_descriptor) else None, modifies=True))
+
+    # we do things differently depending on if this is a singular or repeated field
+    # for singular fields, the new value is the first argument
+    # for repeated fields, the index is arg1 and the value is arg2
+    if repeated:
+        lines.extend([
+            'if (lua_gettop(L) != 3) {',
+            '    return luaL_error(L, "required 2 arguments not passed to function");',
+            '}',
+            'lua_Integer index = luaL_checkinteger(L, 2);',
+            'int current_size = m->%s_size();' % name,
+            'if (index < 1 || index > current_size + 1) {',
+                'return luaL_error(L, "index must be between 1 and %d", current_size + 1);',
+            '}',
+
+            # we don't support the automagic nil clears value... yet
+            'if (lua_isnil(L, 3)) {',
+                'return luaL_error(L, "cannot assign nil to repeated fields (yet)");',
+            '}',
+        ])
+
+    # TODO proper 64 bit handling
+
+    # now move on to the assignment
+    if repeated:
+        if type in [ FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES ]:
+            lines.extend([
+                'size_t length = 0;',
+                'const char *s = luaL_checklstring(L, 3, &length);',
+            ])
+            lines.extend(field_set_assignment(name, 's, length'))
+            lines.append('lua_protobuf_account_growth(L, &mud->accounted, length);')
+
+        elif type == FieldDescriptor.TYPE_BOOL:
+            lines.append('bool b = lua_protobuf_check_bool(L, 3);')
+            lines.extend(field_set_assignment(name, 'b'))
+
+        elif type in [ FieldDescriptor.TYPE_DOUBLE, FieldDescriptor.TYPE_FLOAT ]:
+            lines.append('double d = lua_tonumber(L, 3);')
+            lines.extend(field_set_assignment(name, 'd'))
+
+        elif type in [ FieldDescriptor.TYPE_INT32, FieldDescriptor.TYPE_SFIXED32, FieldDescriptor.TYPE_SINT32 ]:
+            lines.append('lua_Integer i = lua_protobuf_check_int32(L, 3);')
+            lines.extend(field_set_assignment(name, 'i'))
+
+        elif type in [ FieldDescriptor.TYPE_UINT32, FieldDescriptor.TYPE_FIXED32 ]:
+            lines.append('lua_Integer i = lua_protobuf_check_uint32(L, 3);')
+            lines.extend(field_set_assignment(name, 'i'))
+
+        elif type in [ FieldDescriptor.TYPE_INT64, FieldDescriptor.TYPE_UINT64,
+            FieldDescriptor.TYPE_FIXED64, FieldDescriptor.TYPE_SFIXED64, FieldDescriptor.TYPE_SINT64]:
+
+            lines.append('lua_Integer i = lua_tointeger(L, 3);')
+            lines.extend(field_set_assignment(name, 'i'))
+
+        elif type == FieldDescriptor.TYPE_ENUM:
+            lines.append('lua_Integer i = lua_tointeger(L, 3);')
+            lines.extend(field_set_assignment(name, '(%s)i' % type_name.replace('.', '::')))
+
+        elif type == FieldDescriptor.TYPE_MESSAGE:
+            lines.extend(obtain_message_from_udata(package=split_type_name(type_name)[0], message=split_type_name(type_name)[1], index=3, varname='o'))
+            lines.extend(materialize_lazy_fields('o'))
+            lines.extend([
+                # the element is cleared before it is copied to, and a new
+                # element would be copied along with a message containing it
+                'if (msg_udata_inside(mud, o) || (index <= current_size && msg_udata_inside(oud, &m->%s(index-1)))) {' % name,
+                    '%s copy(*o);' % cpp_class(type_name),
+                    '(index == current_size + 1 ? m->add_%s() : m->mutable_%s(index-1))->CopyFrom(copy);' % ( name, name ),
+                '}',
+                'else {',
+                    '%s *e = index == current_size + 1 ? m->add_%s() : m->mutable_%s(index-1);' % ( cpp_class(type_name), name, name ),
+                    'if (e != o) {',
+                        'e->CopyFrom(*o);',
+                    '}',
+                '}',
+            ])
+            lines.extend(account_message())
+
+        else:
+            lines.append('return luaL_error(L, "field type not yet supported");')
+
+        lines.append('return 0;')
+    else:
+        # if they call set() with nil, we interpret as a clear
+        # this is the Lua way, after all
+        lines.extend([
+            'if (lua_isnil(L, 2)) {',
+                'm->clear_%s();' % name,
+                'return 0;',
+            '}',
+            '',
+        ])
+
+        if type in [ FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES ]:
+            lines.extend([
+                'if (!lua_isstring(L, 2)) return luaL_error(L, "passed value is not a string");',
+                'size_t len;',
+                'const char *s = lua_tolstring(L, 2, &len);',
+                'if (!s) {',
+                    'luaL_error(L, "could not obtain string on stack. weird");',
+                '}',
+                'm->set_%s(s, len);' % name,
+                'lua_protobuf_account_growth(L, &mud->accounted, len);',
+                'return 0;',
+            ])
+
+        elif type in [ FieldDescriptor.TYPE_DOUBLE, FieldDescriptor.TYPE_FLOAT ]:
+            lines.extend([
+                'if (!lua_isnumber(L, 2)) return luaL_error(L, "passed value cannot be converted to a number");',
+                'lua_Number n = lua_tonumber(L, 2);',
+                'm->set_%s(n);' % name,
+                'return 0;',
+            ])
+
+        elif type in [ FieldDescriptor.TYPE_INT32, FieldDescriptor.TYPE_SFIXED32, FieldDescriptor.TYPE_SINT32 ]:
+            lines.extend([
+                'lua_Integer v = lua_protobuf_check_int32(L, 2);',
+                'm->set_%s(v);' % name,
+                'return 0;',
+            ])
+
+        elif type in [ FieldDescriptor.TYPE_UINT32, FieldDescriptor.TYPE_FIXED32 ]:
+            lines.extend([
+                'lua_Integer v = lua_protobuf_check_uint32(L, 2);',
+                'm->set_%s(v);' % name,
+                'return 0;',
+            ])
+
+        elif type in [ FieldDescriptor.TYPE_INT64, FieldDescriptor.TYPE_UINT64,
+            FieldDescriptor.TYPE_FIXED64, FieldDescriptor.TYPE_SFIXED64, FieldDescriptor.TYPE_SINT64]:
+
+            lines.extend([
+                'lua_Integer i = luaL_checkinteger(L, 2);',
+                'm->set_%s(i);' % name,
+                'return 0;',
+            ])
+
+        elif type == FieldDescriptor.TYPE_BOOL:
+            lines.extend([
+                'bool b = lua_protobuf_check_bool(L, 2);',
+                'm->set_%s(b);' % name,
+                'return 0;',
+            ])
+
+        elif type == FieldDescriptor.TYPE_ENUM:
+            lines.extend([
+                'lua_Integer i = luaL_checkinteger(L, 2);',
+                'm->set_%s((%s)i);' % ( name, type_name.replace('.', '::') ),
+                'return 0;',
+            ])
+
+        elif type == FieldDescriptor.TYPE_MESSAGE:
+            lines.extend(obtain_message_from_udata(package=split_type_name(type_name)[0], message=split_type_name(type_name)[1], index=2, varname='o'))
+            lines.extend(materialize_lazy_fields('o'))
+            lines.extend([
+                # the field is cleared before it is copied to
+                'if (&m->%s() != o && (msg_udata_inside(mud, o) || msg_udata_inside(oud, &m->%s()))) {' % ( name, name ),
+                    '%s copy(*o);' % cpp_class(type_name),
+                    'm->mutable_%s()->CopyFrom(copy);' % name,
+                '}',
+                'else {',
+                    '%s *e = m->mutable_%s();' % ( cpp_class(type_name), name ),
+                    'if (e != o) {',
+                        'e->CopyFrom(*o);',
+                    '}',
+                '}',
+            ])
+            lines.extend(account_message())
+            lines.append('return 0;')
+
+        else:
+            lines.append('return luaL_error(L, "field type is not yet supported");')
+
+    lines.append('}\n')
+
+    return lines
+
+def new_message(package, message):
+    '''Returns function definition for creating a new protocol buffer message'''
+
+    lines = []
+
+    lines.append('int %snew(lua_State *L)' % message_function_prefix(package, message))
+    lines.append('{')
+
+    lines.append('%s *m = %spushnew(L, 0);' % ( cpp_class(package, message), message_function_prefix(package, message) ))
+    lines.append('lua_protobuf_account(L, &((msg_udata *)lua_touserdata(L, -1))->accounted, m, NULL, 0);')
+    lines.append('return 1;')
+
+    lines.append('}\n')
+
+    return lines
+
+def message_pushnew_function(package, message):
+    '''Returns function definition for pushing a new message owned by Lua
+
+    The memory of the message is not accounted yet, so it can be parsed into
+    first.
+    '''
+
+    c = cpp_class(package, message)
+
+    return [
+        '// mt is the stack index of the metatable, or 0 to look it up',
+        'static %s * %spushnew(lua_State *L, int mt)' % ( c, message_function_prefix(package, message) ),
+        '{',
+        '#ifdef LUA_PROTOBUF_INLINE_MESSAGES',
+        'msg_udata * ud = (msg_udata *)lua_newuserdata(L, sizeof(msg_udata) + sizeof(%s));' % c,
+        'ud->msg = new (MSG_UDATA_INLINE(ud)) %s();' % c,
+        '#else',
+        'msg_udata * ud = (msg_udata *)lua_newuserdata(L, sizeof(msg_udata));',
+        'ud->msg = new %s();' % c,
+        '#endif',
+        'ud->lua_owns = true;',
+        'ud->gc_callback = NULL;',
+        'ud->callback_data = NULL;',
+        'ud->lazy = NULL;',
+        'ud->shared = NULL;',
+        'ud->accounted = 0;',
+        'ud->parent = NULL;',
+        'ud->parent_ref = LUA_NOREF;',
+        'ud->wrapped = false;',
+        'ud->generation = 0;',
+        'ud->busy = NULL;',
+        'if (mt) {',
+            'lua_pushvalue(L, mt);',
+        '}',
+        'else {',
+            'luaL_getmetatable(L, "%s");' % metatable(package, message),
+        '}',
+        'lua_setmetatable(L, -2);',
+        'return (%s *)ud->msg;' % c,
+        '}\n',
+    ]
+
+def message_pushowned_function(package, message):
+    '''Returns function definition for handing a message over to Lua'''
+
+    return [
+        'bool %spushowned(lua_State *L, %s *msg)' % ( message_function_prefix(package, message), cpp_class(package, message) ),
+        '{',
+        'msg_udata * ud = (msg_udata *)lua_newuserdata(L, sizeof(msg_udata));',
+        'ud->lua_owns = true;',
+        'ud->msg = msg;',
+        'ud->gc_callback = NULL;',
+        'ud->callback_data = NULL;',
+        'ud->lazy = NULL;',
+        'ud->shared = NULL;',
+        'ud->accounted = 0;',
+        'ud->parent = NULL;',
+        'ud->parent_ref = LUA_NOREF;',
+        'ud->wrapped = false;',
+        'ud->generation = 0;',
+        'ud->busy = NULL;',
+        'luaL_getmetatable(L, "%s");' % metatable(package, message),
+        'lua_setmetatable(L, -2);',
+        'lua_protobuf_account(L, &ud->accounted, msg, NULL, 0);',
+        'return true;',
+        '}',
+    ]
+
+def message_pushcopy_function(package, message):
+    '''Returns function definition for pushing a copy of a message to the stack'''
+
+    return [
+        'bool %spushcopy(lua_State *L, const %s &from)' % ( message_function_prefix(package, message), cpp_class(package, message) ),
+        '{',
+        'return %spushowned(L, new %s(from));' % ( message_function_prefix(package, message), cpp_class(package, message) ),
+        '}',
+    ]
+
+def message_pushreference_function(package, message):
+    '''Returns function definition for pushing a reference of a message on the stack'''
+
+    return [
+        'bool %spushreference(lua_State *L, %s *msg, lua_protobuf_gc_callback f, void *data)' % ( message_function_prefix(package, message), cpp_class(package, message) ),
+        '{',
+        'msg_udata * ud = (msg_udata *)lua_newuserdata(L, sizeof(msg_udata));',
+        'ud->lua_owns = false;',
+        'ud->msg = msg;',
+        'ud->gc_callback = f;',
+        'ud->callback_data = data;',
+        'ud->lazy = NULL;',
+        'ud->shared = NULL;',
+        'ud->accounted = 0;',
+        'ud->parent = NULL;',
+        'ud->parent_ref = LUA_NOREF;',
+        'ud->wrapped = false;',
+        'ud->generation = 0;',
+        'ud->busy = NULL;',
+        'luaL_getmetatable(L, "%s");' % metatable(package, message),
+        'lua_setmetatable(L, -2);',
+        'return true;',
+        '}',
+    ]
+
+def parsefromstring_message_function(package, descriptor):
+    '''Returns function definition for parsing a message from a serialized string'''
+
+    message = descriptor.name
+    lazy = lazy_fields(descriptor)
+
+    lines = []
+
+    lines.append('int %sparsefromstring(lua_State *L)' % message_function_prefix(package, message))
+    c = cpp_class(package, message)
+
+    lines.extend([
+        '{',
+        'if (lua_gettop(L) != 1) {',
+            'return luaL_error(L, "parsefromstring() requires a string argument. none given");',
+        '}',
+
+        'size_t len;',
+        'const char *s = luaL_checklstring(L, -1, &len);',
+
+        # a message that fails to parse is left to the garbage collector
+        '%s * msg = %spushnew(L, 0);' % ( c, message_function_prefix(package, message) ),
+        'msg_udata * ud = (msg_udata *)lua_touserdata(L, -1);',
+    ])
+
+    # lazy fields are kept in their wire format until they are accessed
+    if lazy:
+        lines.extend([
+            'static const int lazy_numbers[] = { %s, 0 };' % ', '.join([ str(fd.number) for fd in lazy ]),
+            'if (!lua_protobuf_parse_lazy(msg, s, len, lazy_numbers, &ud->lazy)) {',
+        ])
+    else:
+        lines.append('if (!msg->ParseFromArray((const void *)s, len)) {')
+
+    lines.extend([
+            'return luaL_error(L, "error deserializing message");',
+        '}',
+        'lua_protobuf_account(L, &ud->accounted, msg, ud->lazy, len);',
+        'LUA_PROTOBUF_COUNT(%s_counters, %s_stats, LUA_PROTOBUF_STATS_PARSED, len);' % ( message, message ),
+        'return 1;',
+        '}',
+    ])
+
+    return lines
+
+def message_fields_table(package, descriptor):
+    '''Returns the definition of the field table for a message type'''
+
+    lines = [
+        'const lua_protobuf_field_info %s[] = {' % message_fields_name('.%s.%s' % ( package, descriptor.name )),
+    ]
+
+    for fd in descriptor.field:
+        if fd.type == FieldDescriptor.TYPE_MESSAGE:
+            message_fields = message_fields_name(fd.type_name)
+        else:
+            message_fields = 'NULL'
+
+        lines.append('{"%s", %d, ::google::protobuf::FieldDescriptor::TYPE_%s, %s, %s},' % (
+            fd.name, fd.number, FIELD_TYPE_MAP[fd.type].upper(),
+            'true' if fd.label == FieldDescriptor.LABEL_REPEATED else 'false', message_fields ))
+
+    lines.extend([
+        '{NULL, 0, 0, false, NULL},',
+        '};\n',
+    ])
+
+    return lines
+
+def peek_message_function(package, message):
+    '''Returns function definition for reading fields from a serialized message'''
+
+    return [
+        'int %speek(lua_State *L)' % message_function_prefix(package, message),
+        '{',
+        'size_t len;',
+        'const char *s = luaL_checklstring(L, 1, &len);',
+        'return lua_protobuf_peek(L, %s, s, len, 2);' % message_fields_name('.%s.%s' % ( package, message )),
+        '}',
+    ]
+
+def iter_delimited_message_function(package, message):
+    '''Returns function definitions for iterating over length-delimited messages'''
+
+    fp = message_function_prefix(package, message)
+
+    return [
+        'int %siter_delimited(lua_State *L)' % fp,
+        '{',
+        'if (lua_gettop(L) < 1) {',
+            'return luaL_error(L, "iter_delimited() requires a file or string argument. none given");',
+        '}',
+        'bool reuse = lua_toboolean(L, 2);',
+        'lua_settop(L, 1);',
+
+        # the iterator holds on to the reader, its source and the message
+        # to reuse, if any
+        'lua_protobuf_delimited_reader_new(L, 1);',
+        'lua_pushvalue(L, 1);',
+        'if (reuse) {',
+            '%snew(L);' % fp,
+        '}',
+        'else {',
+            'lua_pushnil(L);',
+        '}',
+        'lua_pushcclosure(L, %siter_delimited_next, 3);' % fp,
+        'return 1;',
+        '}',
+        '',
+        'int %siter_delimited_next(lua_State *L)' % fp,
+        '{',
+        'lua_protobuf_delimited_reader *reader = (lua_protobuf_delimited_reader *)lua_touserdata(L, lua_upvalueindex(1));',
+        'if (lua_isnil(L, lua_upvalueindex(3))) {',
+            '%snew(L);' % fp,
+        '}',
+        'else {',
+            'lua_pushvalue(L, lua_upvalueindex(3));',
+
+            # a reused message that was frozen is replaced
+            'if (((msg_udata *)lua_touserdata(L, -1))->shared) {',
+                'lua_pop(L, 1);',
+                '%snew(L);' % fp,
+                'lua_pushvalue(L, -1);',
+                'lua_replace(L, lua_upvalueindex(3));',
+            '}',
+        '}',
+        'msg_udata * ud = (msg_udata *)lua_touserdata(L, -1);',
+        'msg_udata_wait(ud);',
+        'ud->generation++;',
+        'int result = lua_protobuf_delimited_reader_next(reader, ud->msg);',
+        'if (result < 0) {',
+            'return luaL_error(L, "error deserializing message");',
+        '}',
+        'lua_protobuf_account(L, &ud->accounted, ud->msg, NULL, 0);',
+
+        # returning nothing ends a generic for
+        'return result;',
+        '}',
+    ]
+
+def parse_file_message_function(package, message):
+    '''Returns function definition for parsing a message from a memory mapped file'''
+
+    fp = message_function_prefix(package, message)
+
+    return [
+        'int %sparse_file(lua_State *L)' % fp,
+        '{',
+        'luaL_checkstring(L, 1);',
+        'lua_settop(L, 3);',
+        '%snew(L);' % fp,
+        'msg_udata * ud = (msg_udata *)lua_touserdata(L, -1);',
+        'lua_protobuf_parse_file(L, 1, ud->msg);',
+        'lua_protobuf_account(L, &ud->accounted, ud->msg, NULL, 0);',
+        'return 1;',
+        '}',
+    ]
+
+def iter_delimited_file_message_function(package, message):
+    '''Returns function definition for iterating over length-delimited messages in a memory mapped file'''
+
+    fp = message_function_prefix(package, message)
+
+    return [
+        'int %siter_delimited_file(lua_State *L)' % fp,
+        '{',
+        'bool reuse = lua_toboolean(L, 4);',
+        'lua_settop(L, 3);',
+
+        # the reader owns the mapping, so there is no source to hold on to
+        'lua_protobuf_delimited_reader_new_file(L, 1);',
+        'lua_pushnil(L);',
+        'if (reuse) {',
+            '%snew(L);' % fp,
+        '}',
+        'else {',
+            'lua_pushnil(L);',
+        '}',
+        'lua_pushcclosure(L, %siter_delimited_next, 3);' % fp,
+        'return 1;',
         '}',
     ]
 
-def message_pushreference_function(package, message):
-    '''Returns function definition for pushing a reference of a message on the stack'''
+def write_delimited_message_function(package, message):
+    '''Returns function definition for writing a length-delimited message'''
+
+    lines = [
+        'int %swrite_delimited(lua_State *L)' % message_function_prefix(package, message),
+        '{',
+    ]
+    lines.extend(obtain_message_from_udata(package, message, 1))
+    lines.extend(materialize_lazy_fields())
+    lines.extend([
+        'return lua_protobuf_write_delimited(L, lua_isnoneornil(L, 2) ? 0 : 2, *m);',
+        '}',
+    ])
+
+    return lines
+
+def account_message(varname='m'):
+    '''Statement that measures a message obtained from userdata again after it changed'''
 
     return [
-        'bool %spushreference(lua_State *L, %s *msg, lua_protobuf_gc_callback f, void *data)' % ( message_function_prefix(package, message), cpp_class(package, message) ),
+        'if (%sud->accounted) {' % varname,
+            'lua_protobuf_account(L, &%sud->accounted, %s, %sud->lazy, 0);' % ( varname, varname, varname ),
+        '}',
+    ]
+
+def materialize_lazy_fields(varname='m'):
+    '''Statement that parses all lazy fields of a message obtained from userdata
+
+    A job serializing the message is waited for first, as parsing the fields
+    modifies the message and the message is read as a whole afterwards.
+    '''
+
+    return [
+        'msg_udata_wait(%sud);' % varname,
+        'if (!lua_protobuf_lazy_materialize(%s, &%sud->lazy, 0)) {' % ( varname, varname ),
+            'return luaL_error(L, "error deserializing lazy fields");',
+        '}',
+    ]
+
+def materialize_message_function(package, message):
+    '''Returns function definition for parsing all lazy fields of a message'''
+
+    lines = [
+        'int %smaterialize(lua_State *L)' % message_function_prefix(package, message),
         '{',
-        'msg_udata * ud = (msg_udata *)lua_newuserdata(L, sizeof(msg_udata));',
-        'ud->lua_owns = false;',
-        'ud->msg = msg;',
-        'ud->gc_callback = f;',
-        'ud->callback_data = data;',
+    ]
+    lines.extend(obtain_message_from_udata(package, message, 1))
+    lines.extend(materialize_lazy_fields())
+    lines.extend([
+        'if (mud->accounted) {',
+            'lua_protobuf_account(L, &mud->accounted, m, NULL, 0);',
+        '}',
+        'return 0;',
+        '}',
+    ])
+
+    return lines
+
+def parse_many_message_function(package, descriptor):
+    '''Returns function definition for parsing an array of serialized strings'''
+
+    message = descriptor.name
+    c = cpp_class(package, message)
+    lazy = lazy_fields(descriptor)
+
+    lines = [
+        'int %sparse_many(lua_State *L)' % message_function_prefix(package, message),
+        '{',
+        'luaL_checktype(L, 1, LUA_TTABLE);',
+        'if (lua_isnoneornil(L, 2)) {',
+            'lua_settop(L, 1);',
+            'lua_newtable(L);',
+        '}',
+        'else {',
+            'luaL_checktype(L, 2, LUA_TTABLE);',
+            'lua_settop(L, 2);',
+        '}',
+
+        # the metatable is looked up once for the whole batch
         'luaL_getmetatable(L, "%s");' % metatable(package, message),
-        'lua_setmetatable(L, -2);',
-        'return true;',
+        'int n = lua_objlen(L, 1);',
+    ]
+
+    if lazy:
+        lines.append('static const int lazy_numbers[] = { %s, 0 };' % ', '.join([ str(fd.number) for fd in lazy ]))
+
+    lines.extend([
+        'for (int i = 1; i <= n; i++) {',
+            'lua_rawgeti(L, 1, i);',
+            'size_t len;',
+            'const char *s = lua_tolstring(L, -1, &len);',
+            'if (!s) {',
+                'return luaL_error(L, "element %d is not a string", i);',
+            '}',
+
+            # messages already in the output array are parsed into, unless
+            # they are references into other messages or frozen
+            'lua_rawgeti(L, 2, i);',
+            'msg_udata * ud = (msg_udata *)lua_touserdata(L, -1);',
+            'if (ud && lua_getmetatable(L, -1)) {',
+                'if (!lua_rawequal(L, -1, 3) || !ud->lua_owns || ud->shared) {',
+                    'ud = NULL;',
+                '}',
+                'lua_pop(L, 1);',
+            '}',
+            'else {',
+                'ud = NULL;',
+            '}',
+            'if (!ud) {',
+                'lua_pop(L, 1);',
+                '%spushnew(L, 3);' % message_function_prefix(package, message),
+                'ud = (msg_udata *)lua_touserdata(L, -1);',
+            '}',
+            'msg_udata_wait(ud);',
+            'ud->generation++;',
+            'lua_protobuf_lazy_free(ud->lazy);',
+            'ud->lazy = NULL;',
+    ])
+
+    if lazy:
+        lines.append('if (!lua_protobuf_parse_lazy(ud->msg, s, len, lazy_numbers, &ud->lazy)) {')
+    else:
+        lines.append('if (!ud->msg->ParseFromArray((const void *)s, len)) {')
+
+    lines.extend([
+                'return luaL_error(L, "error deserializing message %d", i);',
+            '}',
+            'lua_protobuf_account(L, &ud->accounted, ud->msg, ud->lazy, len);',
+            'lua_rawseti(L, 2, i);',
+            'lua_pop(L, 1);',
+        '}',
+
+        # drop anything left over from a larger batch
+        'for (int i = lua_objlen(L, 2); i > n; i--) {',
+            'lua_pushnil(L);',
+            'lua_rawseti(L, 2, i);',
+        '}',
+
+        'lua_pop(L, 1);',
+        'return 1;',
+        '}',
+    ])
+
+    return lines
+
+def serialize_many_message_function(package, message):
+    '''Returns function definition for serializing an array of messages'''
+
+    return [
+        'int %sserialize_many(lua_State *L)' % message_function_prefix(package, message),
+        '{',
+        'luaL_checktype(L, 1, LUA_TTABLE);',
+        'lua_settop(L, 1);',
+        'luaL_getmetatable(L, "%s");' % metatable(package, message),
+        'int n = lua_objlen(L, 1);',
+        'lua_createtable(L, n, 0);',
+
+        # one buffer is reused for all messages
+        'string s;',
+        'for (int i = 1; i <= n; i++) {',
+            'lua_rawgeti(L, 1, i);',
+            'msg_udata * ud = (msg_udata *)lua_touserdata(L, -1);',
+            'if (!ud || !lua_getmetatable(L, -1) || !lua_rawequal(L, -1, 2)) {',
+                'return luaL_error(L, "element %%d is not a %s message", i);' % lua_libname(package, message),
+            '}',
+            'lua_pop(L, 2);',
+            'msg_udata_wait(ud);',
+            'if (!ud->msg->SerializeToString(&s)) {',
+                'return luaL_error(L, "error serializing message %d", i);',
+            '}',
+            'if (ud->lazy) {',
+                'lua_protobuf_lazy_serialize(ud->lazy, &s);',
+            '}',
+            'lua_pushlstring(L, s.c_str(), s.length());',
+            'lua_rawseti(L, 3, i);',
+        '}',
+        'return 1;',
+        '}',
+    ]
+
+def async_message_functions(package, message):
+    '''Returns function definitions for parsing and serializing on the worker pool'''
+
+    fp = message_function_prefix(package, message)
+    c = cpp_class(package, message)
+
+    lines = [
+        '#ifdef LUA_PROTOBUF_ASYNC',
+        'static void %sadopt(lua_State *L, ::google::protobuf::Message *msg)' % fp,
+        '{',
+        '%spushowned(L, (%s *)msg);' % ( fp, c ),
+        '}\n',
+        'int %sparse_async(lua_State *L)' % fp,
+        '{',
+        'luaL_checkstring(L, 1);',
+        'lua_protobuf_parse_async(L, 1, new %s(), %sadopt);' % ( c, fp ),
+        'return 1;',
+        '}\n',
+        'int %sserialize_async(lua_State *L)' % fp,
+        '{',
+    ]
+    lines.extend(obtain_message_from_udata(package, message, 1))
+    lines.extend([
+        # the FFI bindings modify the message without checking for the job
+        'msg_udata * root = msg_udata_root(mud);',
+        'if (root->wrapped) {',
+            'return luaL_error(L, "messages wrapped by the FFI bindings cannot be serialized in the background");',
+        '}',
+    ])
+
+    # the workers only see the C++ message. a previous job serializing it is
+    # waited for, so there is one at a time
+    lines.extend(materialize_lazy_fields())
+    lines.extend([
+        'lua_protobuf_serialize_async(L, 1, m, &root->busy);',
+        'return 1;',
+        '}',
+        '#endif',
+    ])
+
+    return lines
+
+def shared_message_functions(package, message):
+    '''Returns function definitions for freezing and sharing messages between Lua states'''
+
+    fp = message_function_prefix(package, message)
+    c = cpp_class(package, message)
+
+    lines = [
+        'int %sfreeze(lua_State *L)' % fp,
+        '{',
+    ]
+    lines.extend(obtain_message_from_udata(package, message, 1))
+    lines.extend([
+        'if (!msg_udata_frozen(mud)) {',
+            # the reference count decides when the message goes away, so
+            # nobody else may be responsible for it
+            'if (!mud->lua_owns) {',
+                'return luaL_error(L, "only messages owned by Lua can be frozen");',
+            '}',
+            # the FFI bindings would still write to it
+            'if (mud->wrapped) {',
+                'return luaL_error(L, "messages wrapped by the FFI bindings cannot be frozen");',
+            '}',
+    ])
+
+    # readers in other states must not parse lazy fields
+    lines.extend(materialize_lazy_fields())
+    lines.extend([
+            # the message outlives this userdata, so it cannot stay inside of it
+            'if (mud->msg == MSG_UDATA_INLINE(mud)) {',
+                '%s *moved = new %s();' % ( c, c ),
+                'moved->Swap(m);',
+                'm->~%s();' % c.split('::')[-1],
+                'mud->msg = m = moved;',
+                'mud->generation++;',
+            '}',
+            'mud->shared = lua_protobuf_share(m);',
+            'mud->lua_owns = false;',
+        '}',
+        'lua_settop(L, 1);',
+        'return 1;',
+        '}\n',
+        'int %sfrozen(lua_State *L)' % fp,
+        '{',
+    ])
+    lines.extend([
+        'msg_udata * mud = (msg_udata *)%s;' % check_udata(package, message, 1),
+        'lua_pushboolean(L, msg_udata_frozen(mud));',
+        'return 1;',
+        '}\n',
+        'int %sshare(lua_State *L)' % fp,
+        '{',
+        '%sfreeze(L);' % fp,
+        'msg_udata * ud = (msg_udata *)lua_touserdata(L, 1);',
+        'lua_pushlightuserdata(L, msg_udata_root(ud)->shared);',
+        'return 1;',
+        '}\n',
+        'int %sadopt(lua_State *L)' % fp,
+        '{',
+        'luaL_checktype(L, 1, LUA_TLIGHTUSERDATA);',
+        'lua_protobuf_shared *shared = (lua_protobuf_shared *)lua_touserdata(L, 1);',
+        'const ::google::protobuf::Message *msg = lua_protobuf_shared_message(shared);',
+        'if (msg->GetDescriptor() != %s::descriptor()) {' % c,
+            'return luaL_error(L, "shared message is a %s, not a %s", msg->GetTypeName().c_str(), %s::descriptor()->full_name().c_str());' % ( '%s', '%s', c ),
+        '}',
+        '%spushreference(L, (%s *)msg, NULL, NULL);' % ( fp, c ),
+        '((msg_udata *)lua_touserdata(L, -1))->shared = lua_protobuf_shared_retain(shared);',
+        'return 1;',
+        '}',
+    ])
+
+    return lines
+
+def copy_message_functions(package, message):
+    '''Returns function definitions for copying messages without serializing them'''
+
+    fp = message_function_prefix(package, message)
+    c = cpp_class(package, message)
+
+    def start(name, swaps=False):
+        lines = [
+            'int %s%s(lua_State *L)' % ( fp, name ),
+            '{',
+        ]
+        lines.extend(obtain_message_from_udata(package, message, 1, modifies=True))
+        lines.extend(obtain_message_from_udata(package, message, 2, varname='o', modifies=swaps))
+        lines.extend(materialize_lazy_fields('o'))
+        return lines
+
+    # a message that contains the other one or lies inside of it is cleared
+    # before it is copied, so it is copied through a temporary
+    related = 'msg_udata_inside(mud, o) || msg_udata_inside(oud, m)'
+
+    lines = start('copy_from')
+    lines.extend([
+        'if (m != o) {',
+            'lua_protobuf_lazy_free(mud->lazy);',
+            'mud->lazy = NULL;',
+            'if (%s) {' % related,
+                '%s copy(*o);' % c,
+                'm->CopyFrom(copy);',
+            '}',
+            'else {',
+                'm->CopyFrom(*o);',
+            '}',
+        '}',
+    ])
+    lines.extend(account_message())
+    lines.extend([
+        'return 0;',
+        '}\n',
+    ])
+
+    lines.extend(start('merge_from'))
+    lines.extend(materialize_lazy_fields())
+    lines.extend([
+        # a message cannot be merged into itself or a message it contains
+        'if (m == o || %s) {' % related,
+            '%s copy(*o);' % c,
+            'm->MergeFrom(copy);',
+        '}',
+        'else {',
+            'm->MergeFrom(*o);',
+        '}',
+    ])
+    lines.extend(account_message())
+    lines.extend([
+        'return 0;',
+        '}\n',
+    ])
+
+    lines.extend(start('swap', swaps=True))
+    lines.extend(materialize_lazy_fields())
+    lines.extend([
+        # a message swapped with one it contains would end up inside of itself
+        'if (m != o && (%s)) {' % related,
+            'return luaL_error(L, "cannot swap a message with a message it contains");',
+        '}',
+        # swapped by value, so the embedded messages stay with their owners
+        # and references obtained from either message remain valid
+        'if (m != o) {',
+            '%s copy(*m);' % c,
+            'm->CopyFrom(*o);',
+            'o->CopyFrom(copy);',
+        '}',
+    ])
+    lines.extend(account_message())
+    lines.extend(account_message('o'))
+    lines.extend([
+        'return 0;',
+        '}\n',
+        'int %sclone(lua_State *L)' % fp,
+        '{',
+    ])
+    lines.extend(obtain_message_from_udata(package, message, 1))
+    lines.extend(materialize_lazy_fields())
+    lines.extend([
+        '%s *copy = %spushnew(L, 0);' % ( c, fp ),
+        'copy->CopyFrom(*m);',
+        'lua_protobuf_account(L, &((msg_udata *)lua_touserdata(L, -1))->accounted, copy, NULL, 0);',
+        'return 1;',
+        '}',
+    ])
+
+    return lines
+
+def path_message_functions(package, message):
+    '''Returns function definitions for reading and writing fields by path'''
+
+    fp = message_function_prefix(package, message)
+    c = cpp_class(package, message)
+    fields = message_fields_name('.%s.%s' % ( package, message ))
+
+    lines = [
+        'int %spath(lua_State *L)' % fp,
+        '{',
+        'lua_settop(L, 1);',
+        'lua_protobuf_check_path(L, 1, %s, %s::descriptor());' % ( fields, c ),
+        'return 1;',
+        '}\n',
+        'int %sgetpath(lua_State *L)' % fp,
+        '{',
+    ]
+    lines.extend(obtain_message_from_udata(package, message, 1))
+    lines.extend([
+        'const lua_protobuf_path *path = lua_protobuf_check_path(L, 2, %s, %s::descriptor());' % ( fields, c ),
+
+        # embedded messages are returned serialized
+        'msg_udata_wait(mud);',
+
+        # only the field the path goes through is parsed
+        'if (!lua_protobuf_lazy_materialize(m, &mud->lazy, lua_protobuf_path_number(path))) {',
+            'return luaL_error(L, "error deserializing lazy field");',
+        '}',
+        'return lua_protobuf_getpath(L, path, m);',
+        '}\n',
+        'int %ssetpath(lua_State *L)' % fp,
+        '{',
+    ])
+    lines.extend(obtain_message_from_udata(package, message, 1, modifies=True))
+    lines.extend([
+        'const lua_protobuf_path *path = lua_protobuf_check_path(L, 2, %s, %s::descriptor());' % ( fields, c ),
+        'if (!lua_protobuf_lazy_materialize(m, &mud->lazy, lua_protobuf_path_number(path))) {',
+            'return luaL_error(L, "error deserializing lazy field");',
+        '}',
+        'lua_protobuf_setpath(L, path, m, 3);',
+        'if (lua_type(L, 3) == LUA_TSTRING) {',
+            'lua_protobuf_account_growth(L, &mud->accounted, lua_objlen(L, 3));',
+        '}',
+        'return 0;',
+        '}',
+    ])
+
+    return lines
+
+def mask_message_functions(package, message):
+    '''Returns function definitions for serializing and merging the fields in a mask'''
+
+    fp = message_function_prefix(package, message)
+    c = cpp_class(package, message)
+    fields = message_fields_name('.%s.%s' % ( package, message ))
+
+    lines = [
+        'int %smask(lua_State *L)' % fp,
+        '{',
+        'lua_settop(L, 1);',
+        'lua_protobuf_check_mask(L, 1, %s, %s::descriptor());' % ( fields, c ),
+        'return 1;',
+        '}\n',
+        'int %sserialized_masked(lua_State *L)' % fp,
+        '{',
+    ]
+    lines.extend(obtain_message_from_udata(package, message, 1))
+    lines.extend([
+        'const lua_protobuf_mask *mask = lua_protobuf_check_mask(L, 2, %s, %s::descriptor());' % ( fields, c ),
+    ])
+    lines.extend(materialize_lazy_fields())
+    lines.extend([
+        'return lua_protobuf_serialize_masked(L, mask, *m);',
+        '}\n',
+        'int %smerge_masked(lua_State *L)' % fp,
+        '{',
+    ])
+    lines.extend(obtain_message_from_udata(package, message, 1, modifies=True))
+    lines.extend(obtain_message_from_udata(package, message, 2, varname='o'))
+    lines.extend([
+        'const lua_protobuf_mask *mask = lua_protobuf_check_mask(L, 3, %s, %s::descriptor());' % ( fields, c ),
+    ])
+    lines.extend(materialize_lazy_fields())
+    lines.extend(materialize_lazy_fields('o'))
+    lines.extend([
+        # merging a message into itself does nothing. one that contains the
+        # other or lies inside of it is merged through a temporary
+        'bool ok = true;',
+        'if (m != o && (msg_udata_inside(mud, o) || msg_udata_inside(oud, m))) {',
+            '%s copy(*o);' % c,
+            'ok = lua_protobuf_merge_masked(mask, copy, m);',
+        '}',
+        'else if (m != o) {',
+            'ok = lua_protobuf_merge_masked(mask, *o, m);',
+        '}',
+        'if (!ok) {',
+            'return luaL_error(L, "error merging message");',
+        '}',
+    ])
+    lines.extend(account_message())
+    lines.extend([
+        'return 0;',
+        '}',
+    ])
+
+    return lines
+
+def json_message_functions(package, message):
+    '''Returns function definitions for converting messages from and to JSON'''
+
+    fp = message_function_prefix(package, message)
+    c = cpp_class(package, message)
+
+    lines = [
+        'int %stojson(lua_State *L)' % fp,
+        '{',
+    ]
+    lines.extend(obtain_message_from_udata(package, message, 1))
+    lines.extend(materialize_lazy_fields())
+    lines.extend([
+        'return lua_protobuf_tojson(L, *m, 2);',
+        '}\n',
+        'int %sfromjson(lua_State *L)' % fp,
+        '{',
+        'luaL_checkstring(L, 1);',
+        'lua_settop(L, 2);',
+        '%s *msg = %spushnew(L, 0);' % ( c, fp ),
+        'lua_protobuf_fromjson(L, 1, msg, 2);',
+        'lua_protobuf_account(L, &((msg_udata *)lua_touserdata(L, -1))->accounted, msg, NULL, 0);',
+        'return 1;',
         '}',
-    ]
+    ])
 
-def parsefromstring_message_function(package, message):
-    '''Returns function definition for parsing a message from a serialized string'''
+    return lines
 
-    lines = []
+def compressed_message_functions(package, message):
+    '''Returns function definitions for gzip compressed serialization'''
 
-    lines.append('int %sparsefromstring(lua_State *L)' % message_function_prefix(package, message))
+    fp = message_function_prefix(package, message)
     c = cpp_class(package, message)
 
+    lines = [
+        '#ifdef LUA_PROTOBUF_GZIP',
+        'int %sserialized_compressed(lua_State *L)' % fp,
+        '{',
+    ]
+    lines.extend(obtain_message_from_udata(package, message, 1))
+    lines.extend(materialize_lazy_fields())
     lines.extend([
+        'return lua_protobuf_serialize_compressed(L, *m, (int)luaL_optinteger(L, 2, -1));',
+        '}\n',
+        'int %sparse_compressed(lua_State *L)' % fp,
         '{',
-        'if (lua_gettop(L) != 1) {',
-            'return luaL_error(L, "parsefromstring() requires a string argument. none given");',
+        'luaL_checkstring(L, 1);',
+        'lua_settop(L, 1);',
+        '%s *msg = %spushnew(L, 0);' % ( c, fp ),
+        'lua_protobuf_parse_compressed(L, 1, msg);',
+        'lua_protobuf_account(L, &((msg_udata *)lua_touserdata(L, -1))->accounted, msg, NULL, 0);',
+        'return 1;',
+        '}\n',
+        'int %swrite_delimited_compressed(lua_State *L)' % fp,
+        '{',
+    ])
+    lines.extend(obtain_message_from_udata(package, message, 1))
+    lines.extend(materialize_lazy_fields())
+    lines.extend([
+        'return lua_protobuf_write_delimited_compressed(L, lua_isnoneornil(L, 2) ? 0 : 2, *m, (int)luaL_optinteger(L, 3, -1));',
+        '}\n',
+        'int %siter_delimited_compressed(lua_State *L)' % fp,
+        '{',
+        'if (lua_gettop(L) < 1) {',
+            'return luaL_error(L, "iter_delimited_compressed() requires a file or string argument. none given");',
         '}',
-
-        'size_t len;',
-        'const char *s = luaL_checklstring(L, -1, &len);',
-        '%s * msg = new %s();' % ( c, c ),
-        'if (!msg->ParseFromArray((const void *)s, len)) {',
-            'return luaL_error(L, "error deserializing message");',
+        'bool reuse = lua_toboolean(L, 2);',
+        'lua_settop(L, 1);',
+        'lua_protobuf_delimited_reader_decompress(lua_protobuf_delimited_reader_new(L, 1));',
+        'lua_pushvalue(L, 1);',
+        'if (reuse) {',
+            '%snew(L);' % fp,
         '}',
-
-        'msg_udata * ud = (msg_udata *)lua_newuserdata(L, sizeof(msg_udata));',
-        'ud->lua_owns = true;',
-        'ud->msg = msg;',
-        'ud->gc_callback = NULL;',
-        'ud->callback_data = NULL;',
-        'luaL_getmetatable(L, "%s");' % metatable(package, message),
-        'lua_setmetatable(L, -2);',
-
+        'else {',
+            'lua_pushnil(L);',
+        '}',
+        'lua_pushcclosure(L, %siter_delimited_next, 3);' % fp,
         'return 1;',
         '}',
+        '#endif',
     ])
 
     return lines
@@ -652,8 +4403,34 @@ def gc_message_function(package, message):
     # if Lua "owns" the message, we delete it
     # else, we delete only if a callback exists and it says it is OK
     lines.extend([
+        # a job serializing the message is waited for. references never have
+        # one, and their parent may be collected already
+        '#ifdef LUA_PROTOBUF_ASYNC',
+        'if (mud->busy) {',
+            'lua_protobuf_async_busy(&mud->busy, true);',
+        '}',
+        '#endif',
+        'lua_protobuf_lazy_free(mud->lazy);',
+        'mud->lazy = NULL;',
+        'lua_protobuf_unaccount(&mud->accounted);',
+        'if (mud->parent) {',
+        'luaL_unref(L, LUA_REGISTRYINDEX, mud->parent_ref);',
+        'mud->parent = NULL;',
+        'mud->parent_ref = LUA_NOREF;',
+        '}',
+        'if (mud->shared) {',
+        'lua_protobuf_shared_release(mud->shared);',
+        'mud->shared = NULL;',
+        'mud->msg = NULL;',
+        'return 0;',
+        '}',
         'if (mud->lua_owns) {',
+        'if (mud->msg == MSG_UDATA_INLINE(mud)) {',
+        'mud->msg->~Message();',
+        '}',
+        'else {',
         'delete mud->msg;',
+        '}',
         'mud->msg = NULL;',
         'return 0;',
         '}',
@@ -675,8 +4452,10 @@ def clear_message_function(package, message):
         'int %sclear(lua_State *L)' % message_function_prefix(package, message),
         '{'
     ]
-    lines.extend(obtain_message_from_udata(package, message, 1))
+    lines.extend(obtain_message_from_udata(package, message, 1, modifies=True))
     lines.extend([
+        'lua_protobuf_lazy_free(mud->lazy);',
+        'mud->lazy = NULL;',
         'm->Clear();',
         'return 0;',
         '}',
@@ -693,11 +4472,18 @@ def serialized_message_function(package, message):
     ]
     lines.extend(obtain_message_from_udata(package, message, 1))
     lines.extend([
+        'msg_udata_wait(mud);',
         'string s;',
         'if (!m->SerializeToString(&s)) {',
         'return luaL_error(L, "error serializing message");',
         '}',
+
+        # fields that were never accessed are emitted as they were received
+        'if (mud->lazy) {',
+        'lua_protobuf_lazy_serialize(mud->lazy, &s);',
+        '}',
         'lua_pushlstring(L, s.c_str(), s.length());',
+        'LUA_PROTOBUF_COUNT(%s_counters, %s_stats, LUA_PROTOBUF_STATS_SERIALIZED, s.length());' % ( message, message ),
         'return 1;',
         '}',
     ])
@@ -714,6 +4500,24 @@ def message_function_array(package, message):
         'static const struct luaL_Reg %s_functions [] = {' % message,
         '{"new", %snew},' % message_function_prefix(package, message),
         '{"parsefromstring", %sparsefromstring},' % message_function_prefix(package, message),
+        '{"iter_delimited", %siter_delimited},' % message_function_prefix(package, message),
+        '{"parse_file", %sparse_file},' % message_function_prefix(package, message),
+        '{"iter_delimited_file", %siter_delimited_file},' % message_function_prefix(package, message),
+        '{"peek", %speek},' % message_function_prefix(package, message),
+        '{"parse_many", %sparse_many},' % message_function_prefix(package, message),
+        '{"serialize_many", %sserialize_many},' % message_function_prefix(package, message),
+        '{"adopt", %sadopt},' % message_function_prefix(package, message),
+        '{"clone", %sclone},' % message_function_prefix(package, message),
+        '{"path", %spath},' % message_function_prefix(package, message),
+        '{"mask", %smask},' % message_function_prefix(package, message),
+        '{"fromjson", %sfromjson},' % message_function_prefix(package, message),
+        '#ifdef LUA_PROTOBUF_GZIP',
+        '{"parse_compressed", %sparse_compressed},' % message_function_prefix(package, message),
+        '{"iter_delimited_compressed", %siter_delimited_compressed},' % message_function_prefix(package, message),
+        '#endif',
+        '#ifdef LUA_PROTOBUF_ASYNC',
+        '{"parse_async", %sparse_async},' % message_function_prefix(package, message),
+        '#endif',
         '{NULL, NULL}',
         '};\n',
     ]
@@ -732,6 +4536,28 @@ def message_method_array(package, descriptor):
     lines.append('static const struct luaL_Reg %s_methods [] = {' % message)
     lines.append('{"serialized", %sserialized},' % fp)
     lines.append('{"clear", %sclear},' % fp)
+    lines.append('{"write_delimited", %swrite_delimited},' % fp)
+    lines.append('{"tojson", %stojson},' % fp)
+    lines.append('#ifdef LUA_PROTOBUF_GZIP')
+    lines.append('{"serialized_compressed", %sserialized_compressed},' % fp)
+    lines.append('{"write_delimited_compressed", %swrite_delimited_compressed},' % fp)
+    lines.append('#endif')
+    lines.append('{"serialized_masked", %sserialized_masked},' % fp)
+    lines.append('{"merge_masked", %smerge_masked},' % fp)
+    lines.append('{"getpath", %sgetpath},' % fp)
+    lines.append('{"setpath", %ssetpath},' % fp)
+    lines.append('{"copy_from", %scopy_from},' % fp)
+    lines.append('{"merge_from", %smerge_from},' % fp)
+    lines.append('{"swap", %sswap},' % fp)
+    lines.append('{"freeze", %sfreeze},' % fp)
+    lines.append('{"frozen", %sfrozen},' % fp)
+    lines.append('{"share", %sshare},' % fp)
+    lines.append('#ifdef LUA_PROTOBUF_ASYNC')
+    lines.append('{"serialize_async", %sserialize_async},' % fp)
+    lines.append('#endif')
+
+    if lazy_fields(descriptor):
+        lines.append('{"materialize", %smaterialize},' % fp)
     lines.append('{"__gc", %sgc},' % message_function_prefix(package, message))
 
     for fd in descriptor.field:
@@ -743,6 +4569,12 @@ def message_method_array(package, descriptor):
         lines.append('{"get_%s", %s},' % ( name, field_function_name(package, message, 'get', name) ))
         lines.append('{"set_%s", %s},' % ( name, field_function_name(package, message, 'set', name) ))
 
+        if type in [ FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES ]:
+            lines.append('{"get_%s_view", %s},' % ( name, field_function_name(package, message, 'get', '%s_view' % name) ))
+
+        if type == FieldDescriptor.TYPE_MESSAGE:
+            lines.append('{"swap_%s", %s},' % ( name, field_function_name(package, message, 'swap', name) ))
+
         if label in [ FieldDescriptor.LABEL_REQUIRED, FieldDescriptor.LABEL_OPTIONAL ]:
             lines.append('{"has_%s", %s},' % ( name, field_function_name(package, message, 'has', name) ))
 
@@ -757,14 +4589,30 @@ def message_method_array(package, descriptor):
 
     return lines
 
+def message_type_id(full_name):
+    '''Returns the id of a message type, the 32 bit FNV-1a hash of its full name'''
+
+    h = 2166136261
+    for c in bytearray(full_name.encode('utf-8')):
+        h = ((h ^ c) * 16777619) & 0xffffffff
+
+    return h
+
 def message_open_function(package, descriptor):
     '''Function definition for opening/registering a message type'''
 
     message = descriptor.name
+    full_name = '%s.%s' % (package, message)
+    fp = message_function_prefix(package, message)
 
     lines = [
+        'static const lua_protobuf_type %s_type = {' % message,
+            '"%s", %du, %snew, %sparsefromstring, "%s",' % ( full_name, message_type_id(full_name), fp, fp, lua_libname(package, message) ),
+        '};',
+        '',
         'int %s(lua_State *L)' % message_open_function_name(package, message),
         '{',
+        'lua_protobuf_register_type(L, &%s_type);' % message,
         'luaL_newmetatable(L, "%s");' % metatable(package, message),
         'lua_pushvalue(L, -1);',
         'lua_setfield(L, -2, "__index");',
@@ -805,6 +4653,10 @@ def message_header(package, message_descriptor):
         '// be reflected in Lua and vice-verse',
         'LUA_PROTOBUF_EXPORT bool %s%s_pushcopy(lua_State *L, const %s &msg);' % ( function_prefix, message_name, c),
         '',
+        '// push a message allocated with new to the Lua stack',
+        '// Lua takes ownership of the message and deletes it when it is garbage collected',
+        'LUA_PROTOBUF_EXPORT bool %s%s_pushowned(lua_State *L, %s *msg);' % ( function_prefix, message_name, c ),
+        '',
         '// push a reference of the message to the Lua stack',
         '// the 3rd and 4th arguments define a callback that can be invoked just before Lua',
         '// garbage collects the message. If the 3rd argument is NULL, Lua will *NOT* free',
@@ -834,8 +4686,136 @@ def message_header(package, message_descriptor):
         '// clear all fields in the message',
         'LUA_PROTOBUF_EXPORT int %s%s_clear(lua_State *L);' % ( function_prefix, message_name ),
         '',
+        '// obtain an iterator over length-delimited messages in a file or string',
+        '// if the 2nd argument is true, one message instance is reused for every iteration',
+        'LUA_PROTOBUF_EXPORT int %s%s_iter_delimited(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// obtain instance from a file, which is memory mapped instead of read. string',
+        '// fields are copied out of the mapping',
+        '// optional 2nd and 3rd arguments define the offset and length of the message in the file',
+        'LUA_PROTOBUF_EXPORT int %s%s_parse_file(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// obtain an iterator over length-delimited messages in a memory mapped file',
+        '// arguments are the same as parse_file, followed by the reuse flag of iter_delimited',
+        'LUA_PROTOBUF_EXPORT int %s%s_iter_delimited_file(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// read fields from a serialized string without parsing the whole message',
+        '// the 2nd argument is a table of field names. nested fields are separated by dots',
+        '// the values of the fields are returned in the same order. embedded messages are',
+        '// returned serialized. if a path contains a repeated field, its value is a table',
+        'LUA_PROTOBUF_EXPORT int %s%s_peek(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// obtain instances from an array of serialized strings, in a single call',
+        '// instances are stored in the array given as 2nd argument, or a new one. instances',
+        '// already in that array are reused',
+        'LUA_PROTOBUF_EXPORT int %s%s_parse_many(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// obtain an array of serialized representations from an array of instances',
+        'LUA_PROTOBUF_EXPORT int %s%s_serialize_many(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// compile a path such as "a.b[2].c" for use with getpath and setpath',
+        'LUA_PROTOBUF_EXPORT int %s%s_path(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// obtain the value at the end of a path, which is a string or compiled path',
+        '// returns nil if a field along the path is not set',
+        'LUA_PROTOBUF_EXPORT int %s%s_getpath(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// set the value at the end of a path, creating the embedded messages along it',
+        'LUA_PROTOBUF_EXPORT int %s%s_setpath(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// obtain the JSON representation of instance',
+        '// the optional 2nd argument is a table of options: pretty, defaults, enums_as_ints',
+        '// and preserve_field_names',
+        'LUA_PROTOBUF_EXPORT int %s%s_tojson(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// obtain instance from a JSON string',
+        '// the optional 2nd argument is a table of options: ignore_unknown',
+        'LUA_PROTOBUF_EXPORT int %s%s_fromjson(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '#ifdef LUA_PROTOBUF_GZIP',
+        '// obtain the serialized representation of instance compressed with gzip',
+        '// the optional 2nd argument is the zlib compression level',
+        'LUA_PROTOBUF_EXPORT int %s%s_serialized_compressed(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// obtain instance from a string produced by serialized_compressed',
+        'LUA_PROTOBUF_EXPORT int %s%s_parse_compressed(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// like write_delimited, but the output is compressed with gzip',
+        '// the optional 3rd argument is the zlib compression level',
+        'LUA_PROTOBUF_EXPORT int %s%s_write_delimited_compressed(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// like iter_delimited, but the file or string is decompressed with gzip',
+        'LUA_PROTOBUF_EXPORT int %s%s_iter_delimited_compressed(lua_State *L);' % ( function_prefix, message_name ),
+        '#endif',
+        '',
+        '// compile a table of field paths such as "a.b", like a FieldMask',
+        'LUA_PROTOBUF_EXPORT int %s%s_mask(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// obtain the serialized representation of the fields of instance in a mask',
+        '// the mask is a table of paths or a compiled mask',
+        'LUA_PROTOBUF_EXPORT int %s%s_serialized_masked(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// replace the fields of instance in the mask given as 3rd argument with those of',
+        '// the 2nd argument. fields that are not set in the 2nd argument are cleared',
+        'LUA_PROTOBUF_EXPORT int %s%s_merge_masked(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// replace the contents of instance with those of the 2nd argument',
+        'LUA_PROTOBUF_EXPORT int %s%s_copy_from(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// merge the 2nd argument into instance, like parsing its serialized form would',
+        'LUA_PROTOBUF_EXPORT int %s%s_merge_from(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// exchange the contents of instance and the 2nd argument',
+        'LUA_PROTOBUF_EXPORT int %s%s_swap(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// obtain a copy of a message owned by Lua',
+        'LUA_PROTOBUF_EXPORT int %s%s_clone(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// make instance immutable. its setters, clear functions and those of its embedded',
+        '// messages raise errors from then on. returns instance',
+        'LUA_PROTOBUF_EXPORT int %s%s_freeze(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// whether instance is frozen',
+        'LUA_PROTOBUF_EXPORT int %s%s_frozen(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// freeze instance and return a light userdata that other Lua states can adopt',
+        'LUA_PROTOBUF_EXPORT int %s%s_share(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// obtain a read-only instance from the light userdata returned by share()',
+        '// the message is not copied. it is deleted when no Lua state refers to it anymore',
+        'LUA_PROTOBUF_EXPORT int %s%s_adopt(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '#ifdef LUA_PROTOBUF_ASYNC',
+        '// parse a serialized string on the worker pool',
+        '// returns a handle whose done() polls and wait() blocks for completion. result()',
+        '// waits and returns the message, or raises the error',
+        'LUA_PROTOBUF_EXPORT int %s%s_parse_async(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// serialize instance on the worker pool. returns a handle like parse_async',
+        '// until the job is done, functions that modify or serialize the instance',
+        '// wait for it first',
+        'LUA_PROTOBUF_EXPORT int %s%s_serialize_async(lua_State *L);' % ( function_prefix, message_name ),
+        '#endif',
+        '',
+        '// table of fields used to walk serialized messages',
+        'LUA_PROTOBUF_EXPORT extern const lua_protobuf_field_info %s[];' % message_fields_name('.%s.%s' % ( package, message_name )),
+        '',
+        '// function called by the iterators returned by iter_delimited and iter_delimited_file',
+        'LUA_PROTOBUF_EXPORT int %s%s_iter_delimited_next(lua_State *L);' % ( function_prefix, message_name ),
+        '',
+        '// write instance prefixed with its length to a file',
+        '// if no file is given, the length-delimited representation is returned',
+        'LUA_PROTOBUF_EXPORT int %s%s_write_delimited(lua_State *L);' % ( function_prefix, message_name ),
+        '',
     ])
 
+    if lazy_fields(message_descriptor):
+        lines.extend([
+            '// parse all fields marked lazy which were not accessed yet',
+            'LUA_PROTOBUF_EXPORT int %s%s_materialize(lua_State *L);' % ( function_prefix, message_name ),
+            '',
+        ])
+
     # each field defined in the message
     for field_descriptor in message_descriptor.field:
         field_name = field_descriptor.name
@@ -858,9 +4838,14 @@ def message_header(package, message_descriptor):
         lines.append('LUA_PROTOBUF_EXPORT int %s%s_clear_%s(lua_State *L);' % (function_prefix, message_name, field_name))
         lines.append('LUA_PROTOBUF_EXPORT int %s%s_get_%s(lua_State *L);' % (function_prefix, message_name, field_name))
 
-        # TODO I think we can get rid of this for message types
         lines.append('LUA_PROTOBUF_EXPORT int %s%s_set_%s(lua_State *L);' % (function_prefix, message_name, field_name))
 
+        if field_type in [ FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES ]:
+            lines.append('LUA_PROTOBUF_EXPORT int %s%s_get_%s_view(lua_State *L);' % (function_prefix, message_name, field_name))
+
+        if field_type == FieldDescriptor.TYPE_MESSAGE:
+            lines.append('LUA_PROTOBUF_EXPORT int %s%s_swap_%s(lua_State *L);' % (function_prefix, message_name, field_name))
+
         if field_label in [ FieldDescriptor.LABEL_REQUIRED, FieldDescriptor.LABEL_OPTIONAL ]:
             lines.append('LUA_PROTOBUF_EXPORT int %s%s_has_%s(lua_State *L);' % (function_prefix, message_name, field_name))
 
@@ -872,6 +4857,8 @@ def message_header(package, message_descriptor):
 
         lines.append('')
 
+    lines.extend(ffi_header(package, message_descriptor))
+
     lines.append('// end of message %s\n' % message_name)
 
     return lines
@@ -883,47 +4870,123 @@ def message_source(package, message_descriptor):
 
     message = message_descriptor.name
 
+    lines.extend(message_fields_table(package, message_descriptor))
     lines.extend(message_function_array(package, message))
     lines.extend(message_method_array(package, message_descriptor))
     lines.extend(message_open_function(package, message_descriptor))
+    lines.extend(message_pushnew_function(package, message))
+    lines.extend(message_pushowned_function(package, message))
     lines.extend(message_pushcopy_function(package, message))
     lines.extend(message_pushreference_function(package, message))
     lines.extend(new_message(package, message))
-    lines.extend(parsefromstring_message_function(package, message))
+    lines.extend(parsefromstring_message_function(package, message_descriptor))
     lines.extend(gc_message_function(package, message))
     lines.extend(clear_message_function(package, message))
     lines.extend(serialized_message_function(package, message))
+    lines.extend(iter_delimited_message_function(package, message))
+    lines.extend(parse_file_message_function(package, message))
+    lines.extend(iter_delimited_file_message_function(package, message))
+    lines.extend(peek_message_function(package, message))
+    lines.extend(parse_many_message_function(package, message_descriptor))
+    lines.extend(serialize_many_message_function(package, message))
+    lines.extend(async_message_functions(package, message))
+    lines.extend(shared_message_functions(package, message))
+    lines.extend(copy_message_functions(package, message))
+    lines.extend(path_message_functions(package, message))
+    lines.extend(mask_message_functions(package, message))
+    lines.extend(json_message_functions(package, message))
+    lines.extend(compressed_message_functions(package, message))
+    lines.extend(write_delimited_message_function(package, message))
+
+    if lazy_fields(message_descriptor):
+        lines.extend(materialize_message_function(package, message))
 
     for descriptor in message_descriptor.field:
         name = descriptor.name
+        lazy_field = descriptor if is_lazy(descriptor) else None
 
         # clear() is in all label types
         lines.extend(field_function_start(package, message, 'clear', name))
-        lines.extend(clear_body(package, message, name))
+        lines.extend(clear_body(package, message, name, lazy_field))
         lines.append('}\n')
 
         lines.extend(field_get(package, message, descriptor))
         lines.extend(field_set(package, message, descriptor))
 
+        if descriptor.type in [ FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES ]:
+            lines.extend(field_get_view(package, message, descriptor))
+
+        if descriptor.type == FieldDescriptor.TYPE_MESSAGE:
+            lines.extend(field_swap(package, message, descriptor))
+
         if descriptor.label in [FieldDescriptor.LABEL_OPTIONAL, FieldDescriptor.LABEL_REQUIRED]:
             # has_<field>()
             lines.extend(field_function_start(package, message, 'has', name))
-            lines.extend(has_body(package, message, name))
+            lines.extend(has_body(package, message, name, lazy_field))
             lines.append('}\n')
 
         if descriptor.label == FieldDescriptor.LABEL_REPEATED:
             # size_<field>()
             lines.extend(field_function_start(package, message, 'size', name))
-            lines.extend(size_body(package, message, name))
+            lines.extend(size_body(package, message, name, lazy_field))
             lines.append('}\n')
 
             if descriptor.type == FieldDescriptor.TYPE_MESSAGE:
                 lines.extend(field_function_start(package, message, 'add', name))
-                lines.extend(add_body(package, message, name, descriptor.type_name))
+                lines.extend(add_body(package, message, name, descriptor.type_name, lazy_field))
                 lines.append('}\n')
 
+    lines.extend(ffi_source(package, message_descriptor))
 
-    return lines
+    return count_message_calls(package, message, lines)
+
+def count_message_calls(package, message, lines):
+    '''Adds call counters to the Lua functions of a message type
+
+    Every function defined as int <prefix><name>(lua_State *L) is counted
+    under <name> when LUA_PROTOBUF_STATS is defined.
+    '''
+
+    fp = message_function_prefix(package, message)
+    start = 'int %s' % fp
+    end = '(lua_State *L)'
+
+    functions = []
+    counted = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        counted.append(line)
+        i += 1
+
+        if not (line.startswith(start) and line.endswith(end)) or lines[i] != '{':
+            continue
+
+        name = line[len(start):-len(end)]
+        if name == 'open':
+            continue
+
+        # the counter goes right after the opening bracket
+        counted.append(lines[i])
+        counted.append('LUA_PROTOBUF_COUNT(%s_counters, %s_stats, LUA_PROTOBUF_STATS_FUNCTIONS + %d, 1);' % ( message, message, len(functions) ))
+        functions.append(name)
+        i += 1
+
+    header = [
+        '#ifdef LUA_PROTOBUF_STATS',
+        'static const char * const %s_stats_functions[] = {' % message,
+    ]
+    header.extend([ '"%s",' % name for name in functions ])
+    header.extend([
+            'NULL',
+        '};',
+        'static const lua_protobuf_stats_type %s_stats = { "%s.%s", %s_stats_functions };' % ( message, package, message, message ),
+        'static thread_local lua_protobuf_counter *%s_counters = NULL;' % message,
+        '#endif',
+        '',
+    ])
+
+    return header + counted
 
 def enum_source(descriptor):
     '''Returns source code defining an enumeration type'''
@@ -935,9 +4998,10 @@ def enum_source(descriptor):
 
     # enums are a little funky
     # at the core, there is a table whose keys are the enum string names and
-    # values corresponding to the respective integer values. this table also
-    # has a metatable with __index to throw errors when unknown enumerations
-    # are accessed
+    # values corresponding to the respective integer values. the integer
+    # values are keys as well, mapping back to the first name with that
+    # value. this table also has a metatable with __index to throw errors
+    # when unknown enumerations are accessed
     #
     # this table is then wrapped in a proxy table. the proxy table is empty
     # but has a metatable with __index and __newindex set. __index is the
@@ -947,10 +5011,24 @@ def enum_source(descriptor):
     # we need the proxy table so we can intercept all requests for writes.
     # __newindex is only called for new keys, so we need an empty table so
     # all writes are sent to __newindex
+    #
+    # with LUA_PROTOBUF_FLAT_ENUMS, the main table is used directly, which
+    # saves the metamethod calls on every access. debug builds keep the
+    # proxy to catch misspelled names and writes
+    numbers = []
+    for value in descriptor.value:
+        if value.number not in numbers:
+            numbers.append(value.number)
+
+    array_size = len([ v for v in numbers if 1 <= v <= len(numbers) ])
+    hash_size = len(descriptor.value) + len(numbers) - array_size
+
     lines = [
         '// %s enum' % name,
+        '#if !defined(LUA_PROTOBUF_FLAT_ENUMS) || defined(LUA_PROTOBUF_DEBUG)',
         'lua_newtable(L); // proxy table',
-        'lua_newtable(L); // main table',
+        '#endif',
+        'lua_createtable(L, %d, %d); // main table' % ( array_size, hash_size ),
     ]
 
     # assign enumerations to the table
@@ -958,12 +5036,25 @@ def enum_source(descriptor):
         k = value.name
         v = value.number
         lines.extend([
-            'lua_pushnumber(L, %d);' % v,
+            'lua_pushinteger(L, %d);' % v,
             'lua_setfield(L, -2, "%s");' % k
         ])
 
+    # and the reverse index
+    named = set()
+    for value in descriptor.value:
+        if value.number in named:
+            continue
+        named.add(value.number)
+
+        lines.extend([
+            'lua_pushliteral(L, "%s");' % value.name,
+            'lua_rawseti(L, -2, %d);' % value.number,
+        ])
+
     # assign the metatable
     lines.extend([
+        '#if !defined(LUA_PROTOBUF_FLAT_ENUMS) || defined(LUA_PROTOBUF_DEBUG)',
         '// define metatable on main table',
         'lua_newtable(L);',
         'lua_pushcfunction(L, lua_protobuf_enum_index);',
@@ -980,8 +5071,9 @@ def enum_source(descriptor):
         'lua_setfield(L, -2, "__newindex");',
         'lua_remove(L, -2);',
         'lua_setmetatable(L, -2);',
+        '#endif',
 
-        # proxy at top of stack now
+        # proxy (or main table) at top of stack now
         # assign to appropriate module
         'lua_setfield(L, -2, "%s");' % name,
         '// end %s enum' % name
@@ -989,6 +5081,442 @@ def enum_source(descriptor):
 
     return lines
 
+def ffi_function_name(package, message, prefix, field=None):
+    '''Obtain the name of a flat accessor function used by the LuaJIT FFI bindings'''
+
+    if field is None:
+        return '%sffi_%s' % ( message_function_prefix(package, message), prefix )
+
+    return '%sffi_%s_%s' % ( message_function_prefix(package, message), prefix, field )
+
+def ffi_struct_name(type_name):
+    '''Returns the opaque struct standing in for a message type in FFI declarations'''
+
+    return 'lua_protobuf%s' % type_name.replace('.', '_')
+
+def ffi_message_pointer(type_name, cdef, const=False):
+    '''Returns the type of a message pointer in a flat accessor signature
+
+    The C++ declarations use the real message class. The declarations handed
+    to ffi.cdef use an opaque struct instead, which is passed the same way.
+    '''
+
+    if cdef:
+        t = 'struct %s' % ffi_struct_name(type_name)
+    else:
+        t = cpp_class(type_name)
+
+    if const:
+        return 'const %s *' % t
+
+    return '%s *' % t
+
+def ffi_functions(package, descriptor, cdef=False):
+    '''Returns the flat accessor functions for a message
+
+    Each function is a tuple of return type, name, arguments and body lines.
+    The accessors only deal in plain C types and message pointers, so LuaJIT
+    can call them without leaving a trace. Repeated fields are indexed from 0.
+    '''
+
+    message = descriptor.name
+    own = '.%s.%s' % ( package, message )
+    m = ffi_message_pointer(own, cdef) + 'm'
+    cm = ffi_message_pointer(own, cdef, const=True) + 'm'
+
+    functions = [
+        # returns the message of a userdata, or NULL if it is frozen. a job
+        # serializing it is waited for. once wrapped, the message cannot be
+        # frozen or serialized in the background anymore
+        (ffi_message_pointer(own, cdef), ffi_function_name(package, message, 'wrap'), 'void *ud', [
+            'msg_udata * root = msg_udata_root((msg_udata *)ud);',
+            'if (!msg_udata_modify(root)) {',
+                'return NULL;',
+            '}',
+            'root->wrapped = true;',
+            'return (%s *)((msg_udata *)ud)->msg;' % cpp_class(own),
+        ]),
+        ('void', ffi_function_name(package, message, 'clear'), m, ['m->Clear();']),
+    ]
+
+    for fd in descriptor.field:
+        name = fd.name
+        type = fd.type
+        repeated = fd.label == FieldDescriptor.LABEL_REPEATED
+
+        def f(prefix):
+            return ffi_function_name(package, message, prefix, name)
+
+        functions.append(('void', f('clear'), m, ['m->clear_%s();' % name]))
+
+        if repeated:
+            functions.append(('int', f('size'), cm, ['return m->%s_size();' % name]))
+        else:
+            functions.append(('int', f('has'), cm, ['return m->has_%s();' % name]))
+
+        if type in [ FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES ]:
+            if repeated:
+                functions.extend([
+                    ('const char *', f('get'), cm + ', int index, size_t *len', [
+                        'const string &s = m->%s(index);' % name,
+                        '*len = s.size();',
+                        'return s.data();',
+                    ]),
+                    ('void', f('set'), m + ', int index, const char *s, size_t len', ['m->set_%s(index, s, len);' % name]),
+                    ('void', f('add'), m + ', const char *s, size_t len', ['m->add_%s(s, len);' % name]),
+                ])
+            else:
+                functions.extend([
+                    ('const char *', f('get'), cm + ', size_t *len', [
+                        'const string &s = m->%s();' % name,
+                        '*len = s.size();',
+                        'return s.data();',
+                    ]),
+                    ('void', f('set'), m + ', const char *s, size_t len', ['m->set_%s(s, len);' % name]),
+                ])
+
+        elif type == FieldDescriptor.TYPE_MESSAGE:
+            sub = ffi_message_pointer(fd.type_name, cdef)
+            if repeated:
+                functions.extend([
+                    (sub, f('get'), m + ', int index', ['return m->mutable_%s(index);' % name]),
+                    (sub, f('add'), m, ['return m->add_%s();' % name]),
+                ])
+            else:
+                functions.append((sub, f('get'), m, ['return m->mutable_%s();' % name]))
+
+        elif type in FFI_SCALAR_TYPE_MAP:
+            t = FFI_SCALAR_TYPE_MAP[type]
+
+            if type == FieldDescriptor.TYPE_BOOL:
+                value = 'v != 0'
+            elif type == FieldDescriptor.TYPE_ENUM:
+                value = '(%s)v' % fd.type_name.replace('.', '::')
+            else:
+                value = 'v'
+
+            if repeated:
+                get = 'm->%s(index)' % name
+            else:
+                get = 'm->%s()' % name
+
+            if type == FieldDescriptor.TYPE_BOOL:
+                get = '%s ? 1 : 0' % get
+
+            if repeated:
+                functions.extend([
+                    (t, f('get'), cm + ', int index', ['return %s;' % get]),
+                    ('void', f('set'), '%s, int index, %s v' % ( m, t ), ['m->set_%s(index, %s);' % ( name, value )]),
+                    ('void', f('add'), '%s, %s v' % ( m, t ), ['m->add_%s(%s);' % ( name, value )]),
+                ])
+            else:
+                functions.extend([
+                    (t, f('get'), cm, ['return %s;' % get]),
+                    ('void', f('set'), '%s, %s v' % ( m, t ), ['m->set_%s(%s);' % ( name, value )]),
+                ])
+
+    return functions
+
+def ffi_header(package, descriptor):
+    '''Returns the declarations of the flat accessors for a message'''
+
+    lines = [
+        '#ifdef LUA_PROTOBUF_FFI',
+        '// flat accessors called by the LuaJIT FFI bindings',
+    ]
+
+    for ret, name, args, body in ffi_functions(package, descriptor):
+        lines.append('LUA_PROTOBUF_EXPORT %s %s(%s);' % ( ret, name, args ))
+
+    lines.append('#endif')
+    lines.append('')
+
+    return lines
+
+def ffi_source(package, descriptor):
+    '''Returns the definitions of the flat accessors for a message'''
+
+    lines = ['#ifdef LUA_PROTOBUF_FFI']
+
+    for ret, name, args, body in ffi_functions(package, descriptor):
+        lines.append('%s %s(%s)' % ( ret, name, args ))
+        lines.append('{')
+        lines.extend(body)
+        lines.append('}\n')
+
+    lines.append('#endif')
+
+    return lines
+
+def ffi_message_lua(package, descriptor):
+    '''Returns the Lua wrappers for a message in the FFI module
+
+    Methods mirror the C API: indexes start at 1, unset singular fields read
+    as nil and assigning nil clears a field.
+    '''
+
+    message = descriptor.name
+    ctype = 'struct %s *' % ffi_struct_name('.%s.%s' % ( package, message ))
+    lib = lua_libname(package, message)
+
+    lines = [
+        '-- Message %s' % message,
+        'local %s = {}' % message,
+        'M.%s = %s' % ( message, message ),
+        '',
+        '-- obtain the FFI view of a message userdata created by the C API',
+        'function %s.wrap(ud)' % message,
+        '    if getmetatable(ud) ~= registry["%s"] then' % metatable(package, message),
+        '        error("not a %s message", 2)' % lib,
+        '    end',
+    ]
+
+    # the flat accessors bypass the userdata, which holds unparsed lazy fields
+    if lazy_fields(descriptor):
+        lines.append('    ud:materialize()')
+
+    lines.extend([
+        '    local m = C.%s(ud)' % ffi_function_name(package, message, 'wrap'),
+        '    if m == nil then',
+        '        error("frozen messages cannot be wrapped", 2)',
+        '    end',
+        '    anchors[m] = ud',
+        '    return m',
+        'end',
+        '',
+        '-- obtain the C API userdata a view was wrapped from',
+        'function %s.unwrap(m)' % message,
+        '    return anchors[m]',
+        'end',
+        '',
+        'function %s.new()' % message,
+        '    return %s.wrap(%s.new())' % ( message, lib ),
+        'end',
+        '',
+        'function %s.parsefromstring(s)' % message,
+        '    return %s.wrap(%s.parsefromstring(s))' % ( message, lib ),
+        'end',
+        '',
+        'function %s.clear(m)' % message,
+        '    C.%s(m)' % ffi_function_name(package, message, 'clear'),
+        'end',
+        '',
+    ])
+
+    for fd in descriptor.field:
+        name = fd.name
+        type = fd.type
+        repeated = fd.label == FieldDescriptor.LABEL_REPEATED
+
+        def f(prefix):
+            return 'C.%s' % ffi_function_name(package, message, prefix, name)
+
+        if type in [ FieldDescriptor.TYPE_STRING, FieldDescriptor.TYPE_BYTES ]:
+            get = 'ffi.string(%s(m%%s, len), len[0])' % f('get')
+            check = [
+                '    if type(v) ~= "string" and type(v) ~= "number" then',
+                '        error("passed value is not a string", 2)',
+                '    end',
+                '    v = tostring(v)',
+            ]
+            args = 'v, #v'
+        elif type == FieldDescriptor.TYPE_MESSAGE:
+            # the embedded message lies inside of m, whose userdata must stay alive
+            get = 'child(m, %s(m%%s))' % f('get')
+            check = None
+            args = None
+        elif type in FFI_SCALAR_TYPE_MAP:
+            get = '%s(m%%s)' % f('get')
+            if type == FieldDescriptor.TYPE_BOOL:
+                get = '%s ~= 0' % get
+            elif type in FFI_INT64_TYPES:
+                get = 'tonumber(%s)' % get
+            if type == FieldDescriptor.TYPE_BOOL:
+                check = ['    v = v and 1 or 0']
+            else:
+                check = []
+            args = 'v'
+        else:
+            # same as the C API, which does not support groups
+            continue
+
+        lines.extend([
+            'function %s.clear_%s(m)' % ( message, name ),
+            '    %s(m)' % f('clear'),
+            'end',
+            '',
+        ])
+
+        if repeated:
+            lines.extend([
+                'function %s.size_%s(m)' % ( message, name ),
+                '    return %s(m)' % f('size'),
+                'end',
+                '',
+                'function %s.get_%s(m, i)' % ( message, name ),
+                '    local size = %s(m)' % f('size'),
+                '    if i < 1 or i > size then',
+                '        error(string.format("index must be between 1 and current size: %d", size), 2)',
+                '    end',
+                '    return %s' % ( get % ', i - 1' ),
+                'end',
+                '',
+            ])
+
+            if type == FieldDescriptor.TYPE_MESSAGE:
+                lines.extend([
+                    'function %s.add_%s(m)' % ( message, name ),
+                    '    return child(m, %s(m))' % f('add'),
+                    'end',
+                    '',
+                ])
+            else:
+                lines.append('function %s.set_%s(m, i, v)' % ( message, name ))
+                lines.extend([
+                    '    local size = %s(m)' % f('size'),
+                    '    if i < 1 or i > size + 1 then',
+                    '        error(string.format("index must be between 1 and %d", size + 1), 2)',
+                    '    end',
+                    '    if v == nil then',
+                    '        error("cannot assign nil to repeated fields (yet)", 2)',
+                    '    end',
+                ])
+                lines.extend(check)
+                lines.extend([
+                    '    if i == size + 1 then',
+                    '        %s(m, %s)' % ( f('add'), args ),
+                    '    else',
+                    '        %s(m, i - 1, %s)' % ( f('set'), args ),
+                    '    end',
+                    'end',
+                    '',
+                ])
+        else:
+            lines.extend([
+                'function %s.has_%s(m)' % ( message, name ),
+                '    return %s(m) ~= 0' % f('has'),
+                'end',
+                '',
+                'function %s.get_%s(m)' % ( message, name ),
+            ])
+
+            # like the C API, embedded messages are always returned so they
+            # can be populated
+            if type != FieldDescriptor.TYPE_MESSAGE:
+                lines.extend([
+                    '    if %s(m) == 0 then' % f('has'),
+                    '        return nil',
+                    '    end',
+                ])
+
+            lines.extend([
+                '    return %s' % ( get % '' ),
+                'end',
+                '',
+            ])
+
+            if type != FieldDescriptor.TYPE_MESSAGE:
+                lines.extend([
+                    'function %s.set_%s(m, v)' % ( message, name ),
+                    '    if v == nil then',
+                    '        %s(m)' % f('clear'),
+                    '        return',
+                    '    end',
+                ])
+                lines.extend(check)
+                lines.extend([
+                    '    %s(m, %s)' % ( f('set'), args ),
+                    'end',
+                    '',
+                ])
+
+    lines.extend([
+        'ffi.metatype("%s", { __index = %s })' % ( ctype[:-2], message ),
+        '',
+    ])
+
+    return lines
+
+def file_ffi(file_descriptor):
+    '''Returns the LuaJIT FFI module for a FileDescriptor instance
+
+    The module wraps message userdata created by the C API in FFI cdata whose
+    methods call the flat accessors. The C++ output must be compiled with
+    LUA_PROTOBUF_FFI defined and its symbols must be visible to ffi.C, or the
+    library containing them handed to setlib().
+    '''
+
+    filename = file_descriptor.name
+    package = file_descriptor.package
+
+    lines = [
+        '-- Generated by the lua-protobuf compiler',
+        '-- You shouldn\'t edit this file manually',
+        '--',
+        '-- source proto file: %s' % filename,
+        '',
+        'local ffi = require("ffi")',
+        '',
+        'ffi.cdef[[',
+    ]
+
+    structs = []
+    for descriptor in file_descriptor.message_type:
+        structs.append('.%s.%s' % ( package, descriptor.name ))
+        for fd in descriptor.field:
+            if fd.type == FieldDescriptor.TYPE_MESSAGE and fd.type_name not in structs:
+                structs.append(fd.type_name)
+
+    for type_name in structs:
+        lines.append('struct %s;' % ffi_struct_name(type_name))
+
+    for descriptor in file_descriptor.message_type:
+        for ret, name, args, body in ffi_functions(package, descriptor, cdef=True):
+            lines.append('%s %s(%s);' % ( ret, name, args ))
+
+    lines.extend([
+        ']]',
+        '',
+        'local C = ffi.C',
+        'local registry = debug.getregistry()',
+        '',
+        '-- wrapped messages map to their userdata, and embedded messages obtained',
+        '-- from them to the userdata they lie inside of. the tables are shared by',
+        '-- the modules of all files, as messages of one are embedded in another',
+        'local anchors = registry["lua_protobuf.ffi.anchors"]',
+        'local parents = registry["lua_protobuf.ffi.parents"]',
+        'if not anchors then',
+        '    anchors = setmetatable({}, { __mode = "k" })',
+        '    parents = setmetatable({}, { __mode = "k" })',
+        '    registry["lua_protobuf.ffi.anchors"] = anchors',
+        '    registry["lua_protobuf.ffi.parents"] = parents',
+        'end',
+        '',
+        '-- makes the embedded message c, obtained from m, keep m\'s userdata alive',
+        'local function child(m, c)',
+        '    parents[c] = anchors[m] or parents[m]',
+        '    return c',
+        'end',
+        '',
+        'local len = ffi.new("size_t[1]")',
+        '',
+        'local M = {}',
+        '',
+        '-- call the flat accessors through a library loaded with ffi.load()',
+        'function M.setlib(lib)',
+        '    C = lib',
+        'end',
+        '',
+    ])
+
+    for descriptor in file_descriptor.message_type:
+        lines.extend(ffi_message_lua(package, descriptor))
+
+    lines.append('return M')
+    lines.append('')
+
+    return '\n'.join(lines)
+
 def file_header(file_descriptor):
 
     filename = file_descriptor.name
@@ -996,7 +5524,7 @@ def file_header(file_descriptor):
 
     lines = []
 
-    lines.extend(c_header_header(filename, package))
+    lines.extend(c_header_header(filename, package, file_descriptor.dependency))
 
     for descriptor in file_descriptor.message_type:
         lines.extend(message_header(package, descriptor))
@@ -1022,6 +5550,8 @@ def file_source(file_descriptor):
     lines.extend([
         'int %sopen(lua_State *L)' % package_function_prefix(package),
         '{',
+        'lua_protobuf_open(L);',
+        'lua_pop(L, 1);',
     ])
 
     # we populate enumerations as tables inside the protobuf global